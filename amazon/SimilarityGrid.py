@@ -1,50 +1,118 @@
 import collections
 import csv
 import sys
+import numpy as np
 
 class SimilarityGrid(collections.MutableMapping):
-    """A dictionary of similarity scores by rating pairs."""
+    """A dictionary of similarity scores by rating pairs.
+
+       Entries are [scoreTotal, count] bins over pairs (rating1, rating2) with
+       rating1 <= rating2, stored in two numpy planes indexed by the bin of
+       the lower rating and the offset of the higher rating's bin from it.
+       Bins are found arithmetically in O(1), and whole arrays of rating pairs
+       can be accumulated or looked up at once with add() and lookup().
+    """
     def __init__(self, minRating, maxRating, stepRating):
         self.minRating = minRating
         self.maxRating = maxRating
         self.stepRating = stepRating
-        self.store = {}
-        # initialize grid
-        for key in self:
-            self[key] = [0, 0]
-        # include null entry for bad keys
-        self[(self.maxRating, self.maxRating)] = None
+        # bin edges, accumulated exactly as the rating loops of the grid
+        # iteration accumulate them
+        self.rowEdges = np.array(self.__accumulate__(minRating))
+        numRows = len(self.rowEdges) - 1
+        colEdges = [self.__accumulate__(p) for p in self.rowEdges[:-1]]
+        numCols = max([len(edges) - 1 for edges in colEdges] + [0])
+        self.colEdges = np.empty((numRows, numCols + 1))
+        self.colEdges.fill(np.inf)
+        for i in range(numRows):
+            self.colEdges[i, :len(colEdges[i])] = colEdges[i]
+        self.scoreTotals = np.zeros((numRows, numCols))
+        self.counts = np.zeros((numRows, numCols), dtype=np.int64)
 
-    def __keytransform__(self, key):
-        rating1 = min(key[0], key[1])
-        rating2 = max(key[0], key[1])
-        if rating1 < self.minRating or\
-           rating2 > self.maxRating - self.stepRating:
-            return -1
-        idx = 0
-        p = self.minRating
+    def __accumulate__(self, p):
+        edges = []
         while p < self.maxRating:
-            q = p
-            while q < self.maxRating:
-                if rating1 >= p and rating1 < p + self.stepRating and\
-                   rating2 >= q and rating2 < q + self.stepRating:
-                    return idx
-                idx += 1
-                q += self.stepRating
+            edges.append(p)
             p += self.stepRating
-        raise Exception("Unreachable code.")
+        edges.append(p)
+        return edges
+
+    def getIndexes(self, ratings1, ratings2):
+        """Returns (rows, cols, valid) arrays locating the bins of arrays of
+           rating pairs. Pairs outside the grid have valid set to False.
+        """
+        lower = np.minimum(ratings1, ratings2)
+        upper = np.maximum(ratings1, ratings2)
+        valid = (lower >= self.minRating) &\
+                (upper <= self.maxRating - self.stepRating)
+        numRows, numCols = self.counts.shape
+        if not numRows or not numCols:
+            valid[:] = False
+            return (np.zeros(len(valid), dtype=np.int64),
+                    np.zeros(len(valid), dtype=np.int64), valid)
+        lower = np.where(valid, lower, self.minRating)
+        upper = np.where(valid, upper, self.minRating)
+        # arithmetic bin, corrected against the accumulated edges
+        rows = np.floor((lower - self.minRating)/self.stepRating)
+        rows = np.clip(rows, 0, numRows - 1).astype(np.int64)
+        rows -= lower < self.rowEdges[rows]
+        rows += lower >= self.rowEdges[rows + 1]
+        rows = np.clip(rows, 0, numRows - 1)
+        cols = np.floor((upper - self.rowEdges[rows])/self.stepRating)
+        cols = np.clip(cols, 0, numCols - 1).astype(np.int64)
+        cols -= upper < self.colEdges[rows, cols]
+        cols += upper >= self.colEdges[rows, cols + 1]
+        cols = np.clip(cols, 0, numCols - 1)
+        return rows, cols, valid
+
+    def add(self, ratings1, ratings2, scores):
+        """Adds scores to the bins of arrays of rating pairs. Returns the
+           number of pairs outside the grid, which are skipped.
+        """
+        ratings1 = np.asarray(ratings1, dtype=np.float64)
+        ratings2 = np.asarray(ratings2, dtype=np.float64)
+        scores = np.broadcast_to(np.asarray(scores, dtype=np.float64),
+                                 ratings1.shape)
+        rows, cols, valid = self.getIndexes(ratings1, ratings2)
+        np.add.at(self.scoreTotals, (rows[valid], cols[valid]), scores[valid])
+        np.add.at(self.counts, (rows[valid], cols[valid]), 1)
+        return len(valid) - np.count_nonzero(valid)
+
+    def lookup(self, ratings1, ratings2):
+        """Returns (scoreTotals, counts) arrays for arrays of rating pairs.
+           Pairs outside the grid get zero totals and counts.
+        """
+        ratings1 = np.asarray(ratings1, dtype=np.float64)
+        ratings2 = np.asarray(ratings2, dtype=np.float64)
+        rows, cols, valid = self.getIndexes(ratings1, ratings2)
+        return (np.where(valid, self.scoreTotals[rows, cols], 0.0),
+                np.where(valid, self.counts[rows, cols], 0))
+
+    def __keytransform__(self, key):
+        rows, cols, valid = self.getIndexes(np.array([float(key[0])]),
+                                            np.array([float(key[1])]))
+        if not valid[0]:
+            return -1
+        return (rows[0], cols[0])
 
     def __getitem__(self, key):
-        return self.store[self.__keytransform__(key)]
+        idx = self.__keytransform__(key)
+        if idx == -1:
+            return None
+        return GridEntry(self, idx)
 
     def __setitem__(self, key, value):
-        self.store[self.__keytransform__(key)] = value
+        idx = self.__keytransform__(key)
+        if idx == -1:
+            raise KeyError(key)
+        self.scoreTotals[idx] = value[0]
+        self.counts[idx] = value[1]
 
     def __delitem__(self, key):
-        del self.store[self.__keytransform__(key)]
+        self[key] = [0, 0]
 
     def __len__(self):
-        return len(self.store)
+        return int(np.count_nonzero(np.isfinite(self.colEdges[:, 1:])))
 
     def __iter__(self):
         self.current = [self.minRating, self.minRating]
@@ -77,10 +145,37 @@ class SimilarityGrid(collections.MutableMapping):
             rating2 = float(row[1])
             scoreTotal = float(row[2])
             count = int(row[3])
-            if not self[(rating1, rating2)]:
+            entry = self[(rating1, rating2)]
+            if not entry:
                 print >> sys.stderr,\
                     'WARNING: (%0.3f, %0.3f) not found.' % (rating1, rating2)
             else:
-                self[(rating1, rating2)][0] = scoreTotal
-                self[(rating1, rating2)][1] = count
+                entry[0] = scoreTotal
+                entry[1] = count
 
+class GridEntry(object):
+    """A [scoreTotal, count] view of one bin of a SimilarityGrid."""
+    def __init__(self, grid, idx):
+        self.grid = grid
+        self.idx = idx
+
+    def __len__(self):
+        return 2
+
+    def __getitem__(self, k):
+        if k == 0:
+            scoreTotal = float(self.grid.scoreTotals[self.idx])
+            if not scoreTotal and not self.grid.counts[self.idx]:
+                return 0
+            return scoreTotal
+        elif k == 1:
+            return int(self.grid.counts[self.idx])
+        raise IndexError(k)
+
+    def __setitem__(self, k, value):
+        if k == 0:
+            self.grid.scoreTotals[self.idx] = value
+        elif k == 1:
+            self.grid.counts[self.idx] = value
+        else:
+            raise IndexError(k)
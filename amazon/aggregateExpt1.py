@@ -5,10 +5,14 @@ Aggregates results of experiment 1 into a single data file.
 """
 
 from optparse import OptionParser
+import functools
+import numpy as np
 import csv
 import os
 import sys
-from fnmatch import fnmatch
+
+import resultStore
+import executor
 
 # params
 outputFileTemplate = '%s.csv'
@@ -22,35 +26,179 @@ def getParser(usage=None):
     parser = OptionParser(usage=usage)
     parser.add_option('-p', '--pattern', dest='pattern', default='*.csv',
         help='Input file pattern.', metavar='PATTERN')
+    parser.add_option('--shards', dest='shards', default=None,
+        help='Read results from the npz shards with this prefix.',
+        metavar='PREFIX')
+    parser.add_option('-w', '--numWorkers', dest='numWorkers', type='int',
+        default=1, help='Number of worker processes.', metavar='NUM')
     return parser
 
-def getNumUsers(csvFileName):
-    f = open(csvFileName, 'rb')
-    reader = csv.reader(f)
-    return [int(row[numUsersIdx]) for row in reader]
-
-def getData(csvFileName):
-    f = open(csvFileName, 'rb')
-    reader = csv.reader(f)
-    return [row for row in reader]
-
-def getLastRow(csvFileName):
-    with open(csvFileName, 'rb') as f:
-        reader = csv.reader(f)
-        lastRow = reader.next()
-        for row in reader:
-            lastRow = row
-        return lastRow
-
-def getVariances(csvFileName, truth):
-    f = open(csvFileName, 'rb')
-    reader = csv.reader(f)
-    return [(float(row[simIdx]) - truth)**2 for row in reader]
-
-def getErrors(csvFileName, truth):
-    f = open(csvFileName, 'rb')
-    reader = csv.reader(f)
-    return [float(row[simIdx]) - truth for row in reader]
+class ExptAccumulator(object):
+    """Running statistics of experiment results by step, built in one pass
+       over the product pairs. Means and variances of variances and errors
+       are updated with Welford's method, counts are kept as exact integer
+       sums, and the maximum variance of each step remembers the first pair
+       (in input order) to reach it. Accumulators over disjoint pairs can be
+       merged, so pairs may be split between processes.
+    """
+    def __init__(self):
+        self.numPairs = np.zeros(0, dtype=np.int64)
+        self.varMeans = np.zeros(0)
+        self.varM2s = np.zeros(0)
+        self.errMeans = np.zeros(0)
+        self.errM2s = np.zeros(0)
+        self.userSums = np.zeros(0, dtype=np.int64)
+        self.userSquareSums = np.zeros(0, dtype=np.int64)
+        self.lessSums = np.zeros(0, dtype=np.int64)
+        self.lessSquareSums = np.zeros(0, dtype=np.int64)
+        self.maxVars = np.zeros(0)
+        self.maxOrders = np.zeros(0, dtype=np.int64)
+        self.maxNames = []
+        self.firstOrder = None
+        self.firstNumUsers = None
+
+    def resize(self, numSteps):
+        extra = numSteps - len(self.numPairs)
+        if extra <= 0:
+            return
+        for attr in ('numPairs', 'varMeans', 'varM2s', 'errMeans', 'errM2s',
+                     'userSums', 'userSquareSums', 'lessSums',
+                     'lessSquareSums', 'maxVars'):
+            array = getattr(self, attr)
+            setattr(self, attr,
+                    np.append(array, np.zeros(extra, dtype=array.dtype)))
+        self.maxOrders = np.append(self.maxOrders,
+            np.empty(extra, dtype=np.int64))
+        self.maxOrders[-extra:] = np.iinfo(np.int64).max
+        self.maxNames += [None]*extra
+
+    def add(self, order, name, numUsers, variances, errors, users, less):
+        """Adds the results of the pair at position order of the input."""
+        numSteps = len(variances)
+        self.resize(numSteps)
+        if self.firstOrder is None or order < self.firstOrder:
+            self.firstOrder = order
+            self.firstNumUsers = numUsers
+        s = slice(0, numSteps)
+        self.numPairs[s] += 1
+        n = self.numPairs[s]
+        delta = variances - self.varMeans[s]
+        self.varMeans[s] += delta/n
+        self.varM2s[s] += delta*(variances - self.varMeans[s])
+        delta = errors - self.errMeans[s]
+        self.errMeans[s] += delta/n
+        self.errM2s[s] += delta*(errors - self.errMeans[s])
+        self.userSums[s] += users
+        self.userSquareSums[s] += users**2
+        self.lessSums[s] += less
+        self.lessSquareSums[s] += less**2
+        self.updateMaxima(variances, np.repeat(order, numSteps),
+                          [name]*numSteps)
+
+    def updateMaxima(self, maxVars, maxOrders, maxNames):
+        numSteps = len(maxVars)
+        better = (maxVars > self.maxVars[:numSteps]) |\
+                 ((maxVars == self.maxVars[:numSteps]) & (maxVars > 0) &\
+                  (maxOrders < self.maxOrders[:numSteps]))
+        for j in np.flatnonzero(better):
+            self.maxVars[j] = maxVars[j]
+            self.maxOrders[j] = maxOrders[j]
+            self.maxNames[j] = maxNames[j]
+
+    def merge(self, other):
+        """Merges the statistics of other, accumulated over other pairs."""
+        numSteps = len(other.numPairs)
+        self.resize(numSteps)
+        if other.firstOrder is not None and\
+           (self.firstOrder is None or other.firstOrder < self.firstOrder):
+            self.firstOrder = other.firstOrder
+            self.firstNumUsers = other.firstNumUsers
+        s = slice(0, numSteps)
+        na = self.numPairs[s].astype(np.float64)
+        nb = other.numPairs.astype(np.float64)
+        n = na + nb
+        n[n == 0] = 1
+        self.numPairs[s] += other.numPairs
+        delta = other.varMeans - self.varMeans[s]
+        self.varMeans[s] += delta*nb/n
+        self.varM2s[s] += other.varM2s + delta**2*na*nb/n
+        delta = other.errMeans - self.errMeans[s]
+        self.errMeans[s] += delta*nb/n
+        self.errM2s[s] += other.errM2s + delta**2*na*nb/n
+        self.userSums[s] += other.userSums
+        self.userSquareSums[s] += other.userSquareSums
+        self.lessSums[s] += other.lessSums
+        self.lessSquareSums[s] += other.lessSquareSums
+        self.updateMaxima(other.maxVars, other.maxOrders, other.maxNames)
+
+    def getStats(self):
+        """Returns per-step statistics over the steps that all pairs reach:
+           (avgVariance, varVariance, avgError, varError, avgUsers, varUsers,
+           avgLess, varLess, maxVariance, maxNames), as lists. Averages of
+           counts are rounded down and their variances are taken about the
+           rounded averages.
+        """
+        if not len(self.numPairs):
+            return [[]]*10
+        numSteps = np.count_nonzero(self.numPairs == self.numPairs[0])
+        s = slice(0, numSteps)
+        n = self.numPairs[s]
+        avgUsers = self.userSums[s]//n
+        varUsers = (self.userSquareSums[s] - 2*avgUsers*self.userSums[s] +
+                    n*avgUsers**2)//n
+        avgLess = self.lessSums[s]//n
+        varLess = (self.lessSquareSums[s] - 2*avgLess*self.lessSums[s] +
+                   n*avgLess**2)//n
+        maxVariance = [float(v) if v > 0 else 0 for v in self.maxVars[s]]
+        return (self.varMeans[s].tolist(), (self.varM2s[s]/n).tolist(),
+                self.errMeans[s].tolist(), (self.errM2s[s]/n).tolist(),
+                avgUsers.tolist(), varUsers.tolist(),
+                avgLess.tolist(), varLess.tolist(),
+                maxVariance, self.maxNames[:numSteps])
+
+def getOrder(sourceIdx, pairIdx):
+    """Orders pairs by source file, then by position in the file."""
+    return (sourceIdx << 32) + pairIdx
+
+def initWorker(workerIdx):
+    return ExptAccumulator()
+
+def finishWorker(accumulator):
+    return accumulator
+
+def processSource(inputDir, prefix, accumulator, task):
+    sourceIdx, source = task
+    for pairIdx, (filename, productId1, productId2, columns) in\
+        enumerate(resultStore.readSource(inputDir, source,
+                                         resultStore.experimentDtypes,
+                                         prefix=prefix)):
+        print >> sys.stderr, 'Processing %s . . .' % filename
+        if not len(columns[simIdx]):
+            continue
+        # Determine estimate of truth
+        truth = columns[simIdx][-1]
+        errors = columns[simIdx] - truth
+        accumulator.add(getOrder(sourceIdx, pairIdx), filename,
+                        columns[numUsersIdx].tolist(), errors**2, errors,
+                        columns[numUsersComIdx],
+                        np.minimum(columns[numUsers1Idx],
+                                   columns[numUsers2Idx]))
+
+def aggregate(inputDir, pattern, prefix, processSource, numWorkers=1,
+              initWorker=initWorker, finishWorker=finishWorker):
+    """Streams the results in inputDir through processSource in worker
+       processes and returns the merged ExptAccumulator.
+    """
+    sources = resultStore.listSources(inputDir, pattern=pattern,
+                                      prefix=prefix)
+    stats = executor.run(enumerate(sources),
+        functools.partial(processSource, inputDir, prefix),
+        numWorkers=numWorkers, initWorker=initWorker,
+        finishWorker=finishWorker, chunkSize=1)
+    accumulator = ExptAccumulator()
+    for s in stats:
+        accumulator.merge(s['result'])
+    return accumulator
 
 def main():
     # Parse options
@@ -65,103 +213,15 @@ def main():
         return
 
     # Compute variances and errors
-    numUsers = []
-    data = []
-    variances = []
-    errors = []
-    filenames = []
-    for filename in os.listdir(inputDir):
-        fullpath = os.path.join(inputDir, filename)
-        if not os.path.isfile(fullpath):
-            continue
-        if not fnmatch(filename, options.pattern):
-            continue
-        print >> sys.stderr, 'Processing %s . . .' % filename
-        filenames.append(filename)
-        # record NumUsers for first file only (useful later)
-        if not variances:
-            numUsers = getNumUsers(fullpath)
-        # record all data
-        data.append(getData(fullpath))
-        # Determine estimate of truth
-        lastRow = getLastRow(fullpath)
-        truth = float(lastRow[simIdx])
-        # Compute and save variances for this file
-        variances.append(getVariances(fullpath, truth))
-        # Compute and save errors for this file
-        errors.append(getErrors(fullpath, truth))
-
-    assert(len(variances) > 0)
+    accumulator = aggregate(inputDir, options.pattern, options.shards,
+                            processSource, numWorkers=options.numWorkers)
+    assert(accumulator.firstOrder is not None)
 
     # Aggregate results
-    avgVariance = []
-    avgError = []
-    avgCommonUsers = []
-    avgLess = []
-    maxVariance = []
-    maxFilenames = []
-    varVariance = []
-    varError = []
-    varCommonUsers = []
-    varLess = []
-    finished = False
-    j = 0
-    while True:
-        # Compute averages
-        totalVar = 0
-        totalErr = 0
-        totalCommonUsers = 0
-        totalLess = 0
-        maxVar = 0
-        maxFilename = None
-        for i in range(len(variances)):
-            if j < len(variances[i]):
-                if variances[i][j] > maxVar:
-                    maxVar = variances[i][j]
-                    maxFilename = filenames[i]
-                totalVar += variances[i][j]
-                totalErr += errors[i][j]
-                totalCommonUsers += int(data[i][j][numUsersComIdx])
-                if data[i][j][numUsers1Idx] < data[i][j][numUsers2Idx]:
-                    totalLess += int(data[i][j][numUsers1Idx])
-                else:
-                    totalLess += int(data[i][j][numUsers2Idx])
-            else:
-                finished = True
-                break
-        if finished:
-            break
-        maxVariance.append(maxVar)
-        maxFilenames.append(maxFilename)
-        avgVariance.append(totalVar/len(variances))
-        avgError.append(totalErr/len(errors))
-        avgCommonUsers.append(totalCommonUsers/len(data))
-        avgLess.append(totalLess/len(data))
-        # Compute variance of variance
-        totalVar = 0
-        for i in range(len(variances)):
-            totalVar += (variances[i][j] - avgVariance[-1])**2
-        varVariance.append(totalVar/len(variances))
-        # Compute variance of error
-        totalErr = 0
-        for i in range(len(errors)):
-            totalErr += (errors[i][j] - avgError[-1])**2
-        varError.append(totalErr/len(errors))
-        # Compute variance of common users
-        totalCommonUsers = 0
-        for i in range(len(data)):
-            totalCommonUsers +=\
-                (int(data[i][j][numUsersComIdx]) - avgCommonUsers[-1])**2
-        varCommonUsers.append(totalCommonUsers/len(data))
-        # Compute variance of less reviews
-        totalLess = 0
-        for i in range(len(data)):
-            if data[i][j][numUsers1Idx] < data[i][j][numUsers2Idx]:
-                totalLess += (int(data[i][j][numUsers1Idx]) - avgLess[-1])**2
-            else:
-                totalLess += (int(data[i][j][numUsers2Idx]) - avgLess[-1])**2
-        varLess.append(totalLess/len(data))
-        j += 1
+    numUsers = accumulator.firstNumUsers
+    (avgVariance, varVariance, avgError, varError,
+     avgCommonUsers, varCommonUsers, avgLess, varLess,
+     maxVariance, maxFilenames) = accumulator.getStats()
 
     # Write results:
     writer = csv.writer(sys.stdout, quotechar='"', quoting=csv.QUOTE_NONNUMERIC)
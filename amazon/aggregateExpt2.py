@@ -6,12 +6,16 @@ Aggregates results of experiment 2 into a single data file.
 
 from optparse import OptionParser
 import sqlite3
+import functools
+import numpy as np
 import csv
 import os
 import sys
-from fnmatch import fnmatch
 
 import similarity
+import reviewStore
+import resultStore
+import aggregateExpt1 as aggexpt1
 
 # params
 outputFileTemplate = '%s.csv'
@@ -23,11 +27,6 @@ simIdx = 4
 
 # db params
 dbTimeout = 5
-selectReviewsStmt =\
-    ('SELECT Time, UserId, AdjustedScore '
-     'FROM Reviews '
-     'WHERE ProductId = :ProductId '
-     'ORDER BY UserId')
 
 def getParser(usage=None):
     parser = OptionParser(usage=usage)
@@ -39,35 +38,44 @@ def getParser(usage=None):
              '"prefSim" or "randSim" (default)'), metavar='FUNCNAME')
     parser.add_option('-p', '--pattern', dest='pattern', default='*.csv',
         help='Input file pattern.', metavar='PATTERN')
+    parser.add_option('--shards', dest='shards', default=None,
+        help='Read results from the npz shards with this prefix.',
+        metavar='PREFIX')
+    parser.add_option('--reviewStore', dest='storeDir', default=None,
+        help='Review store directory built by reviewStore.py.', metavar='DIR')
+    parser.add_option('-w', '--numWorkers', dest='numWorkers', type='int',
+        default=1, help='Number of worker processes.', metavar='NUM')
     return parser
 
-def getNumCommonUsers(csvFileName):
-    f = open(csvFileName, 'rb')
-    reader = csv.reader(f)
-    return [int(row[numUsersComIdx]) for row in reader]
-
-def getData(csvFileName):
-    f = open(csvFileName, 'rb')
-    reader = csv.reader(f)
-    return [row for row in reader]
-
-def getLastRow(csvFileName):
-    with open(csvFileName, 'rb') as f:
-        reader = csv.reader(f)
-        lastRow = reader.next()
-        for row in reader:
-            lastRow = row
-        return lastRow
-
-def getVariances(csvFileName, truth):
-    f = open(csvFileName, 'rb')
-    reader = csv.reader(f)
-    return [(float(row[simIdx]) - truth)**2 for row in reader]
-
-def getErrors(csvFileName, truth):
-    f = open(csvFileName, 'rb')
-    reader = csv.reader(f)
-    return [float(row[simIdx]) - truth for row in reader]
+def initWorker(db_fname, workerIdx):
+    # connect to db
+    db_conn = sqlite3.connect(db_fname, dbTimeout)
+    return (aggexpt1.ExptAccumulator(), db_conn.cursor())
+
+def finishWorker(state):
+    accumulator, db_curs = state
+    return accumulator
+
+def processSource(store, cosineFunc, inputDir, prefix, state, task):
+    accumulator, db_curs = state
+    sourceIdx, source = task
+    for pairIdx, (filename, productId1, productId2, columns) in\
+        enumerate(resultStore.readSource(inputDir, source,
+                                         resultStore.experimentDtypes,
+                                         prefix=prefix)):
+        print >> sys.stderr, 'Processing %s . . .' % filename
+        if not len(columns[simIdx]):
+            continue
+        # fetch product reviews
+        reviews1 = reviewStore.fetchReviews(db_curs, productId1, store)
+        reviews2 = reviewStore.fetchReviews(db_curs, productId2, store)
+        #Deterine best estimate of truth ("gold standard")
+        truth, numUserCommon = cosineFunc(reviews1, reviews2)
+        errors = columns[simIdx] - truth
+        accumulator.add(aggexpt1.getOrder(sourceIdx, pairIdx), filename,
+                        None, errors**2, errors, columns[numUsersIdx],
+                        np.minimum(columns[numUsers1Idx],
+                                   columns[numUsers2Idx]))
 
 def main():
     # Parse options
@@ -87,114 +95,21 @@ def main():
             'Invalid Similarity function: %s' % options.cosineFunc
         return
 
-    # connect to db
-    db_conn = sqlite3.connect(options.db_fname, dbTimeout)
-    db_curs = db_conn.cursor()
+    # open review store before forking workers
+    store = reviewStore.openStore(options.storeDir)
 
     # Compute variances and errors
-    data = []
-    variances = []
-    errors = []
-    filenames = []
-    for filename in os.listdir(inputDir):
-        fullpath = os.path.join(inputDir, filename)
-        if not os.path.isfile(fullpath):
-            continue
-        if not fnmatch(filename, options.pattern):
-            continue
-        print >> sys.stderr, 'Processing %s . . .' % filename
-        filenames.append(filename)
-        # record all data
-        filedata = getData(fullpath)
-        if not filedata:
-            continue
-        data.append(filedata)
-        # parse productIds from filename
-        productId1 = filename.split('_')[1]
-        productId2 = filename.split('_')[2].split('.')[0]
-        # fetch product reviews
-        db_curs.execute(selectReviewsStmt, (productId1,))
-        reviews1 = [row for row in db_curs.fetchall()]
-        db_curs.execute(selectReviewsStmt, (productId2,))
-        reviews2 = [row for row in db_curs.fetchall()]
-        #Deterine best estimate of truth ("gold standard")
-        truth, numUserCommon = cosineFunc(reviews1, reviews2)
-        # Compute and save variances for this file
-        variances.append(getVariances(fullpath, truth))
-        # Compute and save errors for this file
-        errors.append(getErrors(fullpath, truth))
-
-    assert(len(variances) > 0)
+    accumulator = aggexpt1.aggregate(inputDir, options.pattern,
+        options.shards, functools.partial(processSource, store, cosineFunc),
+        numWorkers=options.numWorkers,
+        initWorker=functools.partial(initWorker, options.db_fname),
+        finishWorker=finishWorker)
+    assert(accumulator.firstOrder is not None)
 
     # Aggregate results
-    avgVariance = []
-    avgError = []
-    avgNumUsers = []
-    avgLess = []
-    maxVariance = []
-    maxFilenames = []
-    varVariance = []
-    varError = []
-    varNumUsers = []
-    varLess = []
-    finished = False
-    j = 0
-    while True:
-        # Compute averages
-        totalVar = 0
-        totalErr = 0
-        totalNumUsers = 0
-        totalLess = 0
-        maxVar = 0
-        maxFilename = None
-        for i in range(len(variances)):
-            if j < len(variances[i]):
-                if variances[i][j] > maxVar:
-                    maxVar = variances[i][j]
-                    maxFilename = filenames[i]
-                totalVar += variances[i][j]
-                totalErr += errors[i][j]
-                totalNumUsers += int(data[i][j][numUsersIdx])
-                if data[i][j][numUsers1Idx] < data[i][j][numUsers2Idx]:
-                    totalLess += int(data[i][j][numUsers1Idx])
-                else:
-                    totalLess += int(data[i][j][numUsers2Idx])
-            else:
-                finished = True
-                break
-        if finished:
-            break
-        maxVariance.append(maxVar)
-        maxFilenames.append(maxFilename)
-        avgVariance.append(totalVar/len(variances))
-        avgError.append(totalErr/len(errors))
-        avgNumUsers.append(totalNumUsers/len(data))
-        avgLess.append(totalLess/len(data))
-        # Compute variance of variance
-        totalVar = 0
-        for i in range(len(variances)):
-            totalVar += (variances[i][j] - avgVariance[-1])**2
-        varVariance.append(totalVar/len(variances))
-        # Compute variance of error
-        totalErr = 0
-        for i in range(len(errors)):
-            totalErr += (errors[i][j] - avgError[-1])**2
-        varError.append(totalErr/len(errors))
-        # Compute variance of num users
-        totalNumUsers = 0
-        for i in range(len(data)):
-            totalNumUsers +=\
-                (int(data[i][j][numUsersIdx]) - avgNumUsers[-1])**2
-        varNumUsers.append(totalNumUsers/len(data))
-        # Compute variance of less reviews
-        totalLess = 0
-        for i in range(len(data)):
-            if data[i][j][numUsers1Idx] < data[i][j][numUsers2Idx]:
-                totalLess += (int(data[i][j][numUsers1Idx]) - avgLess[-1])**2
-            else:
-                totalLess += (int(data[i][j][numUsers2Idx]) - avgLess[-1])**2
-        varLess.append(totalLess/len(data))
-        j += 1
+    (avgVariance, varVariance, avgError, varError,
+     avgNumUsers, varNumUsers, avgLess, varLess,
+     maxVariance, maxFilenames) = accumulator.getStats()
 
     # Write results:
     writer = csv.writer(sys.stdout, quotechar='"', quoting=csv.QUOTE_NONNUMERIC)
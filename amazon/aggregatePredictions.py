@@ -2,14 +2,24 @@
 
 """
 Aggregates results of predictions.py into a single data file.
+
+Per-user error statistics are accumulated in one pass as sums (count, sum,
+sum of squares and sum of absolute values) in numpy arrays indexed by
+interned user codes, so memory grows with the number of users rather than
+the number of predictions. Input files are split between worker processes,
+whose partial sums are merged.
 """
 
 from optparse import OptionParser
+import functools
+import numpy as np
 import csv
 import os
 import sys
 import math
-from fnmatch import fnmatch
+
+import resultStore
+import executor
 
 # params
 userIdIdx = 0
@@ -22,8 +32,77 @@ def getParser(usage=None):
     parser = OptionParser(usage=usage)
     parser.add_option('-p', '--pattern', dest='pattern', default='*.csv',
         help='Input file pattern.', metavar='PATTERN')
+    parser.add_option('--shards', dest='shards', default=None,
+        help='Read results from the npz shards with this prefix.',
+        metavar='PREFIX')
+    parser.add_option('-w', '--numWorkers', dest='numWorkers', type='int',
+        default=1, help='Number of worker processes.', metavar='NUM')
     return parser
 
+class ErrorAccumulator(object):
+    """Sums of the prediction errors of each user. Users are interned in the
+       order they are first seen, and accumulators over disjoint predictions
+       can be merged.
+    """
+    def __init__(self):
+        self.userCodes = {}
+        self.userIds = []
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.sums = np.zeros(0)
+        self.squareSums = np.zeros(0)
+        self.absSums = np.zeros(0)
+
+    def getCodes(self, userIds):
+        """Returns the codes of userIds, interning new users."""
+        uniqueUserIds, inverse = np.unique(userIds, return_inverse=True)
+        codes = np.zeros(len(uniqueUserIds), dtype=np.int64)
+        for i, userId in enumerate(uniqueUserIds.tolist()):
+            if userId not in self.userCodes:
+                self.userCodes[userId] = len(self.userIds)
+                self.userIds.append(userId)
+            codes[i] = self.userCodes[userId]
+        extra = len(self.userIds) - len(self.counts)
+        if extra > 0:
+            for attr in ('counts', 'sums', 'squareSums', 'absSums'):
+                array = getattr(self, attr)
+                setattr(self, attr,
+                        np.append(array, np.zeros(extra, dtype=array.dtype)))
+        return codes[inverse]
+
+    def add(self, userIds, errors):
+        if not len(userIds):
+            return
+        codes = self.getCodes(userIds)
+        n = len(self.counts)
+        self.counts += np.bincount(codes, minlength=n)
+        self.sums += np.bincount(codes, weights=errors, minlength=n)
+        self.squareSums += np.bincount(codes, weights=errors**2, minlength=n)
+        self.absSums += np.bincount(codes, weights=np.abs(errors),
+                                    minlength=n)
+
+    def merge(self, other):
+        """Merges the sums of other, accumulated over other predictions."""
+        if not other.userIds:
+            return
+        codes = self.getCodes(np.array(other.userIds))
+        self.counts[codes] += other.counts
+        self.sums[codes] += other.sums
+        self.squareSums[codes] += other.squareSums
+        self.absSums[codes] += other.absSums
+
+def initWorker(workerIdx):
+    return ErrorAccumulator()
+
+def finishWorker(accumulator):
+    return accumulator
+
+def processSource(inputDir, prefix, accumulator, source):
+    for filename, productId1, productId2, columns in\
+        resultStore.readSource(inputDir, source,
+                               resultStore.predictionsDtypes, prefix=prefix):
+        print >> sys.stderr, 'Processing %s . . .' % filename
+        accumulator.add(columns[userIdIdx], columns[errorIdx])
+
 def main():
     # Parse options
     usage = 'Usage: %prog [options] <inputDir>'
@@ -37,57 +116,37 @@ def main():
         return
 
     # compile user predictions
-    userErrors = {}
-    for filename in os.listdir(inputDir):
-        fullpath = os.path.join(inputDir, filename)
-        if not os.path.isfile(fullpath):
-            continue
-        if not fnmatch(filename, options.pattern):
-            continue
-        print >> sys.stderr, 'Processing %s . . .' % filename
-        with open(fullpath, 'rb') as csvfile:
-            reader = csv.reader(csvfile)
-            for row in reader:
-                userId = row[userIdIdx]
-                #rating1 = float(row[rating1Idx])
-                #rating2 = float(row[rating2Idx])
-                #prediction = float(row[predictionIdx])
-                error = float(row[errorIdx])
-                if userId in userErrors:
-                    userErrors[userId].append(error)
-                else:
-                    userErrors[userId] = [error]
+    sources = resultStore.listSources(inputDir, pattern=options.pattern,
+                                      prefix=options.shards)
+    stats = executor.run(sources,
+        functools.partial(processSource, inputDir, options.shards),
+        numWorkers=options.numWorkers, initWorker=initWorker,
+        finishWorker=finishWorker, chunkSize=1)
+    accumulator = ErrorAccumulator()
+    for s in stats:
+        accumulator.merge(s['result'])
 
     # compute average error and square error
-    # and write output
-    grandTotalCount = 0
-    grandTotalAbsError = 0
-    grandTotalSquareError = 0
+    # and write output, sorted by user so that it does not depend on the
+    # order in which workers saw the users
     writer = csv.writer(sys.stdout)
-    for userId in userErrors:
-        total = 0
-        squareTotal = 0
-        absTotal = 0
-        count = len(userErrors[userId])
-        for error in userErrors[userId]:
-            total += error
-            squareTotal += error**2
-            absTotal += abs(error)
-            grandTotalCount += 1
-            grandTotalAbsError += abs(error)
-            grandTotalSquareError += error**2
-        average = total/count
+    for userId in sorted(accumulator.userIds):
+        code = accumulator.userCodes[userId]
+        count = int(accumulator.counts[code])
+        average = float(accumulator.sums[code])/count
         if count > 1:
-            variance = squareTotal/(count - 1)
+            variance = float(accumulator.squareSums[code])/(count - 1)
             uncertainty = math.sqrt(variance/count)
         else:
             variance = float('inf')
             uncertainty = float('inf')
-        absAverage = absTotal/count
+        absAverage = float(accumulator.absSums[code])/count
         writer.writerow([userId, count, average, variance, absAverage,
                          uncertainty])
-    grandAverageAbsError = grandTotalAbsError/grandTotalCount
-    grandErrorVariance = grandTotalSquareError/(grandTotalCount - 1)
+    grandTotalCount = int(accumulator.counts.sum())
+    grandAverageAbsError = float(accumulator.absSums.sum())/grandTotalCount
+    grandErrorVariance =\
+        float(accumulator.squareSums.sum())/(grandTotalCount - 1)
     print >> sys.stderr,\
         'grandAverageAbsError = %0.3f, grandErrorVariance = %0.3f' %\
         (grandAverageAbsError, grandErrorVariance)
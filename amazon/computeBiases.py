@@ -3,87 +3,226 @@
 """
 Computes the biases associated with the dataset, each user, and each item and
 stores them in the database.
+
+The global bias is the average score, a user's bias is the average of the
+user's scores less the global bias, a review's AdjustedScore is its score less
+the user and global biases, and a product's bias is the average AdjustedScore
+of its reviews. All three are computed from one scan of Reviews and written
+back in bulk.
+
+In incremental mode (after ingesting new reviews, whose AdjustedScore is NULL)
+only the users with new reviews are re-biased, along with their AdjustedScores
+and the biases of the products they reviewed. The biases of other users are
+shifted by the change in global bias, which leaves their AdjustedScores
+unchanged.
 """
 
 from optparse import OptionParser
 import sqlite3
+import numpy as np
+
+# params
+fetchSize = 100000
 
 # db params
 createGlobalsTableStmt =\
     'CREATE TABLE IF NOT EXISTS Globals(Key TEXT PRIMARY KEY, Value TEXT)'
 deleteGlobalStmt = 'DELETE FROM Globals WHERE Key = :Key'
 insertGlobalStmt = 'INSERT INTO Globals (Key, Value) VALUES (:Key, :Value)'
+selectGlobalStmt = 'SELECT Value FROM Globals WHERE Key = :Key'
 selectAvgScoreStmt = 'SELECT avg(Score) FROM Reviews'
+selectReviewsColumnsStmt = 'PRAGMA table_info(Reviews)'
+addAdjustedScoreStmt = 'ALTER TABLE Reviews ADD COLUMN AdjustedScore REAL'
+selectTablesStmt =\
+    "SELECT name FROM sqlite_master WHERE type = 'table' AND name = :Name"
+selectScoresStmt = 'SELECT UserId, ProductId, Score FROM Reviews'
 dropUserBiasesTableStmt = 'DROP TABLE IF EXISTS UserBiases'
 createUserBiasesTableStmt =\
     ('CREATE TABLE UserBiases (UserId TEXT PRIMARY KEY, Bias Real, FOREIGN '
      'KEY(UserId) REFERENCES Users(UserId))')
-insertUserBiasesStmt =\
-    ('INSERT INTO UserBiases (UserId, Bias) '
-     'SELECT UserId, Avg(Score) - :GlobalBias '
-     'FROM Users NATURAL JOIN Reviews '
-     'GROUP BY UserId')
-updateReviewsStmt =\
-    ('UPDATE Reviews '
-     'SET AdjustedScore = Score - '
-     '(SELECT Bias FROM UserBiases WHERE UserId = Reviews.UserId) - '
-     ':GlobalBias')
+insertUserBiasStmt =\
+    'INSERT OR REPLACE INTO UserBiases (UserId, Bias) VALUES (:UserId, :Bias)'
+shiftUserBiasesStmt = 'UPDATE UserBiases SET Bias = Bias + :Shift'
+updateReviewStmt =\
+    ('UPDATE Reviews SET AdjustedScore = :AdjustedScore '
+     'WHERE ProductId = :ProductId AND UserId = :UserId')
 dropProductBiasesTableStmt = 'DROP TABLE IF EXISTS ProductBiases'
 createProductBiasesTableStmt =\
     ('CREATE TABLE ProductBiases (ProductId TEXT PRIMARY KEY, Bias Real, '
      'FOREIGN KEY (ProductId) REFERENCES Products(ProductId))')
-insertProductBiasesStmt =\
-    ('INSERT INTO ProductBiases (ProductId, Bias) '
-     'SELECT ProductId, Avg(AdjustedScore) '
-     'FROM Reviews '
-     'GROUP BY ProductId')
+insertProductBiasStmt =\
+    ('INSERT OR REPLACE INTO ProductBiases (ProductId, Bias) '
+     'VALUES (:ProductId, :Bias)')
+createUserIndexStmt =\
+    'CREATE INDEX IF NOT EXISTS Reviews_UserId_Idx ON Reviews(UserId)'
+createTouchedUsersTableStmt =\
+    ('CREATE TEMP TABLE TouchedUsers AS '
+     'SELECT DISTINCT UserId FROM Reviews WHERE AdjustedScore IS NULL')
+selectTouchedScoresStmt =\
+    ('SELECT R.UserId, R.ProductId, R.Score '
+     'FROM TouchedUsers AS T, Reviews AS R '
+     'WHERE R.UserId = T.UserId')
+createTouchedProductsTableStmt =\
+    ('CREATE TEMP TABLE TouchedProducts AS '
+     'SELECT DISTINCT R.ProductId '
+     'FROM TouchedUsers AS T, Reviews AS R '
+     'WHERE R.UserId = T.UserId')
+updateTouchedProductBiasesStmt =\
+    ('INSERT OR REPLACE INTO ProductBiases (ProductId, Bias) '
+     'SELECT R.ProductId, Avg(R.AdjustedScore) '
+     'FROM TouchedProducts AS T, Reviews AS R '
+     'WHERE R.ProductId = T.ProductId '
+     'GROUP BY R.ProductId')
 
 def getParser(usage=None):
     parser = OptionParser(usage=usage)
     parser.add_option('-d', '--database', dest='db_fname',
                       default='data/amazon.db', help='sqlite3 database file.',
                       metavar='FILE')
+    parser.add_option('-i', '--incremental', action='store_true',
+        dest='incremental', default=False,
+        help=('Only re-bias users with new reviews (AdjustedScore NULL) and '
+              'the products they reviewed.'))
     return parser
 
-def main():
-    # Parse options
-    usage = 'Usage: %prog [options]'
-    parser = getParser(usage=usage)
-    (options, args) = parser.parse_args()
+def fetchScores(db_curs, stmt):
+    """Returns (userIds, productIds, scores) arrays of the rows of stmt."""
+    userIds = []
+    productIds = []
+    scores = []
+    db_curs.execute(stmt)
+    while True:
+        rows = db_curs.fetchmany(fetchSize)
+        if not rows:
+            break
+        for row in rows:
+            userIds.append(row[0])
+            productIds.append(row[1])
+            scores.append(row[2])
+    return (np.array(userIds, dtype=object), np.array(productIds, dtype=object),
+            np.array(scores, dtype=np.float64))
 
-    # connect to db
-    print 'Connecting to %s. . .' % options.db_fname
-    db_conn = sqlite3.connect(options.db_fname)
-    db_curs = db_conn.cursor()
-    # create Globals table if not already exists
-    db_curs.execute(createGlobalsTableStmt)
-    # delete any peexisting Bias from Globals table 
+def computeUserBiases(userIds, scores, globalBias):
+    """Returns (uniqueUserIds, userBiases, adjustedScores)."""
+    uniqueUserIds, userCodes = np.unique(userIds, return_inverse=True)
+    counts = np.bincount(userCodes)
+    userBiases = np.bincount(userCodes, weights=scores)/counts - globalBias
+    adjustedScores = scores - userBiases[userCodes] - globalBias
+    return (uniqueUserIds, userBiases, adjustedScores)
+
+def computeProductBiases(productIds, adjustedScores):
+    """Returns (uniqueProductIds, productBiases)."""
+    uniqueProductIds, productCodes = np.unique(productIds,
+                                               return_inverse=True)
+    counts = np.bincount(productCodes)
+    productBiases = np.bincount(productCodes, weights=adjustedScores)/counts
+    return (uniqueProductIds, productBiases)
+
+def setGlobalBias(db_curs, globalBias):
+    # delete any peexisting Bias from Globals table
     db_curs.execute(deleteGlobalStmt, ('Bias',))
+    # insert global bias into db
+    db_curs.execute(insertGlobalStmt, ('Bias', repr(globalBias)))
+
+def updateAdjustedScores(db_curs, userIds, productIds, adjustedScores):
+    db_curs.executemany(updateReviewStmt,
+        zip(adjustedScores.tolist(), productIds.tolist(), userIds.tolist()))
+
+def ensureAdjustedScore(db_curs):
+    db_curs.execute(selectReviewsColumnsStmt)
+    if 'AdjustedScore' not in [row[1] for row in db_curs.fetchall()]:
+        db_curs.execute(addAdjustedScoreStmt)
+
+def tableExists(db_curs, name):
+    db_curs.execute(selectTablesStmt, (name,))
+    return db_curs.fetchone() is not None
+
+def computeAll(db_conn):
+    db_curs = db_conn.cursor()
+    # scan reviews
+    print 'Reading Reviews. . .'
+    userIds, productIds, scores = fetchScores(db_curs, selectScoresStmt)
     # compute global bias
     print 'Computing Global Bias. . .'
-    db_curs.execute(selectAvgScoreStmt)
-    globalBias = float(db_curs.fetchone()[0])
+    globalBias = float(scores.mean())
     print 'Global Bias = %.2f' % globalBias
-    # insert global bias into db
-    db_curs.execute(insertGlobalStmt, ('Bias', str(globalBias)))
-    # drop UserBiases table if exists
-    db_curs.execute(dropUserBiasesTableStmt)
-    # create UserBiases table
-    db_curs.execute(createUserBiasesTableStmt)
+    setGlobalBias(db_curs, globalBias)
     # compute and insert UserBiases
     print 'Computing User Biases. . .'
-    db_curs.execute(insertUserBiasesStmt, (globalBias,))
+    uniqueUserIds, userBiases, adjustedScores =\
+        computeUserBiases(userIds, scores, globalBias)
+    db_curs.execute(dropUserBiasesTableStmt)
+    db_curs.execute(createUserBiasesTableStmt)
+    db_curs.executemany(insertUserBiasStmt,
+                        zip(uniqueUserIds.tolist(), userBiases.tolist()))
     # update Review AdjustedScores
     print 'Updating Review AdjustedScores. . .'
-    db_curs.execute(updateReviewsStmt, (globalBias,))
-    # drop ProductBiases table if exists
+    updateAdjustedScores(db_curs, userIds, productIds, adjustedScores)
+    # compute and insert ProductBiases
+    print 'Computing Product Biases. . .'
+    uniqueProductIds, productBiases =\
+        computeProductBiases(productIds, adjustedScores)
     db_curs.execute(dropProductBiasesTableStmt)
-    # create ProductBiases table
     db_curs.execute(createProductBiasesTableStmt)
-    # compute and insert ProductBiases
+    db_curs.executemany(insertProductBiasStmt,
+                        zip(uniqueProductIds.tolist(), productBiases.tolist()))
+    db_conn.commit()
+
+def computeIncremental(db_conn):
+    db_curs = db_conn.cursor()
+    db_curs.execute(selectGlobalStmt, ('Bias',))
+    row = db_curs.fetchone()
+    if row is None or not tableExists(db_curs, 'UserBiases') or\
+       not tableExists(db_curs, 'ProductBiases'):
+        print 'No previous biases found.'
+        computeAll(db_conn)
+        return
+    oldGlobalBias = float(row[0])
+    # find users with new reviews
+    db_curs.execute(createUserIndexStmt)
+    db_curs.execute(createTouchedUsersTableStmt)
+    userIds, productIds, scores = fetchScores(db_curs, selectTouchedScoresStmt)
+    print 'Found %d users with new reviews.' % len(np.unique(userIds))
+    # compute global bias
+    print 'Computing Global Bias. . .'
+    db_curs.execute(selectAvgScoreStmt)
+    globalBias = float(db_curs.fetchone()[0])
+    print 'Global Bias = %.2f' % globalBias
+    setGlobalBias(db_curs, globalBias)
+    # shift all user biases, then recompute those of users with new reviews
+    print 'Computing User Biases. . .'
+    db_curs.execute(shiftUserBiasesStmt, (oldGlobalBias - globalBias,))
+    uniqueUserIds, userBiases, adjustedScores =\
+        computeUserBiases(userIds, scores, globalBias)
+    db_curs.executemany(insertUserBiasStmt,
+                        zip(uniqueUserIds.tolist(), userBiases.tolist()))
+    # update Review AdjustedScores of users with new reviews
+    print 'Updating Review AdjustedScores. . .'
+    updateAdjustedScores(db_curs, userIds, productIds, adjustedScores)
+    # recompute ProductBiases of products reviewed by those users
     print 'Computing Product Biases. . .'
-    db_curs.execute(insertProductBiasesStmt)
+    db_curs.execute(createTouchedProductsTableStmt)
+    db_curs.execute(updateTouchedProductBiasesStmt)
+    db_conn.commit()
+
+def main():
+    # Parse options
+    usage = 'Usage: %prog [options]'
+    parser = getParser(usage=usage)
+    (options, args) = parser.parse_args()
+
+    # connect to db
+    print 'Connecting to %s. . .' % options.db_fname
+    db_conn = sqlite3.connect(options.db_fname)
+    db_curs = db_conn.cursor()
+    # create Globals table if not already exists
+    db_curs.execute(createGlobalsTableStmt)
+    # add AdjustedScore column if not already exists
+    ensureAdjustedScore(db_curs)
+    if options.incremental:
+        computeIncremental(db_conn)
+    else:
+        computeAll(db_conn)
 
 if __name__ == '__main__':
     main()
-
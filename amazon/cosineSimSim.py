@@ -0,0 +1,152 @@
+#!/usr/local/bin/python
+
+"""
+Simulates the cosine similarity of two products whose ratings along each of
+many dimensions are drawn from a bivariate Gaussian prior centered on a pair
+of observed ratings.
+
+All dimensions of a batch of rating pairs are drawn as one block of standard
+normals and transformed by a square root of each pair's covariance matrix.
+"""
+
+from optparse import OptionParser
+import numpy as np
+
+# params
+maxBlockSize = 2**22 # standard normals drawn at once
+
+def getParser(usage=None):
+    parser = OptionParser(usage=usage)
+    parser.add_option('-r', '--randomSeed', type='int', dest='randomSeed',
+        default=0, help='Seed for random module.', metavar='NUM')
+    parser.add_option('-d', '--dimensions', type='int', dest='dimensions',
+        default=10000, help='Number of dimensions.', metavar='NUM')
+    parser.add_option('--sigmaXX', type='float', dest='sigmaXX', default=1.0,
+       help=('Diagonal component of covariance matrix for multivariate '
+             'Gaussian distribution prior for ratings.'), metavar='FLOAT')
+    parser.add_option('--rho', type='float', dest='rho', default=0.1,
+       help=('Scalar constant for off-diagonal component of covariance matrix '
+             'for multivariate Gaussian distribution prior for ratings.'),
+             metavar='FLOAT')
+    return parser
+
+def cosineSimSim(dimensions, sigmaXX, rho, rating1, rating2,
+                 randomState=np.random):
+    return cosineSimSims(dimensions, sigmaXX, rho, np.array([rating1]),
+                         np.array([rating2]), randomState=randomState)[0]
+
+def cosineSimSims(dimensions, sigmaXX, rho, ratings1, ratings2,
+                  randomState=np.random):
+    """Returns simulated cosine similarities for arrays of rating pairs.
+       The covariance [[sigmaXX, c], [c, sigmaXX]], c = rho*rating1*rating2,
+       has eigenvectors (1, 1) and (1, -1) with eigenvalues sigmaXX +/- c, so
+       its square root is closed-form. Like np.random.multivariate_normal, the
+       absolute eigenvalues are used where c exceeds sigmaXX.
+    """
+    ratings1 = np.asarray(ratings1, dtype=np.float64)
+    ratings2 = np.asarray(ratings2, dtype=np.float64)
+    sims = np.zeros(len(ratings1))
+    batchSize = max(1, maxBlockSize/(2*dimensions))
+    for begin in range(0, len(ratings1), batchSize):
+        end = min(begin + batchSize, len(ratings1))
+        z = randomState.standard_normal((end - begin, dimensions, 2))
+        sims[begin:end] = transformSims(sigmaXX, rho, ratings1[begin:end],
+                                        ratings2[begin:end], z)
+    return sims
+
+def transformSims(sigmaXX, rho, ratings1, ratings2, z):
+    """Returns cosine similarities of rating pairs simulated from a block z of
+       standard normals of shape (len(ratings1), dimensions, 2).
+    """
+    cov = rho*ratings1*ratings2
+    scale1 = np.sqrt(np.abs(sigmaXX + cov)/2)[:, np.newaxis]
+    scale2 = np.sqrt(np.abs(sigmaXX - cov)/2)[:, np.newaxis]
+    u = scale1*z[:, :, 0]
+    v = scale2*z[:, :, 1]
+    elements1 = ratings1[:, np.newaxis] + u + v
+    elements2 = ratings2[:, np.newaxis] + u - v
+    innerProd = (elements1*elements2).sum(axis=1)
+    var1 = (elements1**2).sum(axis=1)
+    var2 = (elements2**2).sum(axis=1)
+    return innerProd/(np.sqrt(var1)*np.sqrt(var2))
+
+class CosineSimSampler(object):
+    """Batched cosineSimSims with a cache of results keyed by rating pairs
+       quantized to multiples of quantum. Rating pairs are simulated at their
+       quantized values from a random state seeded by randomSeed and the key,
+       so a result depends neither on which rating pair first filled the
+       cache nor on which process computed it. quantum 0 disables
+       quantization and caching, and keys rating pairs by their exact values.
+    """
+    def __init__(self, dimensions, sigmaXX, rho, randomSeed=0, quantum=0.01):
+        self.dimensions = dimensions
+        self.sigmaXX = sigmaXX
+        self.rho = rho
+        self.quantum = quantum
+        self.randomSeed = randomSeed
+        self.cache = {}
+
+    def getKeys(self, ratings1, ratings2):
+        if self.quantum:
+            keys1 = np.round(ratings1/self.quantum).astype(np.int64)
+            keys2 = np.round(ratings2/self.quantum).astype(np.int64)
+        else:
+            keys1 = ratings1.view(np.int64)
+            keys2 = ratings2.view(np.int64)
+        return zip(keys1.tolist(), keys2.tolist())
+
+    def simulate(self, keys, ratings1, ratings2):
+        sims = np.zeros(len(keys))
+        batchSize = max(1, maxBlockSize/(2*self.dimensions))
+        for begin in range(0, len(keys), batchSize):
+            end = min(begin + batchSize, len(keys))
+            z = np.empty((end - begin, self.dimensions, 2))
+            for i in range(begin, end):
+                seed = [self.randomSeed & 0xffffffff]
+                for key in keys[i]:
+                    seed += [key & 0xffffffff, (key >> 32) & 0xffffffff]
+                randomState = np.random.RandomState(seed)
+                z[i - begin] = randomState.standard_normal((self.dimensions,
+                                                            2))
+            sims[begin:end] = transformSims(self.sigmaXX, self.rho,
+                                            ratings1[begin:end],
+                                            ratings2[begin:end], z)
+        return sims
+
+    def sample(self, ratings1, ratings2):
+        ratings1 = np.asarray(ratings1, dtype=np.float64)
+        ratings2 = np.asarray(ratings2, dtype=np.float64)
+        keys = self.getKeys(ratings1, ratings2)
+        if not self.quantum:
+            return self.simulate(keys, ratings1, ratings2)
+        # simulate each missing key once
+        missing = sorted(set(key for key in keys if key not in self.cache))
+        if missing:
+            missing1 = np.array([key[0] for key in missing])*self.quantum
+            missing2 = np.array([key[1] for key in missing])*self.quantum
+            sims = self.simulate(missing, missing1, missing2)
+            self.cache.update(zip(missing, sims.tolist()))
+        return np.array([self.cache[key] for key in keys])
+
+def main():
+    # Parse options
+    usage = 'Usage: %prog [options] rating1 rating2'
+    parser = getParser(usage=usage)
+    (options, args) = parser.parse_args()
+    if len(args) != 2:
+        parser.error('Wrong number of arguments')
+    rating1 = float(args[0])
+    rating2 = float(args[1])
+
+    # Seed random state
+    randomState = np.random.RandomState(options.randomSeed)
+
+    # Run simulation
+    simsim = cosineSimSim(options.dimensions, options.sigmaXX, options.rho,
+                          rating1, rating2, randomState=randomState)
+
+    # Output
+    print simsim
+
+if __name__ == '__main__':
+    main()
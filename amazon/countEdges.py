@@ -3,57 +3,91 @@
 """
 Counts the edges with non-zero weight in an otherwise complete
 weighted product graph constructed via user-item collaborative filtering.
+
+Scores are loaded into a sparse product x user matrix X, and B is its binary
+pattern, whose transpose is an inverted index from users to the products they
+reviewed. Worker processes compute X_b X^T and B_b B^T for blocks b of
+products, which walk the products of the reviewers of each product in b and
+give the inner products and numbers of common reviewers of every pair with a
+product in b, and count the pairs with a common reviewer, with a nonzero
+cosine similarity and with a positive one (the edges counted before).
+A histogram of the numbers of common reviewers is written as a by-product.
 """
 
+import multiprocessing as mp
 from optparse import OptionParser
 import sqlite3
-import math
-import sys
+import numpy as np
+import scipy.sparse as sp
+import csv
+
+import makeSimilarities
+
+# params
+fetchSize = 100000
 
 # db params
-selectProductsStmt = 'SELECT ProductId FROM Products ORDER BY ProductId'
-selectUserScoresStmt =\
-    ('SELECT UserId, Score FROM Reviews WHERE ProductId = :ProductId '
-     'ORDER BY UserId')
-selectOtherProductsStmt =\
-    ('SELECT ProductId FROM Products WHERE ProductId > :ProductId '
-     'ORDER BY ProductId')
+selectScoresStmt = 'SELECT ProductId, UserId, Score FROM Reviews'
+
+# matrices shared with worker processes
+X = None
+B = None
 
 def getParser(usage=None):
     parser = OptionParser(usage=usage)
     parser.add_option('-d', '--database', dest='db_fname', default='data/amazon.db',
         help='sqlite3 database file.', metavar='FILE')
+    parser.add_option('-o', '--outputFile', dest='outputFileName',
+        default='output/countEdges_hist.csv',
+        help='Output file for the histogram of common reviewers.',
+        metavar='FILE')
+    parser.add_option('-w', '--numWorkers', dest='numWorkers', type='int',
+        default=1, help='Number of worker processes.', metavar='NUM')
+    parser.add_option('--memory', dest='memory', type='int', default=1024,
+        help='Memory budget per worker for one block, in MB.', metavar='MB')
     return parser
 
-def cosSim(scoresA, scoresB):
-    """Compute Cosine similarity of sparse vectors in O(n),
-       where n is the max nonzero elements of the two vectors.
+def loadScores(db_conn):
+    """Returns the product x user matrix of scores."""
+    db_curs = db_conn.cursor()
+    productCodes = {}
+    userCodes = {}
+    rows = []
+    cols = []
+    vals = []
+    db_curs.execute(selectScoresStmt)
+    while True:
+        chunk = db_curs.fetchmany(fetchSize)
+        if not chunk:
+            break
+        rows.append(np.array([productCodes.setdefault(row[0], len(productCodes))
+                              for row in chunk], dtype=np.int32))
+        cols.append(np.array([userCodes.setdefault(row[1], len(userCodes))
+                              for row in chunk], dtype=np.int32))
+        vals.append(np.array([row[2] for row in chunk], dtype=np.float64))
+    if not rows:
+        return sp.csr_matrix((0, 0))
+    return sp.csr_matrix((np.concatenate(vals),
+                          (np.concatenate(rows), np.concatenate(cols))),
+                         shape=(len(productCodes), len(userCodes)))
+
+def countBlock(block):
+    """Returns (numCommon, numNonzero, numPositive, hist) for the pairs
+       (a, b) with a in block and a < b, where hist[n] is the number of pairs
+       with n common reviewers.
     """
-    innerProd = 0
-    varA = 0
-    varB = 0
-    i = 0
-    j = 0
-    while i < len(scoresA) and j < len(scoresB):
-        if scoresA[i][0] < scoresB[j][0]:
-            varA += scoresA[i][1]**2
-            i += 1
-        elif scoresA[i][0] > scoresB[j][0]:
-            varB += scoresB[j][1]**2
-            j += 1
-        else:
-            innerProd += scoresA[i][1]*scoresB[j][1]
-            varA += scoresA[i][1]**2
-            varB += scoresB[j][1]**2
-            i += 1
-            j += 1
-    if innerProd == 0:
-        return 0
-    else:
-        score = innerProd/(math.sqrt(varA)*math.sqrt(varB))
-        return score
+    begin, end = block
+    common = B[begin:end].dot(B.T).tocoo()
+    counts = common.data[common.col > common.row + begin]
+    hist = np.bincount(np.rint(counts).astype(np.int64))
+    inner = X[begin:end].dot(X.T).tocoo()
+    inner = inner.data[(inner.col > inner.row + begin) & (inner.data != 0)]
+    return (len(counts), len(inner), int(np.count_nonzero(inner > 0)), hist)
 
 def main():
+    global X
+    global B
+
     # Parse options
     usage = 'Usage: %prog [options]'
     parser = getParser(usage=usage)
@@ -62,30 +96,43 @@ def main():
     # connect to db
     print 'Connecting to %s. . .' % options.db_fname
     db_conn = sqlite3.connect(options.db_fname)
-    with db_conn:
-        num_edges = 0
-        updateEvery = 10000000
-        count = 0
-        db_curs1 = db_conn.cursor()
-        db_curs1.execute(selectProductsStmt)
-        for row1 in db_curs1.fetchall():
-            idA = row1[0]
-            db_curs2 = db_conn.cursor()
-            db_curs2.execute(selectUserScoresStmt, (idA,))
-            scoresA = [(row[0], row[1]) for row in db_curs2.fetchall()]
-            db_curs2.execute(selectOtherProductsStmt, (idA,))
-            for row2 in db_curs2.fetchall():
-               idB = row2[0]
-               db_curs3 = db_conn.cursor()
-               db_curs3.execute(selectUserScoresStmt, (idB,))
-               scoresB = [(row[0], row[1]) for row in db_curs3.fetchall()]
-               similarity = cosSim(scoresA, scoresB)
-               count += 1
-               if similarity > 0:
-                   num_edges += 1
-               if count % updateEvery == 0:
-                   print 'count =', count
+
+    # load scores
+    print 'Loading scores . . .'
+    X = loadScores(db_conn)
+    print '%d products, %d users, %d scores' % (X.shape[0], X.shape[1], X.nnz)
+    B = X.copy()
+    B.data = np.ones(len(B.data))
+    blocks = makeSimilarities.getBlocks(B, options.memory*1024*1024)
+    print '%d blocks' % len(blocks)
+
+    # count blocks in worker processes forked after loading
+    pool = mp.Pool(options.numWorkers)
+    num_common = 0
+    num_nonzero = 0
+    num_edges = 0
+    hist = np.zeros(0, dtype=np.int64)
+    for numCommon, numNonzero, numPositive, blockHist in\
+            pool.imap_unordered(countBlock, blocks):
+        num_common += numCommon
+        num_nonzero += numNonzero
+        num_edges += numPositive
+        if len(blockHist) > len(hist):
+            hist = np.append(hist, np.zeros(len(blockHist) - len(hist),
+                                            dtype=np.int64))
+        hist[:len(blockHist)] += blockHist
+    pool.close()
+    pool.join()
+    print 'Number of pairs with common reviewers = %d' % num_common
+    print 'Number of pairs with nonzero similarity = %d' % num_nonzero
     print 'Number of Edges = %d' % num_edges
 
+    # write histogram of common reviewers
+    print 'Writing to %s . . .' % options.outputFileName
+    with open(options.outputFileName, 'wb') as csvfile:
+        writer = csv.writer(csvfile)
+        for numUsers in np.flatnonzero(hist):
+            writer.writerow([numUsers, hist[numUsers]])
+
 if __name__ == '__main__':
     main()
@@ -8,9 +8,18 @@ into sqlite3 database.
 
 import os
 import sys
+import gzip
+import itertools
+import multiprocessing as mp
 from optparse import OptionParser
 import sqlite3
 
+# params
+chunkLines = 100000 # lines parsed per bulk parse task
+batchSize = 100000 # reviews written per bulk transaction
+recordFields = ['productId', 'title', 'price', 'userId', 'profileName',
+                'helpfulness', 'score', 'time', 'summary', 'text']
+
 # db params
 createProductsTableStmt =\
     ('CREATE TABLE IF NOT EXISTS Products(ProductId TEXT PRIMARY KEY, Title TEXT, '
@@ -46,6 +55,32 @@ insertReviewStmt =\
     ('INSERT INTO Reviews (ProductId, UserId, Helpfulness, Score, Time, '
      'Summary, Text) VALUES (:ProductId, :UserId, :Helpfulness, :Score, '
      ':Time, :Summary, :Text)')
+insertOrIgnoreProductStmt =\
+    ('INSERT OR IGNORE INTO Products (ProductId, Title, Price) VALUES '
+     '(:ProductId, :Title, :Price)')
+insertOrIgnoreCategoryStmt =\
+    ('INSERT OR IGNORE INTO FileCategories (ProductId, Category) VALUES '
+     '(:ProductId, :Category)')
+insertOrIgnoreUserStmt =\
+    ('INSERT OR IGNORE INTO Users (UserId, ProfileName) VALUES '
+     '(:UserId, :ProfileName)')
+insertOrIgnoreReviewStmt =\
+    ('INSERT OR IGNORE INTO Reviews (ProductId, UserId, Helpfulness, Score, '
+     'Time, Summary, Text) VALUES (:ProductId, :UserId, :Helpfulness, '
+     ':Score, :Time, :Summary, :Text)')
+countTemplate = 'SELECT count(*) FROM %s'
+bulkPragmas = [
+    'PRAGMA journal_mode = MEMORY',
+    'PRAGMA synchronous = OFF',
+    'PRAGMA cache_size = -1048576',
+    'PRAGMA temp_store = MEMORY',
+]
+dropIndexesStmts = [
+    'DROP INDEX IF EXISTS Reviews_UserId_Idx',
+]
+createIndexesStmts = [
+    'CREATE INDEX IF NOT EXISTS Reviews_UserId_Idx ON Reviews(UserId)',
+]
 
 # global counters
 products_inserted = 0
@@ -96,8 +131,70 @@ def getParser(usage=None):
         help='sqlite3 database file.', metavar='FILE')
     parser.add_option('-c', '--category', dest='category', default=None,
         help='Category of products in datafile.', metavar='FILE')
+    parser.add_option('-b', '--bulk', action='store_true', dest='bulk',
+        default=False, help=('Parse in worker processes and insert in large '
+        'batches, building indexes after the load.'))
+    parser.add_option('-w', '--numWorkers', dest='numWorkers', type='int',
+        default=1, help='Number of parsing processes for --bulk.',
+        metavar='NUM')
     return parser
 
+def parseLine(line):
+    """Returns (attribute, value) of a line of the data file, or None."""
+    tokens = line.split('/', 1)
+    try:
+        tokens = tokens[1].split(' ', 1)
+    except IndexError:
+        return None
+    attribute = tokens[0].split(':')[0]
+    value = tokens[1].rstrip()
+    return (attribute, value)
+
+def parseChunk(lines):
+    """Parses lines into the attributes set by each review that ends in the
+       chunk, plus those set by the trailing partial review. The first
+       review may continue one begun in the previous chunk.
+    """
+    records = []
+    attrs = {}
+    pr = ProductReview()
+    for line in lines:
+        parsed = parseLine(line)
+        if parsed is None:
+            continue
+        attribute, value = parsed
+        pr.setAttr(attribute, value)
+        attrs[attribute] = getattr(pr, attribute)
+        if attribute == 'text':
+            records.append(attrs)
+            attrs = {}
+    return (records, attrs)
+
+def readChunks(inputfile):
+    chunk = []
+    for line in inputfile:
+        chunk.append(line)
+        if len(chunk) == chunkLines:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def iterRecords(parsedChunks):
+    """Yields a tuple of recordFields per review from parsed chunks."""
+    partial = {}
+    for records, trailing in parsedChunks:
+        for attrs in records:
+            partial.update(attrs)
+            yield tuple([partial.get(field) for field in recordFields])
+            partial = {}
+        partial.update(trailing)
+
+def openDataFile(inputfilename):
+    if inputfilename.endswith('.gz'):
+        return gzip.open(inputfilename, 'rb')
+    return open(inputfilename, 'r')
+
 def importProductReview(db_curs, fileCategory, pr):
     global products_inserted
     global categories_inserted
@@ -128,6 +225,66 @@ def importProductReview(db_curs, fileCategory, pr):
             pr.helpfulness, pr.score, pr.time, pr.summary, pr.text))
         reviews_inserted += 1
 
+def getCounts(db_curs):
+    counts = []
+    for table in ['Products', 'FileCategories', 'Users', 'Reviews']:
+        db_curs.execute(countTemplate % table)
+        counts.append(db_curs.fetchone()[0])
+    return counts
+
+def writeBatch(db_conn, products, categories, users, reviews):
+    db_curs = db_conn.cursor()
+    db_curs.executemany(insertOrIgnoreProductStmt, products)
+    db_curs.executemany(insertOrIgnoreCategoryStmt, categories)
+    db_curs.executemany(insertOrIgnoreUserStmt, users)
+    db_curs.executemany(insertOrIgnoreReviewStmt, reviews)
+    db_conn.commit()
+
+def bulkImport(db_conn, fileCategory, records):
+    """Inserts records in batches. Products, categories and users are
+       deduplicated in memory and reviews by INSERT OR IGNORE, so as with
+       importProductReview the first occurrence of each row wins.
+    """
+    global products_inserted
+    global categories_inserted
+    global users_inserted
+    global reviews_inserted
+    db_curs = db_conn.cursor()
+    countsBefore = getCounts(db_curs)
+    seenProducts = set()
+    seenUsers = set()
+    products = []
+    categories = []
+    users = []
+    reviews = []
+    for (productId, title, price, userId, profileName, helpfulness, score,
+         time, summary, text) in records:
+        # ignore reviews by 'unknown' users
+        if userId == 'unknown':
+            continue
+        if productId not in seenProducts:
+            seenProducts.add(productId)
+            products.append((productId, title, price))
+            categories.append((productId, fileCategory))
+        if userId not in seenUsers:
+            seenUsers.add(userId)
+            users.append((userId, profileName))
+        reviews.append((productId, userId, helpfulness, score, time, summary,
+                        text))
+        if len(reviews) >= batchSize:
+            writeBatch(db_conn, products, categories, users, reviews)
+            print 'Inserted batch of %d reviews . . .' % len(reviews)
+            products = []
+            categories = []
+            users = []
+            reviews = []
+    writeBatch(db_conn, products, categories, users, reviews)
+    countsAfter = getCounts(db_curs)
+    products_inserted = countsAfter[0] - countsBefore[0]
+    categories_inserted = countsAfter[1] - countsBefore[1]
+    users_inserted = countsAfter[2] - countsBefore[2]
+    reviews_inserted = countsAfter[3] - countsBefore[3]
+
 def printCounts():
     global products_inserted
     global categories_inserted
@@ -138,6 +295,24 @@ def printCounts():
     print 'Inserted %d users' % users_inserted
     print 'Inserted %d reviews' % reviews_inserted
 
+def importFile(db_curs, fileCategory, inputfilename):
+    with openDataFile(inputfilename) as inputfile:
+        maxReviews = sys.maxint
+        review_cnt = 0
+        pr = ProductReview()
+        for line in inputfile:
+            parsed = parseLine(line)
+            if parsed is None:
+                continue
+            attribute, value = parsed
+            pr.setAttr(attribute, value)
+            if attribute == 'text':
+                importProductReview(db_curs, fileCategory, pr)
+                review_cnt += 1
+                if review_cnt >= maxReviews:
+                    break
+                pr = ProductReview()
+
 def main():
     # Parse options
     usage = 'Usage: %prog [options] <datafile>'
@@ -171,25 +346,31 @@ def main():
         # create Reviews table id not already exists
         db_curs.execute(createReviewsTableStmt)
 
-        with open(inputfilename, 'r') as inputfile:
-            maxReviews = sys.maxint
-            review_cnt = 0
-            pr = ProductReview()
-            for line in inputfile:
-                tokens = line.split('/', 1)
-                try:
-                    tokens = tokens[1].split(' ', 1)
-                except IndexError:
-                    continue
-                attribute = tokens[0].split(':')[0]
-                value = tokens[1].rstrip()
-                pr.setAttr(attribute, value)
-                if attribute == 'text':
-                    importProductReview(db_curs, fileCategory, pr)
-                    review_cnt += 1
-                    if review_cnt >= maxReviews:
-                        break
-                    pr = ProductReview()
+        if options.bulk:
+            # tune for bulk load and drop indexes until after the load
+            for stmt in bulkPragmas + dropIndexesStmts:
+                db_curs.execute(stmt)
+        else:
+            importFile(db_curs, fileCategory, inputfilename)
+    if options.bulk:
+        # parse chunks of lines in order in worker processes
+        if options.numWorkers > 1:
+            pool = mp.Pool(options.numWorkers)
+            imap = pool.imap
+        else:
+            pool = None
+            imap = itertools.imap
+        with openDataFile(inputfilename) as inputfile:
+            parsedChunks = imap(parseChunk, readChunks(inputfile))
+            bulkImport(db_conn, fileCategory, iterRecords(parsedChunks))
+        if pool is not None:
+            pool.close()
+            pool.join()
+        print 'Creating indexes . . .'
+        with db_conn:
+            db_curs = db_conn.cursor()
+            for stmt in createIndexesStmts:
+                db_curs.execute(stmt)
     # print insertion counts
     printCounts()
 
@@ -0,0 +1,226 @@
+#!/usr/local/bin/python
+
+"""
+Runs a function over a stream of tasks (e.g. product pairs) in worker
+processes that share one task queue.
+
+The master puts chunks of tasks on a single bounded queue and any idle worker
+takes the next chunk, so a worker busy with a long task never holds up tasks
+that other workers could run. Before starting each task, a worker puts half
+of the rest of its chunk back on the queue if other workers are idle and no
+chunks are queued, so the tail of a run is spread over all workers. If a
+worker dies, the others stop once the queue is drained and run() raises.
+Workers are forked when run() is called, so anything loaded beforehand (e.g.
+module globals) is shared copy-on-write, and each worker opens its own
+resources (db connections, output files) in initWorker.
+"""
+
+import multiprocessing as mp
+import Queue
+import sys
+import time
+import traceback
+
+# params
+chunkSize = 10
+workerTimeout = 30
+workerQueueSize = 100
+sentinelWait = 0.1
+END_OF_QUEUE = None
+
+def run(tasks, processTask, numWorkers=1, initWorker=None, finishWorker=None,
+        chunkSize=chunkSize):
+    """Calls processTask(state, task) for each task in worker processes, where
+       state = initWorker(workerIdx) once per worker (None if not given).
+       finishWorker(state) is called when a worker runs out of tasks. Returns
+       the list of per-worker stats dicts, in which 'result' holds the value
+       returned by finishWorker (e.g. a partial aggregate to be merged).
+       Raises RuntimeError once all tasks are done if any task failed or a
+       worker died, so that scripts exit with an error.
+    """
+    q = mp.Queue(workerQueueSize)
+    statsQueue = mp.Queue()
+    counters = Counters()
+    # fork worker processes
+    workers = []
+    for w in range(numWorkers):
+        workers.append(mp.Process(target=worker,
+            args=(w, q, statsQueue, counters, processTask, initWorker,
+                  finishWorker)))
+    for w in range(numWorkers):
+        workers[w].start()
+    # do master task
+    master(tasks, q, workers, counters, chunkSize)
+    # collect stats before joining, so that workers can flush statsQueue
+    stats, dead = collectStats(q, statsQueue, workers, counters)
+    for w in range(numWorkers):
+        workers[w].join()
+    stats.sort(key=lambda x: x['workerIdx'])
+    printStats(stats)
+    if dead:
+        raise RuntimeError('Workers %s exited without stats.' %
+                           ', '.join(str(w) for w in sorted(dead)))
+    numFailures = sum(s['failures'] for s in stats)
+    if numFailures:
+        raise RuntimeError('%d tasks failed.' % numFailures)
+    return stats
+
+class Counters(object):
+    """Counters shared by the master and the workers."""
+    def __init__(self):
+        self.numIdle = mp.Value('i', 0)
+        self.numOutstanding = mp.Value('i', 0)
+        self.numQueued = mp.Value('i', 0)
+        self.aborted = mp.Value('i', 0)
+
+def increment(value, n):
+    with value.get_lock():
+        value.value += n
+
+def master(tasks, q, workers, counters, chunkSize):
+    chunk = []
+    for task in tasks:
+        chunk.append(task)
+        if len(chunk) == chunkSize:
+            putChunk(q, workers, counters, chunk)
+            chunk = []
+    if chunk:
+        putChunk(q, workers, counters, chunk)
+    # one sentinel per worker
+    for w in range(len(workers)):
+        put(q, workers, END_OF_QUEUE)
+
+def putChunk(q, workers, counters, chunk):
+    increment(counters.numOutstanding, len(chunk))
+    increment(counters.numQueued, 1)
+    put(q, workers, chunk)
+
+def collectStats(q, statsQueue, workers, counters):
+    """Returns (stats, dead): the stats of the workers that finished and the
+       indexes of those that exited without stats. When a worker dies, the
+       others are told to stop, as its tasks will never be done.
+    """
+    stats = []
+    dead = set()
+    exited = set()
+    while len(stats) + len(dead) < len(workers):
+        try:
+            stats.append(statsQueue.get(timeout=sentinelWait))
+            continue
+        except Queue.Empty:
+            pass
+        reported = set(s['workerIdx'] for s in stats)
+        # stats put before exiting are read by the next get, so a worker is
+        # dead if it has exited without stats on two polls in a row
+        newExited = set(w for w in range(len(workers))
+                        if workers[w].exitcode is not None and
+                        w not in reported and w not in dead)
+        newDead = newExited & exited
+        exited = newExited
+        if newDead:
+            dead |= newDead
+            print >> sys.stderr, 'Worker(s) %s died, stopping . . .' %\
+                ', '.join(str(w) for w in sorted(newDead))
+            counters.aborted.value = 1
+            for w in range(len(workers)):
+                if workers[w].is_alive():
+                    put(q, workers, END_OF_QUEUE)
+    return stats, dead
+
+def put(q, workers, item):
+    while True:
+        try:
+            q.put(item, timeout=workerTimeout)
+            return
+        except Queue.Full:
+            if not any(w.is_alive() for w in workers):
+                raise RuntimeError('All workers have exited.')
+
+def workerPut(q, counters, item):
+    """Puts item on the queue unless the run is aborted. Returns whether it
+       was put.
+    """
+    while not counters.aborted.value:
+        try:
+            q.put(item, timeout=workerTimeout)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+def worker(workerIdx, q, statsQueue, counters, processTask, initWorker,
+           finishWorker):
+    startTime = time.time()
+    stats = {'workerIdx': workerIdx, 'tasks': 0, 'failures': 0, 'shared': 0,
+             'busyTime': 0.0}
+    if initWorker:
+        state = initWorker(workerIdx)
+    else:
+        state = None
+    idle = False
+    while True:
+        if not idle:
+            increment(counters.numIdle, 1)
+            idle = True
+        chunk = q.get()
+        if chunk is END_OF_QUEUE:
+            if counters.numOutstanding.value == 0 or counters.aborted.value:
+                break
+            # other workers may still share tasks, so wait for them
+            if not workerPut(q, counters, END_OF_QUEUE):
+                break
+            time.sleep(sentinelWait)
+            continue
+        increment(counters.numQueued, -1)
+        increment(counters.numIdle, -1)
+        idle = False
+        while chunk:
+            task = chunk.pop(0)
+            # share the rest of the chunk with idle workers once no chunks
+            # are left for them on the queue
+            if chunk and counters.numIdle.value > 0 and\
+               counters.numQueued.value == 0:
+                half = len(chunk)/2
+                increment(counters.numQueued, 1)
+                if workerPut(q, counters, chunk[half:]):
+                    stats['shared'] += len(chunk) - half
+                    chunk = chunk[:half]
+                else:
+                    increment(counters.numQueued, -1)
+            taskStart = time.time()
+            try:
+                processTask(state, task)
+            except Exception:
+                stats['failures'] += 1
+                print >> sys.stderr, 'Worker %d failed on task %s:' %\
+                    (workerIdx, task)
+                traceback.print_exc()
+            stats['busyTime'] += time.time() - taskStart
+            stats['tasks'] += 1
+            increment(counters.numOutstanding, -1)
+    increment(counters.numIdle, -1)
+    if finishWorker:
+        stats['result'] = finishWorker(state)
+    else:
+        stats['result'] = None
+    stats['elapsedTime'] = time.time() - startTime
+    statsQueue.put(stats)
+
+def printStats(stats):
+    for s in stats:
+        if s['elapsedTime'] > 0:
+            rate = s['tasks']/s['elapsedTime']
+            busy = 100*s['busyTime']/s['elapsedTime']
+        else:
+            rate = 0.0
+            busy = 0.0
+        print >> sys.stderr, ('Worker %d: %d tasks (%d failed, %d shared) '
+                              'in %.1fs, %.1f tasks/s, %.0f%% busy') %\
+            (s['workerIdx'], s['tasks'], s['failures'], s['shared'],
+             s['elapsedTime'], rate, busy)
+
+def readPairs(inputfile):
+    """Yields (productId1, productId2) tasks from lines of a pairs file."""
+    for line in inputfile:
+        tokens = line.split(',')
+        yield (tokens[0].strip(), tokens[1].strip())
@@ -1,8 +1,18 @@
 #!/usr/local/bin/python
 
-import multiprocessing as mp
-import Queue
+"""
+Computes similarity estimates of product pairs step by step as their reviews
+arrive over time (expt1) or as common reviewers arrive (expt2).
+
+Several similarity functions, each with its own parameters, may be given
+as a comma separated list (see similarity.parseSpecs). They are computed in
+one pass over each pair's reviews, from shared running sums when all of
+them have an incremental version, and each is written to its own output
+with the function and its parameters as prefix.
+"""
+
 from optparse import OptionParser
+import functools
 import sqlite3
 import numpy as np
 import csv
@@ -12,13 +22,14 @@ import math
 
 import similarity
 import modelPredictions as modpred
+import reviewStore
+import resultStore
+import executor
 
 # params
 stepSize = 10
-workerTimeout = 15
-workerQueueSize = 100
 outputFileTemplate = '%s_%s_%s.csv'
-END_OF_QUEUE = -1
+store = None
 
 #db params
 dbTimeout = 5
@@ -41,16 +52,23 @@ def getParser(usage=None):
         default='data/amazon.db', help='sqlite3 database file.', metavar='FILE')
     parser.add_option('-o', '--output-dir', dest='outputDir', default=None,
         help='Output directory.', metavar='DIR')
+    parser.add_option('--reviewStore', dest='storeDir', default=None,
+        help='Review store directory built by reviewStore.py.', metavar='DIR')
     parser.add_option('-p', '--prefix', dest='prefix', default=None,
         help='Output file prefix.', metavar='STR')
+    parser.add_option('--shards', action='store_true', dest='shards',
+        default=False, help=('Append results to npz shards in the output '
+        'directory instead of writing one CSV file per pair.'))
     parser.add_option('-e', '--exptFunc', dest='exptFunc', default='expt1',
         help='Experiment function to use: "expt1" (default) or "expt2"',
         metavar='EXPTNAME')
     parser.add_option('-c', '--cosineFunc', dest='cosineFunc',
         default='prefSim',
         help=('Similarity function to use: "prefSim" (default), "randSim", '
-              '"prefSimAlt1", "randSimAlt1", "regSim", "momSim", "alphaSim" or "predSim"'),
-        metavar='FUNCNAME')
+              '"prefSimAlt1", "randSimAlt1", "regSim", "momSim", "alphaSim", "predSim" or "mfSim", '
+              'or a comma separated list of them, each optionally followed '
+              'by :K=, :sigma=, :epsilon= or :constSimScore= settings'),
+        metavar='FUNCNAMES')
     parser.add_option('--constSimScore', type='float', dest='constSimScore',
         default=None, help='Constant similarity estimate used by constSim.',
         metavar='FLOAT')
@@ -99,8 +117,23 @@ def getParser(usage=None):
     parser.add_option('--epsilon', dest='epsilon', type='float', default=0.01,
         help='Parameter epsilon for weightedRandSim or wightedPrefSim.',
         metavar='FLOAT')
+    parser.add_option('--mfDir', dest='mfDir', default='.mf',
+        help='Save directory of matrixFactorization.py for mfSim.',
+        metavar='DIR')
     return parser
 
+def fetchReviews(db_curs, productId, orderByTime=False):
+    if store is not None:
+        reviews = store.getReviews(productId)
+        if orderByTime:
+            reviews.sort(key=lambda x: x[0])
+        return reviews
+    if orderByTime:
+        db_curs.execute(selectReviewsOrderByTimeStmt, (productId,))
+    else:
+        db_curs.execute(selectReviewsOrderByUserStmt, (productId,))
+    return [(row[0], row[1], row[2]) for row in db_curs.fetchall()]
+
 def getReviewPairTimes(reviewsA, reviewsB):
     reviewPairTimes = []
     i = 0
@@ -124,19 +157,45 @@ def getReviewPairTimes(reviewsA, reviewsB):
             j += 1
     return reviewPairTimes
 
-def expt1(db_conn, writer, cosineFunc, productId1, productId2):
+def getPrefixes(prefix, specs):
+    """Returns the output prefix of each SimilaritySpec."""
+    if len(specs) == 1:
+        return [prefix or specs[0].getLabel()]
+    if prefix:
+        return ['%s_%s' % (prefix, spec.getLabel()) for spec in specs]
+    return [spec.getLabel() for spec in specs]
+
+def getModelSim(spec, predictions):
+    """Returns (cosineSim, numUserCommon) of modelSim or weightedModelSim
+       from the predictions so far.
+    """
+    specWeights, specAvgWeight = spec.getWeights()
+    totalScore = 0
+    totalWeight = 0
+    for p in predictions:
+        if spec.func == similarity.weightedModelSim:
+            try:
+                weight = specWeights[p[0]]
+            except:
+                weight = specAvgWeight
+        else:
+            weight = 1
+        totalScore += p[3]*weight
+        totalWeight += weight
+    return (totalScore/totalWeight, len(predictions))
+
+def expt1(db_conn, writers, specs, productId1, productId2):
     db_curs = db_conn.cursor()
     # fetch product reviews
-    db_curs.execute(selectReviewsOrderByTimeStmt, (productId1,))
-    reviews1 = [(row[0], row[1], row[2]) for row in db_curs.fetchall()]
-    db_curs.execute(selectReviewsOrderByTimeStmt, (productId2,))
-    reviews2 = [(row[0], row[1], row[2]) for row in db_curs.fetchall()]
+    reviews1 = fetchReviews(db_curs, productId1, orderByTime=True)
+    reviews2 = fetchReviews(db_curs, productId2, orderByTime=True)
     i = 0
     j = 0
     stepBegin_i = 0
     stepBegin_j = 0
     pastReviews1 = []
     pastReviews2 = []
+    accumulator = similarity.getSpecsAccumulator(specs)
     count = 0
     # TODO: Fix so that we capture the last (partial) step.
     while i < len(reviews1) or j < len(reviews2):
@@ -150,6 +209,16 @@ def expt1(db_conn, writer, cosineFunc, productId1, productId2):
             raise RuntimeError('Unreachable code.')
         count += 1
         if count % stepSize == 0:
+            if accumulator is not None:
+                # add reviews for step to running sums
+                accumulator.addReviews(reviews1[stepBegin_i:i],
+                                       reviews2[stepBegin_j:j])
+                stepBegin_i = i
+                stepBegin_j = j
+                for writer, (cosineSim, numUserCommon) in\
+                        zip(writers, accumulator.getSimilarities()):
+                    writer.writerow([count, i, j, numUserCommon, cosineSim])
+                continue
             # extract reviews for step and sort by userId
             # (faster to pre-sort step)
             stepReviews1 = sorted(reviews1[stepBegin_i:i], key=lambda x: x[1])
@@ -162,19 +231,17 @@ def expt1(db_conn, writer, cosineFunc, productId1, productId2):
             pastReviews2 = sorted(pastReviews2 + stepReviews2,
                                   key=lambda x:x[1])
             # compute cosine similarity at present time slice
-            # using the provided function.
-            cosineSim, numUserCommon =\
-                cosineFunc(pastReviews1, pastReviews2)
-            # write step info
-            writer.writerow([count, i, j, numUserCommon, cosineSim])
+            # using the provided functions.
+            for writer, spec in zip(writers, specs):
+                cosineSim, numUserCommon = spec(pastReviews1, pastReviews2)
+                # write step info
+                writer.writerow([count, i, j, numUserCommon, cosineSim])
 
-def expt2(db_conn, writer, cosineFunc, productId1, productId2):
+def expt2(db_conn, writers, specs, productId1, productId2):
     db_curs = db_conn.cursor()
     # fetch product reviews
-    db_curs.execute(selectReviewsOrderByUserStmt, (productId1,))
-    reviews1 = [(row[0], row[1], row[2]) for row in db_curs.fetchall()]
-    db_curs.execute(selectReviewsOrderByUserStmt, (productId2,))
-    reviews2 = [(row[0], row[1], row[2]) for row in db_curs.fetchall()]
+    reviews1 = fetchReviews(db_curs, productId1)
+    reviews2 = fetchReviews(db_curs, productId2)
     # compute product biases
     bias1 = np.mean([review[2] for review in reviews1])
     bias2 = np.mean([review[2] for review in reviews2])
@@ -192,6 +259,9 @@ def expt2(db_conn, writer, cosineFunc, productId1, productId2):
     predReviews1 = []
     predReviews2 = []
     predictions = []
+    accumulator = similarity.getSpecsAccumulator(specs)
+    isModel = [spec.func == similarity.modelSim or
+               spec.func == similarity.weightedModelSim for spec in specs]
     i = 0
     j = 0
     for pairTime in reviewPairTimes:
@@ -204,14 +274,23 @@ def expt2(db_conn, writer, cosineFunc, productId1, productId2):
             if (reviews2[j][0] > pairTime):
                 break
             j += 1
+        if accumulator is not None:
+            # add reviews for step to running sums
+            accumulator.addReviews(reviews1[stepBegin_i:i],
+                                   reviews2[stepBegin_j:j])
+            stepBegin_i = i
+            stepBegin_j = j
+            for writer, (cosineSim, numUserCommon) in\
+                    zip(writers, accumulator.getSimilarities()):
+                writer.writerow([i+j, i, j, numUserCommon, cosineSim])
+            continue
         # sort reviews by userId
         stepReviews1 = sorted(reviews1[stepBegin_i:i], key=lambda x: x[1])
         stepReviews2 = sorted(reviews2[stepBegin_j:j], key=lambda x: x[1])
         stepBegin_i = i
         stepBegin_j = j
         # special handling for modelSim
-        if cosineFunc == similarity.modelSim or\
-           cosineFunc == similarity.weightedModelSim:
+        if any(isModel):
             predReviews1 =\
                 sorted(predReviews1 + stepReviews1, key=lambda x: x[1])
             predReviews2 =\
@@ -223,22 +302,7 @@ def expt2(db_conn, writer, cosineFunc, productId1, productId2):
                             if r[1] not in [p[0] for p in predictions]]
             predReviews2 = [r for r in predReviews2\
                             if r[1] not in [p[0] for p in predictions]]
-            # compute weighted mean
-            totalScore = 0
-            totalWeight = 0
-            for p in predictions:
-                if cosineFunc == similarity.weightedModelSim:
-                    try:
-                        weight = similarity.weights[p[0]]
-                    except:
-                        weight = similarity.avgWeight
-                else:
-                    weight = 1
-                totalScore += p[3]*weight
-                totalWeight += weight
-            cosineSim = totalScore/totalWeight
-            numUserCommon = len(predictions)
-        else:
+        if not all(isModel):
             # append to past reviews and sort by userId
             pastReviews1 = sorted(pastReviews1 + stepReviews1,
                                   key=lambda x: x[1])
@@ -246,53 +310,70 @@ def expt2(db_conn, writer, cosineFunc, productId1, productId2):
             pastReviews2 = sorted(pastReviews2 + stepReviews2,
                                   key=lambda x: x[1])
             assert(pastReviews2)
-            # compute cosine similarity at present time slice
-            # using the provided function.
-            cosineSim, numUserCommon = cosineFunc(pastReviews1, pastReviews2)
-        # write step info
-        writer.writerow([i+j, i, j, numUserCommon, cosineSim])
+        for writer, spec, model in zip(writers, specs, isModel):
+            if model:
+                # compute weighted mean
+                cosineSim, numUserCommon = getModelSim(spec, predictions)
+            else:
+                # compute cosine similarity at present time slice
+                # using the provided function.
+                cosineSim, numUserCommon = spec(pastReviews1, pastReviews2)
+            # write step info
+            writer.writerow([i+j, i, j, numUserCommon, cosineSim])
 
-def worker(workerIdx, q, db_fname, outputDir, prefix, exptFunc, cosineFunc):
-    num_writes = 0
-    num_skips = 0
+def initWorker(db_fname, outputDir, prefixes, shards, workerIdx):
     # connect to db
     db_conn = sqlite3.connect(db_fname, dbTimeout)
-    while True:
-        (productId1, productId2) = q.get()
-        if productId1 == END_OF_QUEUE: break
+    if shards:
+        resultWriters = [resultStore.ResultWriter(outputDir, prefix,
+                             workerIdx, resultStore.experimentDtypes)
+                         for prefix in prefixes]
+    else:
+        resultWriters = None
+    return (db_conn, resultWriters)
+
+def finishWorker(state):
+    db_conn, resultWriters = state
+    if resultWriters is not None:
+        for resultWriter in resultWriters:
+            resultWriter.close()
+
+def skipStored(pairs, storedPairs):
+    """Yields the product pairs that are not yet stored for every prefix."""
+    for pair in pairs:
+        if all(pair in stored for stored in storedPairs):
+            print 'Skipping %s, %s . . .' % pair
+        else:
+            yield pair
+
+def writePair(outputDir, prefixes, exptFunc, specs, storedPairs, state,
+              pair):
+    db_conn, resultWriters = state
+    productId1, productId2 = pair
+    if resultWriters is not None:
+        todo = [k for k in range(len(specs)) if pair not in storedPairs[k]]
+        rows = [resultStore.RowBuffer() for k in todo]
+        exptFunc(db_conn, rows, [specs[k] for k in todo], productId1,
+                 productId2)
+        for k, buf in zip(todo, rows):
+            resultWriters[k].writePair(productId1, productId2, buf.rows)
+        return
+    todo = []
+    for k in range(len(specs)):
         outputFileName = os.path.join(outputDir, outputFileTemplate %
-                                      (prefix, productId1, productId2))
+                                      (prefixes[k], productId1, productId2))
         if os.path.isfile(outputFileName):
-            num_skips += 1
             print 'Skipping %s . . .' % outputFileName
         else:
             print 'Writing %s . . .' % outputFileName
-            with open(outputFileName, 'wb') as csvfile:
-                writer = csv.writer(csvfile)
-                exptFunc(db_conn, writer, cosineFunc, productId1, productId2)
-                num_writes += 1
-
-def master(inputfile, queues, workers):
-    i = 0
-    for line in inputfile:
-        tokens = line.split(',')
-        productId1 = tokens[0].strip()
-        productId2 = tokens[1].strip()
-        workerIdx = i % len(workers)
-
-        while True:
-            try:
-                queues[workerIdx].put((productId1, productId2),
-                                      timeout=workerTimeout)
-                break
-            except Queue.Full:
-                print 'WARNING: Worker Queue Full!'
-        i += 1
-
-    # close queues
-    for q in queues:
-        q.put((END_OF_QUEUE, END_OF_QUEUE))
-        q.close()
+            todo.append((k, outputFileName))
+    if not todo:
+        return
+    with resultStore.openFiles([outputFileName for k, outputFileName
+                                in todo]) as csvfiles:
+        exptFunc(db_conn, [csv.writer(csvfile) for csvfile in csvfiles],
+                 [specs[k] for k, outputFileName in todo], productId1,
+                 productId2)
 
 def main():
     # Parse options
@@ -312,11 +393,11 @@ def main():
             'Invalid Experiment function: %s' % options.exptFunc
         return
     try:
-        cosineFunc = getattr(similarity, options.cosineFunc)
-    except KeyError:
-        print >> sys.stderr,\
-            'Invalid Similarity function: %s' % options.cosineFunc
+        specs = similarity.parseSpecs(options.cosineFunc)
+    except ValueError as e:
+        print >> sys.stderr, e
         return
+    funcNames = set([spec.funcName for spec in specs])
     try:
         regSimRawFunc = getattr(similarity, options.regSimRawFunc)
     except KeyError:
@@ -342,10 +423,7 @@ def main():
     if not os.path.isdir(outputDir):
        print >> sys.stderr, 'Cannot find output dir: %s' % outputDir
        return
-    if options.prefix:
-        prefix = options.prefix
-    else:
-        prefix = options.cosineFunc
+    prefixes = getPrefixes(options.prefix, specs)
     global stepSize
     if options.stepSize:
         stepSize = options.stepSize
@@ -357,50 +435,57 @@ def main():
         similarity.constSimScore = options.constSimScore
 
     # regSim
-    if options.cosineFunc == 'regSim':
+    if 'regSim' in funcNames:
         similarity.initRegSim(options.regSimParamsFile, regSimRawFunc,
                    options.maxUsersCommon)
 
     # momSim
-    if options.cosineFunc == 'momSim':
+    if 'momSim' in funcNames:
         similarity.initMomSim(options.momSimParamsFile, momSimRawFunc,
                    options.maxUsersCommon)
 
     # alphaSim
-    if options.cosineFunc == 'alphaSim':
-        similarity.initMomSim(options.alphaSimParamsFile, alphaSimRawFunc,
+    if 'alphaSim' in funcNames:
+        similarity.initAlphaSim(options.alphaSimParamsFile, alphaSimRawFunc,
                    options.maxUsersCommon)
 
     # predSim
-    if options.cosineFunc == 'predSim':
+    if 'predSim' in funcNames:
         similarity.initPredSim(options.minRating, options.maxRating,
                                options.stepRating, options.simGridFile)
 
     # weighted similarity
-    if options.cosineFunc == 'weightedModelSim':
+    if 'weightedModelSim' in funcNames or 'weightedRandSim' in funcNames:
         similarity.initWeightedSim(options.errorFileName, options.epsilon)
+        for spec in specs:
+            spec.initWeights(options.errorFileName)
 
-    # create queues
-    queues = []
-    for w in range(options.numWorkers):
-        queues.append(mp.Queue(workerQueueSize))
+    # mfSim
+    if 'mfSim' in funcNames:
+        similarity.initMFSim(options.mfDir)
 
-    # create worker processes
-    workers = []
-    for w in range(options.numWorkers):
-        workers.append(mp.Process(target=worker,
-            args=(w, queues[w], options.db_fname, outputDir, prefix,
-                  exptFunc, cosineFunc)))
-
-    # start worker processes
-    for w in range(options.numWorkers):
-        workers[w].start()
+    # open review store before forking workers
+    global store
+    store = reviewStore.openStore(options.storeDir)
 
     # open input file
     print 'Reading from %s. . .' % inputFileName
     with open(inputFileName, 'r') as inputfile:
-        # do master task
-        master(inputfile, queues, workers)
+        pairs = executor.readPairs(inputfile)
+        if options.shards:
+            storedPairs = [resultStore.ResultStore(outputDir,
+                               prefix).getPairs() for prefix in prefixes]
+            pairs = skipStored(pairs, storedPairs)
+        else:
+            storedPairs = None
+        # process pairs in worker processes
+        executor.run(pairs,
+            functools.partial(writePair, outputDir, prefixes, exptFunc,
+                              specs, storedPairs),
+            numWorkers=options.numWorkers,
+            initWorker=functools.partial(initWorker, options.db_fname,
+                                         outputDir, prefixes, options.shards),
+            finishWorker=finishWorker)
 
 if __name__ == '__main__':
     main()
@@ -3,6 +3,8 @@
 """
 Generates and saves a directed weighted graph from Similarities
 relations according to given parameters.
+Alternatively, the graph is built from the top K neighbor index of a matrix
+factorization (see mfNeighbors.py), without querying Similarities.
 """
 
 from optparse import OptionParser
@@ -11,6 +13,8 @@ import sqlite3
 import pickle
 import sys
 
+import mfNeighbors
+
 # params
 displayInterval = 1000
 
@@ -47,6 +51,11 @@ def getParser(usage=None):
     parser.add_option('--minNumUsers', dest='minNumUsers', type='int',
         default=0, help='Minimum Number of Users associated with edges.',
         metavar='NUM')
+    parser.add_option('--mfDir', dest='mfDir', default=None,
+        help=('Build the graph from the neighbor index in this save directory '
+              'of matrixFactorization.py instead of from Similarities '
+              '(--minExtJaccard and --minNumUsers do not apply).'),
+        metavar='DIR')
     return parser
 
 def saveGraph(graph, filename):
@@ -57,6 +66,53 @@ def addDirectedEdge(graph, node1, node2, weight):
         graph[node1] = {}
     graph[node1][node2] = weight
 
+def addSimilarityEdges(graph, db_fname, options):
+    # connect to db
+    print 'Connecting to %s. . .' % db_fname
+    db_conn = sqlite3.connect(db_fname)
+    with db_conn:
+        db_curs1 = db_conn.cursor()
+        count = 0
+        db_curs1.execute(selectSimilaritiesStmt,
+                          (options.minCosineSim,
+                          options.minExtJaccard,
+                          options.minNumUsers))
+        for row in db_curs1.fetchall():
+            count += 1
+            productId1 = row[0]
+            productId2 = row[1]
+            cosineSim = row[2]
+            numUsers = row[3]
+            if options.weight:
+                weight = cosineSim
+            else:
+                weight = 1
+            addDirectedEdge(graph, productId1, productId2, weight)
+            if count % displayInterval == 0:
+                print '%d Edges Processed' % count
+
+def addNeighborEdges(graph, mfDir, options):
+    print 'Loading neighbors from %s. . .' % mfDir
+    productIds, neighbors, sims = mfNeighbors.loadNeighbors(mfDir)
+    # plain strings as nodes, as for the edges read from the db
+    productIds = productIds.tolist()
+    count = 0
+    for i in range(len(productIds)):
+        for j in range(min(options.k, neighbors.shape[1])):
+            cosineSim = float(sims[i,j])
+            # neighbors are in decreasing order of similarity
+            if cosineSim < options.minCosineSim:
+                break
+            count += 1
+            if options.weight:
+                weight = cosineSim
+            else:
+                weight = 1
+            addDirectedEdge(graph, productIds[i], productIds[neighbors[i,j]],
+                            weight)
+            if count % displayInterval == 0:
+                print '%d Edges Processed' % count
+
 def truncateEdges(graph, k):
     count = 0
     for node1 in graph:
@@ -86,32 +142,13 @@ def main():
     parser = getParser(usage=usage)
     (options, args) = parser.parse_args()
 
-    # connect to db
-    print 'Connecting to %s. . .' % options.db_fname
-    db_conn = sqlite3.connect(options.db_fname)
-    with db_conn:
-        db_curs1 = db_conn.cursor()
-        graph = {}
-        count = 0
-        db_curs1.execute(selectSimilaritiesStmt,
-                          (options.minCosineSim,
-                          options.minExtJaccard,
-                          options.minNumUsers))
-        for row in db_curs1.fetchall():
-            count += 1
-            productId1 = row[0]
-            productId2 = row[1]
-            cosineSim = row[2]
-            numUsers = row[3]
-            if options.weight:
-                weight = cosineSim
-            else:
-                weight = 1
-            addDirectedEdge(graph, productId1, productId2, weight)
-            if count % displayInterval == 0:
-                print '%d Edges Processed' % count
-        print 'Truncating Graph...'
-        truncateEdges(graph, options.k)
+    graph = {}
+    if options.mfDir:
+        addNeighborEdges(graph, options.mfDir, options)
+    else:
+        addSimilarityEdges(graph, options.db_fname, options)
+    print 'Truncating Graph...'
+    truncateEdges(graph, options.k)
     print 'Saving Graph...'
     saveGraph(graph, options.outfilename)
     print 'Printing Graph...'
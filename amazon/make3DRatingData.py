@@ -2,28 +2,37 @@
 
 """
 Generate 3D histogram of rating pair data.
+
+Pairs are split between worker processes, each of which fetches its rating
+pairs and fills its own histogram, and the histograms are summed.
 """
 
 from optparse import OptionParser
+import functools
 import sqlite3
 import csv
 import os
 import sys
 import numpy as np
-import random
+
+import reviewStore
+import ratingPairs
+import executor
 
 # db params
 dbTimeout = 5
-selectReviewsStmt =\
-    ('SELECT Time, UserId, AdjustedScore '
-     'FROM Reviews '
-     'WHERE ProductId = :ProductId '
-     'ORDER BY UserId')
 
 def getParser(usage=None):
     parser = OptionParser(usage=usage)
+    parser.add_option('-w', '--numWorkers', dest='numWorkers', type='int',
+        default=1, help='Number of worker processes.', metavar='NUM')
     parser.add_option('-d', '--database', dest='db_fname',
         default='data/amazon.db', help='sqlite3 database file.', metavar='FILE')
+    parser.add_option('--reviewStore', dest='storeDir', default=None,
+        help='Review store directory built by reviewStore.py.', metavar='DIR')
+    parser.add_option('--cache', dest='cacheDir', default=None,
+        help='Rating pair cache directory (see ratingPairs.py).',
+        metavar='DIR')
     parser.add_option('--minRating', type='float', dest='minRating',
         default=-1.5, help='Minimum rating.', metavar='NUM')
     parser.add_option('--stepRating', type='float', dest='stepRating',
@@ -33,65 +42,42 @@ def getParser(usage=None):
     return parser
 
 def incrementHistogram(histogram, minRating, stepRating, numBins,
-                       rating1, rating2):
-    if rating1 >= minRating and rating1 < minRating + numBins*stepRating and\
-       rating2 >= minRating and rating2 < minRating + numBins*stepRating:
-        idx1 = int(round((rating1 - minRating)/stepRating))
-        idx2 = int(round((rating2 - minRating)/stepRating))
-        if idx1 >= numBins:
-            idx1 = numBins - 1
-        if idx2 >= numBins:
-            idx2 = numBins - 1
-        histogram[idx1][idx2] += 1
-
-def fillHistogram(db_conn, inputfile, histogram,
-                  minRating, stepRating, numBins):
-    db_curs = db_conn.cursor()
-    for line in inputfile:
-        tokens = line.split(',')
-        productId1 = tokens[0].strip()
-        productId2 = tokens[1].strip()
-        print >> sys.stderr, 'Processing %s, %s . . .' %\
-                             (productId1, productId2)
-        # fetch product reviews
-        db_curs.execute(selectReviewsStmt, (productId1,))
-        reviews1 = [(row[0], row[1], row[2]) for row in db_curs.fetchall()]
-        db_curs.execute(selectReviewsStmt, (productId2,))
-        reviews2 = [(row[0], row[1], row[2]) for row in db_curs.fetchall()]
-        # compute product biases:
-        bias1 = np.mean([review[2] for review in reviews1])
-        bias2 = np.mean([review[2] for review in reviews2])
-        numUsersCommon = 0
-        i = 0
-        j = 0
-        while i < len(reviews1) and j < len(reviews2):
-            userId1 = reviews1[i][1]
-            userId2 = reviews2[j][1]
-            if userId1 < userId2:
-                i += 1
-            elif userId1 > userId2:
-                j += 1
-            else:
-                time1 = reviews1[i][0]
-                time2 = reviews2[j][0]
-                if time1 == time2:
-                    i += 1
-                    j += 1
-                    continue # ignore duplicate reviews
-                numUsersCommon += 1
-                rating1 = reviews1[i][2] - bias1
-                rating2 = reviews2[j][2] - bias2
-                # randomly shuffle ratings
-                if random.random() < 0.5:
-                    ratingA = rating1
-                    ratingB = rating2
-                else:
-                    ratingA = rating2
-                    ratingB = rating1
-                incrementHistogram(histogram, minRating, stepRating, numBins,
-                                   ratingA, ratingB)
-                i += 1
-                j += 1
+                       ratings1, ratings2):
+    maxRating = minRating + numBins*stepRating
+    valid = (ratings1 >= minRating) & (ratings1 < maxRating) &\
+            (ratings2 >= minRating) & (ratings2 < maxRating)
+    # round half away from zero, as round() does
+    idx1 = np.floor((ratings1[valid] - minRating)/stepRating + 0.5)
+    idx2 = np.floor((ratings2[valid] - minRating)/stepRating + 0.5)
+    idx1 = np.minimum(idx1.astype(np.int64), numBins - 1)
+    idx2 = np.minimum(idx2.astype(np.int64), numBins - 1)
+    np.add.at(histogram, (idx1, idx2), 1)
+
+def initWorker(db_fname, numBins, workerIdx):
+    # forked workers start with the same random state
+    np.random.seed()
+    # connect to db
+    db_conn = sqlite3.connect(db_fname, dbTimeout)
+    histogram = np.zeros((numBins, numBins), dtype=np.int64)
+    return (db_conn, histogram)
+
+def finishWorker(state):
+    db_conn, histogram = state
+    db_conn.close()
+    return histogram
+
+def fillHistogram(store, cache, minRating, stepRating, numBins, state, pair):
+    db_conn, histogram = state
+    productId1, productId2 = pair
+    print >> sys.stderr, 'Processing %s, %s . . .' % (productId1, productId2)
+    ratingPair = ratingPairs.getCachedRatingPair(db_conn.cursor(), store,
+                                                 cache, productId1, productId2)
+    # randomly shuffle ratings
+    swap = np.random.random(len(ratingPair)) < 0.5
+    ratingsA = np.where(swap, ratingPair.ratings2, ratingPair.ratings1)
+    ratingsB = np.where(swap, ratingPair.ratings1, ratingPair.ratings2)
+    incrementHistogram(histogram, minRating, stepRating, numBins,
+                       ratingsA, ratingsB)
 
 def printHistogram(writer, histogram, minRating, stepRating, numBins):
     for i in range(numBins):
@@ -117,17 +103,28 @@ def main():
     print >> sys.stderr, 'Connect to %s . . .' % options.db_fname
     db_conn = sqlite3.connect(options.db_fname, dbTimeout)
 
-    # Open input file
-    print >> sys.stderr, 'Reading from %s . . .' % inputFileName
-    inputfile = open(inputFileName, 'r')
+    # Open review store
+    store = reviewStore.openStore(options.storeDir)
 
-    # Initialize histogram
-    histogram = [[0 for x in xrange(options.numBins)]\
-                    for x in xrange(options.numBins)]
+    # Open rating pair cache
+    if options.cacheDir:
+        cache = ratingPairs.openCache(db_conn, inputFileName,
+                                      options.cacheDir, store=store)
+    else:
+        cache = None
 
-    # Fill histogram
-    fillHistogram(db_conn, inputfile, histogram,
-                  options.minRating, options.stepRating, options.numBins)
+    # Open input file
+    print >> sys.stderr, 'Reading from %s . . .' % inputFileName
+    with open(inputFileName, 'r') as inputfile:
+        # Fill histograms in worker processes
+        stats = executor.run(executor.readPairs(inputfile),
+            functools.partial(fillHistogram, store, cache, options.minRating,
+                              options.stepRating, options.numBins),
+            numWorkers=options.numWorkers,
+            initWorker=functools.partial(initWorker, options.db_fname,
+                                         options.numBins),
+            finishWorker=finishWorker)
+    histogram = sum(s['result'] for s in stats)
 
     # Print histogram
     writer = csv.writer(sys.stdout)
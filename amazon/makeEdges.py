@@ -5,17 +5,15 @@ Creates edge records with cosine similarities and number of common users
 as per user-item collaborative filtering.
 """
 
-import multiprocessing as mp
-import Queue
 from optparse import OptionParser
+import functools
 import sqlite3
 import csv
 import os
+import sys
 import math
 
-# params
-workerTimeout = 30
-workerQueueSize = 1000
+import executor
 
 # db params
 dbTimeout = 5
@@ -85,7 +83,7 @@ def computeSim(reviewsA, reviewsB):
         varA += scoreA**2
         i += 1
     while j < len(reviewsB):
-        scoreB = reviewsB[i][1]
+        scoreB = reviewsB[j][1]
         varB += scoreB**2
         j += 1
     if innerProd == 0:
@@ -95,57 +93,36 @@ def computeSim(reviewsA, reviewsB):
         return (cosineSim, numUsersCommon)
 
 
-def worker(workerIdx, q, db_fname, minUsers, outputFileName):
-    num_writes = 0
-    num_skips = 0
+def initWorker(db_fname, outputDir, workerIdx):
     # connect to db
     db_conn = sqlite3.connect(db_fname, dbTimeout)
-    db_curs = db_conn.cursor()
-
+    outputFileName = os.path.join(outputDir,
+        '%s_%d.out' % (os.path.splitext(os.path.basename(__file__))[0],
+                       workerIdx))
     print 'Writing to %s . . .' % outputFileName
-    with open(outputFileName, 'wb') as csvfile:
-        writer = csv.writer(csvfile)
-        # TODO: Need a terminal condition here.
-        while True:
-            (productId1, productId2) = q.get()
-            db_curs.execute(selectReviewsStmt, (productId1,))
-            reviews1 = [(row[0], row[1], row[2], row[3])\
-                        for row in db_curs.fetchall()]
-            db_curs.execute(selectReviewsStmt, (productId2,))
-            reviews2 = [(row[0], row[1], row[2], row[3])\
-                        for row in db_curs.fetchall()]
-            cosineSim, numUsersCommon = computeSim(reviews1, reviews2)
-            if numUsers < minUsers:
-                num_skips += 1
-                continue # skip when below minUsers threshold
-            if cosineSim == 0:
-                num_skips += 1
-                continue # skip zero similarity edges
-            writer.writerow([productId1, productId2, cosineSim,
-                             numUsersCommon, len(reviews1), len(reviews2)])
-            num_writes += 1
-
-
-def master(inputfile, queues, workers):
-    i = 0
-    for line in inputfile:
-        tokens = line.split(',')
-        productId1 = tokens[0].strip()
-        productId2 = tokens[1].strip()
-        workerIdx = i % len(workers)
-       
-        while True:
-            try:
-                queues[workerIdx].put((productId1, productId2),
-                                      timeout=workerTimeout)
-                break
-            except Queue.Full:
-                print 'WARNING: Worker Queue Full!'
-        i += 1
-
-    # close queues
-    for q in queues:
-        q.close()
+    csvfile = open(outputFileName, 'wb')
+    return (db_conn.cursor(), csvfile, csv.writer(csvfile))
+
+def finishWorker(state):
+    db_curs, csvfile, writer = state
+    csvfile.close()
+
+def processPair(minUsers, state, pair):
+    db_curs, csvfile, writer = state
+    productId1, productId2 = pair
+    db_curs.execute(selectReviewsStmt, (productId1,))
+    reviews1 = [(row[0], row[1], row[2], row[3])\
+                for row in db_curs.fetchall()]
+    db_curs.execute(selectReviewsStmt, (productId2,))
+    reviews2 = [(row[0], row[1], row[2], row[3])\
+                for row in db_curs.fetchall()]
+    cosineSim, numUsersCommon = computeSim(reviews1, reviews2)
+    if numUsersCommon < minUsers:
+        return # skip when below minUsers threshold
+    if cosineSim == 0:
+        return # skip zero similarity edges
+    writer.writerow([productId1, productId2, cosineSim,
+                     numUsersCommon, len(reviews1), len(reviews2)])
 
 
 def main():
@@ -160,29 +137,16 @@ def main():
         print >> sys.stderr, 'Cannot find: %s' % inputfilename
         return
 
-    # create queues
-    queues = []
-    for w in range(options.numWorkers):
-        queues.append(mp.Queue(workerQueueSize))
-
-    # create worker processes
-    workers = []
-    for w in range(options.numWorkers):
-        outputFileName = os.path.join(options.outputDir,
-            '%s_%d.out' % (os.path.splitext(os.path.basename(__file__))[0], w))
-        workers.append(mp.Process(target=worker,
-            args=(w, queues[w], options.db_fname, options.minUsers,
-                  outputFileName)))
-
-    # start worker processes
-    for w in range(options.numWorkers):
-        workers[w].start()
-
     # open input file
     print 'Reading from %s. . .' % inputfilename
     with open(inputfilename, 'r') as inputfile:
-        # do master task
-        master(inputfile, queues, workers)
+        # process pairs in worker processes
+        executor.run(executor.readPairs(inputfile),
+            functools.partial(processPair, options.minUsers),
+            numWorkers=options.numWorkers,
+            initWorker=functools.partial(initWorker, options.db_fname,
+                                         options.outputDir),
+            finishWorker=finishWorker)
 
 if __name__ == '__main__':
     main()
@@ -6,31 +6,38 @@ Compute the average similarity scores associated with rating pairs.
 
 from optparse import OptionParser
 import sqlite3
-import numpy
-import csv
+import numpy as np
 import os
 import sys
-import collections
 
 import similarity
+import reviewStore
+import ratingPairs
+import executor
 from SimilarityGrid import SimilarityGrid
 
 # db params
 dbTimeout = 5
-selectReviewsStmt =\
-    ('SELECT Time, UserId, AdjustedScore '
-     'FROM Reviews '
-     'WHERE ProductId = :ProductId '
-     'ORDER BY UserId')
 
 def getParser(usage=None):
     parser = OptionParser(usage=usage)
     parser.add_option('-d', '--database', dest='db_fname',
         default='data/amazon.db', help='sqlite3 database file.', metavar='FILE')
+    parser.add_option('--reviewStore', dest='storeDir', default=None,
+        help='Review store directory built by reviewStore.py.', metavar='DIR')
+    parser.add_option('--cache', dest='cacheDir', default=None,
+        help='Rating pair cache directory (see ratingPairs.py).',
+        metavar='DIR')
     parser.add_option('-c', '--cosineFunc', dest='cosineFunc',
         default='randSim',
         help='Similarity function to use: "prefSim" or "randSim" (default)',
         metavar='FUNCNAME')
+    parser.add_option('--errorFileName', dest='errorFileName',
+        default='output/aggregatePredictions_modelSim.csv',
+        help='User prediction errors file for weightedRandSim.',
+        metavar='FILE')
+    parser.add_option('--epsilon', dest='epsilon', type='float', default=0.01,
+        help='Parameter epsilon for weightedRandSim.', metavar='FLOAT')
     parser.add_option('--minRating', type='float', dest='minRating',
         default=-2.0, help='Minimum rating.', metavar='FLOAT')
     parser.add_option('--maxRating', type='float', dest='maxRating',
@@ -39,53 +46,22 @@ def getParser(usage=None):
         default=0.1, help='Step rating.', metavar='FLOAT')
     return parser
 
-def fillGrid(db_conn, inputfile, cosineFunc, simGrid):
-    count = 0
-    bad_keys = 0
-    db_curs = db_conn.cursor()
-    for line in inputfile:
-        tokens = line.split(',')
-        productId1 = tokens[0].strip()
-        productId2 = tokens[1].strip()
-        print >> sys.stderr, '%s, %s' % (productId1, productId2)
-        # fetch product reviews
-        db_curs.execute(selectReviewsStmt, (productId1,))
-        reviews1 = [row for row in db_curs.fetchall()]
-        db_curs.execute(selectReviewsStmt, (productId2,))
-        reviews2 = [row for row in db_curs.fetchall()]
+def fillGrid(pairs, cosineFunc, simGrid):
+    ratings1 = [np.zeros(0)]
+    ratings2 = [np.zeros(0)]
+    sims = [np.zeros(0)]
+    for ratingPair in pairs:
+        print >> sys.stderr, '%s, %s' %\
+                             (ratingPair.productId1, ratingPair.productId2)
         # compute cosine similarity using the provided function.
-        cosineSim, numUserCommon = cosineFunc(reviews1, reviews2)
-        # compute product biases
-        bias1 = numpy.mean([review[2] for review in reviews1])
-        bias2 = numpy.mean([review[2] for review in reviews2])
-        # update grid
-        i = 0
-        j = 0
-        while i < len(reviews1) and j < len(reviews2):
-            userId1 = reviews1[i][1]
-            userId2 = reviews2[j][1]
-            if userId1 < userId2:
-                i += 1
-            elif userId1 > userId2:
-                j += 1
-            else:
-                time1 = reviews1[i][0]
-                time2 = reviews2[j][0]
-                if time1 == time2:
-                    i += 1
-                    j += 1
-                    continue # ignore duplicate reviews
-                rating1 = reviews1[i][2] - bias1
-                rating2 = reviews2[j][2] - bias2
-                #print 'rating1 = %0.3f, rating2 = %0.3f' % (rating1, rating2)
-                if simGrid[(rating1, rating2)]:
-                    count += 1
-                    simGrid[(rating1, rating2)][0] += cosineSim
-                    simGrid[(rating1, rating2)][1] += 1
-                else:
-                    bad_keys += 1
-                i += 1
-                j += 1
+        cosineSim, numUserCommon = ratingPair.cosineSim(cosineFunc)
+        # collect rating pairs
+        ratings1.append(ratingPair.ratings1)
+        ratings2.append(ratingPair.ratings2)
+        sims.append(np.repeat(cosineSim, len(ratingPair)))
+    # update grid with all rating pairs at once
+    bad_keys = simGrid.add(np.concatenate(ratings1), np.concatenate(ratings2),
+                           np.concatenate(sims))
     print >> sys.stderr, '%d Bad Keys.' % bad_keys
 
 def main():
@@ -99,27 +75,40 @@ def main():
     if not os.path.isfile(inputFileName):
         print >> sys.stderr, 'Cannot find input file: %s' % inputFileName
         return
-    try:
-        cosineFunc = getattr(similarity, options.cosineFunc)
-    except KeyError:
+    if options.cosineFunc not in similarity.batchCosineFuncs:
         print >> sys.stderr,\
             'Invalid Similarity function: %s' % options.cosineFunc
         return
 
+    # weighted similarity
+    if options.cosineFunc == 'weightedRandSim':
+        similarity.initWeightedSim(options.errorFileName, options.epsilon)
+
     # Initialize similarity grid
     simGrid = SimilarityGrid(options.minRating, options.maxRating,
                              options.stepRating)
 
-    # Open input file
-    print >> sys.stderr, 'Reading from %s . . .' % inputFileName
-    inputfile = open(inputFileName, 'r')
-
     # Connect to db
     print >> sys.stderr, 'Connect to %s . . .' % options.db_fname
     db_conn = sqlite3.connect(options.db_fname, dbTimeout)
 
-    # Fill similarity grid
-    fillGrid(db_conn, inputfile, cosineFunc, simGrid)
+    # Open review store
+    store = reviewStore.openStore(options.storeDir)
+
+    # Open rating pair cache
+    if options.cacheDir:
+        cache = ratingPairs.openCache(db_conn, inputFileName,
+                                      options.cacheDir, store=store)
+    else:
+        cache = None
+
+    # Open input file
+    print >> sys.stderr, 'Reading from %s . . .' % inputFileName
+    with open(inputFileName, 'r') as inputfile:
+        # Fill similarity grid
+        fillGrid(ratingPairs.iterRatingPairs(db_conn,
+                     executor.readPairs(inputfile), store=store, cache=cache),
+                 options.cosineFunc, simGrid)
 
     # Write similarity grid to stdout
     simGrid.writeToFile(sys.stdout)
@@ -0,0 +1,391 @@
+#!/usr/local/bin/python
+
+"""
+Computes Similarities records for all product pairs with common reviewers in a
+single command, in place of nonzeroSims.py, sort | uniq and edgeIngest.py.
+
+Bias-adjusted scores (as used by edgeIngest.py) are loaded into a sparse
+user x product matrix X, and B is the binary pattern of X. Products are split
+into blocks sized to fit a memory budget, and worker processes compute
+X_b^T X and B_b^T B for their block b, which give the inner products and
+numbers of common users of every pair with a product in b. Workers are forked
+after the matrices are loaded, so they share them copy-on-write.
+
+The rowid of the last review included is kept in Globals, so that after new
+reviews are ingested (and computeBiases.py -i has been run) the incremental
+mode only recomputes the pairs whose similarities may have changed. New
+reviews change the biases of their users, and so the scores of every product
+those users reviewed; only pairs with such a product are recomputed, by
+loading the products that share a reviewer with them, computing the blocks
+of the changed products and replacing their rows of Similarities.
+"""
+
+import multiprocessing as mp
+from optparse import OptionParser
+import sqlite3
+import numpy as np
+import scipy.sparse as sp
+
+import reviewStore
+
+# params
+fetchSize = 100000
+bytesPerEntry = 48 # per entry of a block product, including temporaries
+
+# db params
+dbTimeout = 5
+createSimilaritiesTableStmt =\
+    ('CREATE TABLE IF NOT EXISTS Similarities(ProductId1 INT, ProductId2 INT, '
+     'CosineSim REAL, ExtJaccard REAL, NumUsers INT, PRIMARY KEY(ProductId1, '
+     'ProductId2), FOREIGN KEY(ProductId1) REFERENCES Products(ProductId), '
+     'FOREIGN KEY(ProductId2) REFERENCES Products(ProductId))')
+createUserIndexStmt =\
+    'CREATE INDEX IF NOT EXISTS Reviews_UserId_Idx ON Reviews(UserId)'
+createProductId2IndexStmt =\
+    ('CREATE INDEX IF NOT EXISTS Similarities_ProductId2_Idx ON '
+     'Similarities(ProductId2)')
+selectGlobalBiasStmt = 'SELECT Value FROM Globals WHERE Key = "Bias"'
+selectGlobalStmt = 'SELECT Value FROM Globals WHERE Key = :Key'
+deleteGlobalStmt = 'DELETE FROM Globals WHERE Key = :Key'
+insertGlobalStmt = 'INSERT INTO Globals (Key, Value) VALUES (:Key, :Value)'
+rowidKey = 'SimilaritiesRowid'
+selectMaxRowidStmt = 'SELECT max(rowid) FROM Reviews'
+selectNumNewReviewsStmt = 'SELECT count(*) FROM Reviews WHERE rowid > :Rowid'
+selectNumUnbiasedStmt =\
+    ('SELECT count(*) FROM Reviews '
+     'WHERE rowid > :Rowid AND AdjustedScore IS NULL')
+createTouchedUsersTableStmt =\
+    ('CREATE TEMP TABLE TouchedUsers AS '
+     'SELECT DISTINCT UserId FROM Reviews WHERE rowid > :Rowid')
+createTouchedProductsTableStmt =\
+    ('CREATE TEMP TABLE TouchedProducts AS '
+     'SELECT DISTINCT R.ProductId '
+     'FROM TouchedUsers AS T, Reviews AS R '
+     'WHERE R.UserId = T.UserId')
+createAffectedUsersTableStmt =\
+    ('CREATE TEMP TABLE AffectedUsers AS '
+     'SELECT DISTINCT R.UserId '
+     'FROM TouchedProducts AS T, Reviews AS R '
+     'WHERE R.ProductId = T.ProductId')
+createAffectedProductsTableStmt =\
+    ('CREATE TEMP TABLE AffectedProducts AS '
+     'SELECT DISTINCT R.ProductId '
+     'FROM AffectedUsers AS A, Reviews AS R '
+     'WHERE R.UserId = A.UserId')
+selectTouchedProductsStmt = 'SELECT ProductId FROM TouchedProducts'
+selectScoresStmt =\
+    ('SELECT R.ProductId, R.UserId, R.Score - PB.Bias - UB.Bias '
+     'FROM Reviews AS R, ProductBiases AS PB, UserBiases AS UB '
+     'WHERE R.ProductId = PB.ProductId '
+     'AND R.UserId = UB.UserId')
+selectAffectedScoresStmt =\
+    ('SELECT R.ProductId, R.UserId, R.Score - PB.Bias - UB.Bias '
+     'FROM AffectedProducts AS A, Reviews AS R, ProductBiases AS PB, '
+     'UserBiases AS UB '
+     'WHERE R.ProductId = A.ProductId '
+     'AND R.ProductId = PB.ProductId '
+     'AND R.UserId = UB.UserId')
+insertSimilarityStmt =\
+    ('INSERT OR IGNORE INTO Similarities (ProductId1, ProductId2, CosineSim, '
+     'ExtJaccard, NumUsers) VALUES (:ProductId1, :ProductId2, :CosineSim, '
+     ':ExtJaccard, :NumUsers)')
+upsertSimilarityStmt =\
+    ('INSERT OR REPLACE INTO Similarities (ProductId1, ProductId2, CosineSim, '
+     'ExtJaccard, NumUsers) VALUES (:ProductId1, :ProductId2, :CosineSim, '
+     ':ExtJaccard, :NumUsers)')
+deleteTouchedSimilarities1Stmt =\
+    ('DELETE FROM Similarities '
+     'WHERE ProductId1 IN (SELECT ProductId FROM TouchedProducts)')
+deleteTouchedSimilarities2Stmt =\
+    ('DELETE FROM Similarities '
+     'WHERE ProductId2 IN (SELECT ProductId FROM TouchedProducts)')
+
+# matrices shared with worker processes
+X = None
+B = None
+norms = None
+minUsers = 1
+
+def getParser(usage=None):
+    parser = OptionParser(usage=usage)
+    parser.add_option('-d', '--database', dest='db_fname',
+        default='data/amazon.db', help='sqlite3 database file.', metavar='FILE')
+    parser.add_option('--reviewStore', dest='storeDir', default=None,
+        help=('Review store directory built by reviewStore.py. If given, '
+              'scores are read from the store instead of the database.'),
+        metavar='DIR')
+    parser.add_option('-w', '--numWorkers', dest='numWorkers', type='int',
+        default=1, help='Number of worker processes.', metavar='NUM')
+    parser.add_option('-m', '--minUsers', dest='minUsers', type='int',
+        default=1, help='Minimum number of users for a similarity.',
+        metavar='NUM')
+    parser.add_option('--memory', dest='memory', type='int', default=1024,
+        help='Memory budget per worker for one block, in MB.', metavar='MB')
+    parser.add_option('-i', '--incremental', action='store_true',
+        dest='incremental', default=False,
+        help=('Only recompute the similarities of products reviewed by users '
+              'with reviews added since the last run.'))
+    return parser
+
+def getLastRowid(db_curs):
+    """Returns the rowid of the last review included in Similarities, or None
+       if it was not recorded.
+    """
+    db_curs.execute(selectGlobalStmt, (rowidKey,))
+    row = db_curs.fetchone()
+    if row is None:
+        return None
+    return int(row[0])
+
+def setLastRowid(db_curs, rowid):
+    db_curs.execute(deleteGlobalStmt, (rowidKey,))
+    db_curs.execute(insertGlobalStmt, (rowidKey, str(rowid)))
+
+def getMaxRowid(db_curs):
+    db_curs.execute(selectMaxRowidStmt)
+    rowid = db_curs.fetchone()[0]
+    if rowid is None:
+        return 0
+    return rowid
+
+def loadScoresFromDb(db_conn, stmt=selectScoresStmt):
+    """Returns (productIds, X) with products in ProductId order."""
+    db_curs = db_conn.cursor()
+    db_curs.execute(selectGlobalBiasStmt)
+    globalBias = float(db_curs.fetchone()[0])
+    print 'Global Bias = %.3f' % globalBias
+    productCodes = {}
+    userCodes = {}
+    cols = []
+    rows = []
+    vals = []
+    db_curs.execute(stmt)
+    while True:
+        chunk = db_curs.fetchmany(fetchSize)
+        if not chunk:
+            break
+        cols.append(np.array([productCodes.setdefault(row[0], len(productCodes))
+                              for row in chunk], dtype=np.int32))
+        rows.append(np.array([userCodes.setdefault(row[1], len(userCodes))
+                              for row in chunk], dtype=np.int32))
+        vals.append(np.array([row[2] for row in chunk]) - globalBias)
+    # renumber products in ProductId order
+    productIds = sorted(productCodes)
+    rank = np.empty(len(productIds), dtype=np.int32)
+    for i in range(len(productIds)):
+        rank[productCodes[productIds[i]]] = i
+    cols = rank[np.concatenate(cols)] if cols else np.zeros(0, dtype=np.int32)
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int32)
+    vals = np.concatenate(vals) if vals else np.zeros(0)
+    X = sp.csc_matrix((vals, (rows, cols)),
+                      shape=(len(userCodes), len(productIds)))
+    return productIds, X
+
+def loadScoresFromStore(store):
+    """Returns (productIds, X) with scores centered on product biases."""
+    lens = np.diff(store.offsets)
+    seg = np.repeat(np.arange(len(lens)), lens)
+    scores = np.asarray(store.scores, dtype=np.float64)
+    biases = np.bincount(seg, scores, minlength=len(lens)) / np.maximum(lens, 1)
+    X = sp.csc_matrix((scores - biases[seg], np.asarray(store.userCodes),
+                       np.asarray(store.offsets)),
+                      shape=(len(store.userIds), len(store.productIds)))
+    return store.productIds.tolist(), X
+
+def getBlocks(B, memory):
+    """Splits products into contiguous blocks whose products X_b^T X fit in
+       memory bytes, bounding the nonzeros of row a by the sum over the
+       reviewers of a of their numbers of reviews.
+    """
+    userDegrees = np.asarray(B.sum(axis=0)).ravel()
+    rowBounds = B.dot(userDegrees)
+    maxEntries = max(1, memory / bytesPerEntry)
+    blocks = []
+    begin = 0
+    total = 0
+    for a in range(len(rowBounds)):
+        if a > begin and total + rowBounds[a] > maxEntries:
+            blocks.append((begin, a))
+            begin = a
+            total = 0
+        total += rowBounds[a]
+    if begin < len(rowBounds):
+        blocks.append((begin, len(rowBounds)))
+    return blocks
+
+def computeBlock(block):
+    """Returns (productIdx1, productIdx2, cosineSim, extJaccard, numUsers)
+       arrays for the pairs (a, b) with a in block, a < b, at least minUsers
+       common users and a nonzero inner product.
+    """
+    begin, end = block
+    common = B[begin:end].dot(B.T).tocoo()
+    idx = (common.col > common.row + begin) & (common.data >= minUsers)
+    rows = common.row[idx]
+    cols = common.col[idx]
+    numUsers = common.data[idx].astype(np.int64)
+    # look up inner products, which are missing where they sum to zero
+    inner = X[begin:end].dot(X.T).tocsr()
+    inner.sort_indices()
+    innerKeys = np.repeat(np.arange(end - begin, dtype=np.int64),
+                          np.diff(inner.indptr))*X.shape[0] + inner.indices
+    keys = rows.astype(np.int64)*X.shape[0] + cols
+    pos = np.minimum(np.searchsorted(innerKeys, keys),
+                     max(len(innerKeys) - 1, 0))
+    if len(innerKeys):
+        innerProd = np.where(innerKeys[pos] == keys, inner.data[pos], 0.0)
+    else:
+        innerProd = np.zeros(len(keys))
+    idx = innerProd != 0
+    rows = rows[idx] + begin
+    cols = cols[idx]
+    innerProd = innerProd[idx]
+    varA = norms[rows]
+    varB = norms[cols]
+    cosineSim = innerProd/(np.sqrt(varA)*np.sqrt(varB))
+    extJaccard = innerProd/(varA + varB - innerProd)
+    return rows, cols, cosineSim, extJaccard, numUsers[idx]
+
+def setMatrices(XT):
+    """Sets the matrices shared with worker processes from the user x product
+       matrix XT.
+    """
+    global X
+    global B
+    global norms
+    # store products as rows for fast block slicing
+    X = XT.T.tocsr()
+    B = X.copy()
+    B.data = np.ones(len(B.data))
+    norms = np.asarray(X.multiply(X).sum(axis=1)).ravel()
+
+def getSimilarityRows(productIds, rows, cols, cosineSim, extJaccard, numUsers):
+    for k in range(len(rows)):
+        productId1 = productIds[rows[k]]
+        productId2 = productIds[cols[k]]
+        if productId1 > productId2:
+            productId1, productId2 = productId2, productId1
+        yield (productId1, productId2, cosineSim[k], extJaccard[k],
+               int(numUsers[k]))
+
+def insertBlocks(db_conn, productIds, blocks, stmt, numWorkers):
+    """Computes blocks in worker processes forked after loading and inserts
+       their similarities with stmt, committing after each block.
+    """
+    db_curs = db_conn.cursor()
+    pool = mp.Pool(numWorkers)
+    num_inserts = 0
+    for rows, cols, cosineSim, extJaccard, numUsers in\
+            pool.imap_unordered(computeBlock, blocks):
+        db_curs.executemany(stmt,
+            getSimilarityRows(productIds, rows, cols, cosineSim, extJaccard,
+                              numUsers))
+        db_conn.commit()
+        num_inserts += len(rows)
+        print '%d Similarities computed' % num_inserts
+    pool.close()
+    pool.join()
+    return num_inserts
+
+def computeAll(db_conn, options):
+    db_curs = db_conn.cursor()
+    # load scores
+    print 'Loading scores . . .'
+    store = reviewStore.openStore(options.storeDir)
+    if store is not None:
+        productIds, XT = loadScoresFromStore(store)
+        maxRowid = None
+    else:
+        maxRowid = getMaxRowid(db_curs)
+        productIds, XT = loadScoresFromDb(db_conn)
+    print '%d products, %d users, %d scores' %\
+        (XT.shape[1], XT.shape[0], XT.nnz)
+    setMatrices(XT)
+    blocks = getBlocks(B, options.memory*1024*1024)
+    print '%d blocks' % len(blocks)
+    insertBlocks(db_conn, productIds, blocks, insertSimilarityStmt,
+                 options.numWorkers)
+    # remember the reviews included, unless they came from a review store
+    if maxRowid is not None:
+        setLastRowid(db_curs, maxRowid)
+        db_conn.commit()
+
+def computeIncremental(db_conn, options):
+    db_curs = db_conn.cursor()
+    lastRowid = getLastRowid(db_curs)
+    if lastRowid is None:
+        print 'No previous Similarities found.'
+        computeAll(db_conn, options)
+        return
+    maxRowid = getMaxRowid(db_curs)
+    db_curs.execute(selectNumNewReviewsStmt, (lastRowid,))
+    numNewReviews = db_curs.fetchone()[0]
+    print '%d new reviews' % numNewReviews
+    if numNewReviews == 0:
+        return
+    db_curs.execute(selectNumUnbiasedStmt, (lastRowid,))
+    if db_curs.fetchone()[0] > 0:
+        print 'Biases are out of date, run computeBiases.py -i first.'
+        return
+
+    # find products whose scores changed and products sharing reviewers
+    print 'Finding affected products . . .'
+    db_curs.execute(createUserIndexStmt)
+    db_curs.execute(createProductId2IndexStmt)
+    db_curs.execute(createTouchedUsersTableStmt, (lastRowid,))
+    db_curs.execute(createTouchedProductsTableStmt)
+    db_curs.execute(createAffectedUsersTableStmt)
+    db_curs.execute(createAffectedProductsTableStmt)
+    db_curs.execute(selectTouchedProductsStmt)
+    touchedProductIds = set([row[0] for row in db_curs.fetchall()])
+
+    # load scores of affected products, with touched products first
+    print 'Loading scores . . .'
+    productIds, XT = loadScoresFromDb(db_conn, selectAffectedScoresStmt)
+    order = [i for i in range(len(productIds))
+             if productIds[i] in touchedProductIds]
+    numTouched = len(order)
+    order += [i for i in range(len(productIds))
+              if productIds[i] not in touchedProductIds]
+    productIds = [productIds[i] for i in order]
+    XT = XT[:,order]
+    print '%d changed products, %d products, %d users, %d scores' %\
+        (numTouched, XT.shape[1], XT.shape[0], XT.nnz)
+    setMatrices(XT)
+    # blocks of touched products give all pairs with a touched product
+    blocks = [(begin, min(end, numTouched)) for (begin, end) in
+              getBlocks(B, options.memory*1024*1024) if begin < numTouched]
+    print '%d blocks' % len(blocks)
+
+    # replace the rows of touched products
+    db_curs.execute(deleteTouchedSimilarities1Stmt)
+    db_curs.execute(deleteTouchedSimilarities2Stmt)
+    insertBlocks(db_conn, productIds, blocks, upsertSimilarityStmt,
+                 options.numWorkers)
+    setLastRowid(db_curs, maxRowid)
+    db_conn.commit()
+
+def main():
+    global minUsers
+
+    # Parse options
+    usage = 'Usage: %prog [options]'
+    parser = getParser(usage=usage)
+    (options, args) = parser.parse_args()
+    minUsers = options.minUsers
+    if options.incremental and options.storeDir:
+        parser.error('--reviewStore cannot be used with --incremental')
+
+    # connect to db
+    print 'Connecting to %s. . .' % options.db_fname
+    db_conn = sqlite3.connect(options.db_fname, dbTimeout)
+    db_curs = db_conn.cursor()
+    # create Similarities table if not already exists
+    db_curs.execute(createSimilaritiesTableStmt)
+    if options.incremental:
+        computeIncremental(db_conn, options)
+    else:
+        computeAll(db_conn, options)
+
+if __name__ == '__main__':
+    main()
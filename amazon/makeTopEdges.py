@@ -3,6 +3,10 @@
 """
 Make csv containing product pairs for which we have the most information about
 their similarity as per user-item collaborative filtering.
+
+Pairs are selected by joining Similarities to StoreProducts for both products
+in SQL. With several stores, one scan of Similarities in NumUsers order feeds
+one file per store and stops when every store has its limit of edges.
 """
 
 from optparse import OptionParser
@@ -12,6 +16,8 @@ import csv
 
 # params
 outputFileTemplate = '%s.csv'
+storeOutputFileTemplate = '%s_%d.csv'
+fetchSize = 1000
 
 # db params
 createSimilaritiesNumUsersIndexStmt =\
@@ -20,12 +26,26 @@ createSimilaritiesNumUsersIndexStmt =\
 createStoreProductsProductIdIndexStmt =\
     ('CREATE INDEX IF NOT EXISTS StoreProducts_ProductId_Idx ON '
      'StoreProducts(ProductId)')
-selectSimilaritiesStmt =\
-    ('SELECT ProductId1, ProductId2, CosineSim, NumUsers '
-     'FROM Similarities '
-     'ORDER BY NumUsers DESC')
-selectStoreProductsStmt =\
-    'SELECT StoreId FROM StoreProducts WHERE ProductId = :ProductId'
+selectStoreSimilaritiesStmt =\
+    ('SELECT S.ProductId1, S.ProductId2, S.CosineSim, S.NumUsers '
+     'FROM Similarities AS S, StoreProducts AS SP1, StoreProducts AS SP2 '
+     'WHERE SP1.StoreId = :StoreId '
+     'AND SP1.ProductId = S.ProductId1 '
+     'AND SP2.StoreId = :StoreId '
+     'AND SP2.ProductId = S.ProductId2 '
+     'ORDER BY S.NumUsers DESC, S.ProductId1, S.ProductId2 '
+     'LIMIT :Limit')
+# scan Similarities in NumUsers order, probing StoreProducts for each row
+selectStoresSimilaritiesStmt =\
+    ('SELECT SP1.StoreId, S.ProductId1, S.ProductId2, S.CosineSim, '
+     'S.NumUsers '
+     'FROM Similarities AS S CROSS JOIN StoreProducts AS SP1 '
+     'CROSS JOIN StoreProducts AS SP2 '
+     'WHERE SP1.StoreId IN (%s) '
+     'AND SP1.ProductId = S.ProductId1 '
+     'AND SP2.StoreId = SP1.StoreId '
+     'AND SP2.ProductId = S.ProductId2 '
+     'ORDER BY S.NumUsers DESC, S.ProductId1, S.ProductId2')
 
 def getParser(usage=None):
     parser = OptionParser(usage=usage)
@@ -35,15 +55,70 @@ def getParser(usage=None):
         help='Output directory.', metavar='DIR')
     parser.add_option('-l', '--limit', dest='limit', type='int', default=100,
         help='Limit to the number of edges made.', metavar='NUM')
-    parser.add_option('-s', '--storeId', dest='storeId', type='int', default=1,
-        help='StoreId from which to select edges.', metavar='ID')
+    parser.add_option('-s', '--storeId', dest='storeIds', default='1',
+        help=('StoreId from which to select edges, or a comma-separated list '
+              'of StoreIds to make one file each.'), metavar='IDS')
     return parser
 
+def iterRows(db_curs):
+    """Yields the rows of the executed statement, fetched in batches."""
+    while True:
+        rows = db_curs.fetchmany()
+        if not rows:
+            break
+        for row in rows:
+            yield row
+
+def writeStoreEdges(db_conn, storeId, limit, outputFileName):
+    print 'Writing to %s . . .' % outputFileName
+    with open(outputFileName, 'wb') as csvfile:
+        writer = csv.writer(csvfile)
+        db_curs = db_conn.cursor()
+        db_curs.arraysize = fetchSize
+        db_curs.execute(selectStoreSimilaritiesStmt,
+                        {'StoreId': storeId, 'Limit': limit})
+        for row in iterRows(db_curs):
+            # output edge
+            writer.writerow(list(row))
+
+def writeStoresEdges(db_conn, storeIds, limit, outputFileNames):
+    csvfiles = {}
+    writers = {}
+    for storeId in storeIds:
+        print 'Writing to %s . . .' % outputFileNames[storeId]
+        csvfiles[storeId] = open(outputFileNames[storeId], 'wb')
+        writers[storeId] = csv.writer(csvfiles[storeId])
+    num_writes = dict((storeId, 0) for storeId in storeIds)
+    num_full = 0
+    db_curs = db_conn.cursor()
+    db_curs.arraysize = fetchSize
+    db_curs.execute(selectStoresSimilaritiesStmt %
+                    ', '.join(['?']*len(storeIds)), storeIds)
+    for row in iterRows(db_curs):
+        storeId = row[0]
+        if num_writes[storeId] >= limit:
+            continue
+        # output edge
+        writers[storeId].writerow(list(row[1:]))
+        num_writes[storeId] += 1
+        if num_writes[storeId] == limit:
+            num_full += 1
+            if num_full == len(storeIds):
+                break
+    for storeId in storeIds:
+        csvfiles[storeId].close()
+
 def main():
     # Parse options
     usage = 'Usage: %prog [options]'
     parser = getParser(usage=usage)
     (options, args) = parser.parse_args()
+    try:
+        storeIds = [int(storeId) for storeId in options.storeIds.split(',')]
+    except ValueError:
+        parser.error('Invalid StoreIds: %s' % options.storeIds)
+    # ignore repeated StoreIds
+    storeIds = sorted(set(storeIds))
 
     # connect to db
     print 'Connecting to %s. . .' % options.db_fname
@@ -54,33 +129,16 @@ def main():
         db_curs.execute(createSimilaritiesNumUsersIndexStmt)
         db_curs.execute(createStoreProductsProductIdIndexStmt)
 
-    outputFileName = os.path.join(options.outputDir,
-        outputFileTemplate % os.path.splitext(os.path.basename(__file__))[0])
-    print 'Writing to %s . . .' % outputFileName
-    with open(outputFileName, 'wb') as csvfile:
-        writer = csv.writer(csvfile)
-        # fetch top similarity records
-        num_writes = 0
-        db_curs = db_conn.cursor()
-        db_curs.execute(selectSimilaritiesStmt)
-        for row in db_curs.fetchall():
-            productId1 = row[0]
-            productId2 = row[1]
-            cosineSim = row[2]
-            numUsers = row[3]
-            # skip edges where both products are not in our store
-            db_curs1 = db_conn.cursor()
-            db_curs1.execute(selectStoreProductsStmt, (productId1,))
-            if options.storeId not in [row[0] for row in db_curs1.fetchall()]:
-                continue
-            db_curs1.execute(selectStoreProductsStmt, (productId2,))
-            if options.storeId not in [row[0] for row in db_curs1.fetchall()]:
-                continue
-            # output edge
-            writer.writerow([productId1, productId2, cosineSim, numUsers])
-            num_writes += 1
-            if num_writes >= options.limit:
-                break
+    name = os.path.splitext(os.path.basename(__file__))[0]
+    if len(storeIds) == 1:
+        outputFileName = os.path.join(options.outputDir,
+                                      outputFileTemplate % name)
+        writeStoreEdges(db_conn, storeIds[0], options.limit, outputFileName)
+    else:
+        outputFileNames = dict((storeId, os.path.join(options.outputDir,
+                                storeOutputFileTemplate % (name, storeId)))
+                               for storeId in storeIds)
+        writeStoresEdges(db_conn, storeIds, options.limit, outputFileNames)
 
 if __name__ == '__main__':
     main()
@@ -1,9 +1,29 @@
 #!/usr/local/bin/python
 
+"""
+Factors the matrix of AdjustedScores of Reviews as Q P^T, with a row of Q
+for each product and a row of P for each user.
+
+The ratings are loaded once into arrays of product indices, user indices and
+scores, and a random fraction of them is held out to report the RMSE after
+each epoch. Two training methods are offered:
+  sgd: minibatch stochastic gradient descent. The updates of a batch are
+       computed from the same Q and P and summed per row. With several
+       workers, each worker runs over its own part of the ratings and
+       updates the shared Q and P without locking.
+  als: alternating least squares. Each half-epoch solves the regularized
+       least squares problems of all products (then all users) at once,
+       in blocks of rows that are split among the workers.
+Q and P are kept in shared memory, and workers are forked after the ratings
+are loaded, so they share them copy-on-write.
+"""
+
+import multiprocessing as mp
 from optparse import OptionParser
 import sqlite3
 import pickle
 import numpy as np
+import scipy.sparse as sp
 import math
 import os
 import sys
@@ -13,10 +33,39 @@ innerDimension = 100
 iterations = 40
 learningRate = 0.05
 regularization = 0.01
-displayInterval = 100000
+batchSize = 1000
+holdout = 0.1
+fetchSize = 100000
+predictChunkSize = 100000
+alsBlockBytes = 256*1024*1024 # per chunk of outer products, block of A
+productIdsFileName = 'productIds.npy'
+userIdsFileName = 'userIds.npy'
+QFileName = 'Q.npy'
+PFileName = 'P.npy'
+neighborsFileName = 'neighbors.npy' # see mfNeighbors.py
+neighborSimsFileName = 'neighborSims.npy'
+# files of earlier versions
+oldProductIdDictFileName = 'productIdDict.pickle'
+oldUserIdDictFileName = 'userIdDict.pickle'
+oldQFileName = 'Q.pickle'
+oldPFileName = 'P.pickle'
 
 #db params
 dbTimeout = 5
+selectReviewsStmt = 'SELECT ProductId, UserId, AdjustedScore FROM Reviews'
+selectUsersStmt = 'SELECT UserId FROM Users'
+selectProductsStmt = 'SELECT ProductId FROM Products'
+
+# ratings and factors shared with worker processes
+items = None
+users = None
+ratings = None
+Q = None
+P = None
+trainShards = None
+alsIndex = None
+shuffle = False
+seed = 0
 
 def getParser(usage=None):
     parser = OptionParser(usage=usage)
@@ -27,133 +76,380 @@ def getParser(usage=None):
     parser.add_option('--shuffle', type='int', dest='shuffle', default=0,
         help=('Whether or not to shuffle ratings between each iteration. '
               '1=true, 0=false (default).'), metavar='NUM')
+    parser.add_option('-m', '--method', dest='method', default='sgd',
+        help='Training method: "sgd" (default) or "als".', metavar='METHOD')
+    parser.add_option('-i', '--iterations', dest='iterations', type='int',
+        default=iterations, help='Number of epochs.', metavar='NUM')
+    parser.add_option('-b', '--batchSize', dest='batchSize', type='int',
+        default=batchSize, help='Ratings per SGD minibatch.', metavar='NUM')
+    parser.add_option('--holdout', dest='holdout', type='float',
+        default=holdout, help='Fraction of ratings held out for testing.',
+        metavar='FLOAT')
+    parser.add_option('--seed', dest='seed', type='int', default=None,
+        help='Seed for the random number generator.', metavar='NUM')
+    parser.add_option('-w', '--numWorkers', dest='numWorkers', type='int',
+        default=1, help='Number of worker processes.', metavar='NUM')
     return parser
 
-def getIdDict(values):
-    idDict = {}
-    for i in range(len(values)):
-        idDict[values[i]] = i
-    return idDict
+def loadIds(idsFilename, mmap=True):
+    if mmap:
+        return np.load(idsFilename, mmap_mode='r')
+    return np.load(idsFilename)
 
-def getUserIdDict(db_conn, userIdDictFilename):
-    """Construct UserId dict if not exists"""
-    selectUsersStmt = 'SELECT UserId FROM Users'
-    db_curs = db_conn.cursor()
-    if not os.path.isfile(userIdDictFilename):
-        print 'Constructing UserId dict . . .'
-        db_curs.execute(selectUsersStmt)
-        userIds = [row[0] for row in db_curs.fetchall()]
-        userIdDict = getIdDict(userIds)
-        pickle.dump(userIdDict, open(userIdDictFilename, 'wb'))
-    else:
-        print 'Loading UserId dict from %s . . .' % userIdDictFilename
-        userIdDict = pickle.load(open(userIdDictFilename, 'rb'))
-        print '%d UserIds read' % len(userIdDict)
-    return userIdDict
-
-def getProductIdDict(db_conn, productIdDictFilename):
-    """Construct ProductId dict if not exists"""
-    selectProductsStmt = 'SELECT ProductId FROM Products'
-    db_curs = db_conn.cursor()
-    if not os.path.isfile(productIdDictFilename):
-        print 'Constructing ProductId dict . . .'
-        db_curs.execute(selectProductsStmt)
-        productIds = [row[0] for row in db_curs.fetchall()]
-        productIdDict = getIdDict(productIds)
-        pickle.dump(productIdDict, open(productIdDictFilename, 'wb'))
+def saveIds(ids, idsFilename):
+    np.save(open(idsFilename, 'wb'), ids)
+
+def getIds(db_conn, idsFilename, selectStmt):
+    """Returns the sorted array of ids selected by selectStmt, constructing
+       it if not exists.
+    """
+    if not os.path.isfile(idsFilename):
+        print 'Constructing %s . . .' % idsFilename
+        db_curs = db_conn.cursor()
+        db_curs.execute(selectStmt)
+        ids = np.sort(np.array([row[0] for row in db_curs.fetchall()],
+                               dtype=np.unicode_))
+        saveIds(ids, idsFilename)
     else:
-        print 'Loading ProductId dict from %s . . .' % productIdDictFilename
-        productIdDict = pickle.load(open(productIdDictFilename, 'rb'))
-        print '%d ProductIds read' % len(productIdDict)
-    return productIdDict
+        print 'Loading %s . . .' % idsFilename
+        ids = loadIds(idsFilename, mmap=False)
+        print '%d Ids read' % len(ids)
+    return ids
+
+def getUserIds(db_conn, userIdsFilename):
+    """Construct sorted UserIds if not exists"""
+    return getIds(db_conn, userIdsFilename, selectUsersStmt)
+
+def getProductIds(db_conn, productIdsFilename):
+    """Construct sorted ProductIds if not exists"""
+    return getIds(db_conn, productIdsFilename, selectProductsStmt)
 
-def loadMatrix(MFilename):
+def lookupIds(ids, queries):
+    """Returns the indices of queries in the sorted array ids by binary
+       search, with -1 for queries not in ids.
+    """
+    queries = np.array(queries, dtype=np.unicode_)
+    if not len(ids) or not len(queries):
+        return np.zeros(len(queries), dtype=np.int64) - 1
+    idx = np.minimum(np.searchsorted(ids, queries), len(ids) - 1)
+    return np.where(ids[idx] == queries, idx, -1)
+
+def getRows(M, idx):
+    """Returns the rows idx of M (zeros where idx is -1), reading only those
+       rows if M is memory-mapped.
+    """
+    known = idx >= 0
+    rows = np.zeros((len(idx), M.shape[1]))
+    rows[known] = M[idx[known]]
+    return rows
+
+def loadMatrix(MFilename, mmap=False):
+    if mmap:
+        return np.load(MFilename, mmap_mode='r')
     return np.load(open(MFilename, 'rb'))
 
 def saveMatrix(M, MFilename):
     np.save(open(MFilename, 'wb'), M)
 
-def SGD_iter(db_curs, productIdDict, userIdDict,
-             Q, P, learningRate, regularization, displayInterval):
+def upgradeModel(saveDir):
+    """Converts a model saved with pickled id dicts, and Q and P rows in
+       dict order, to sorted id arrays with Q and P rows in the same order.
+    """
+    for (oldIdDictFileName, idsFileName, oldMFileName, MFileName) in\
+        ((oldProductIdDictFileName, productIdsFileName, oldQFileName,
+          QFileName),
+         (oldUserIdDictFileName, userIdsFileName, oldPFileName, PFileName)):
+        oldIdDictFilename = os.path.join(saveDir, oldIdDictFileName)
+        idsFilename = os.path.join(saveDir, idsFileName)
+        if not os.path.isfile(oldIdDictFilename) or\
+           os.path.isfile(idsFilename):
+            continue
+        print 'Converting %s . . .' % oldIdDictFilename
+        idDict = pickle.load(open(oldIdDictFilename, 'rb'))
+        ids = [None]*len(idDict)
+        for value, i in idDict.iteritems():
+            ids[i] = value
+        ids = np.array(ids, dtype=np.unicode_)
+        order = np.argsort(ids, kind='mergesort')
+        oldMFilename = os.path.join(saveDir, oldMFileName)
+        MFilename = os.path.join(saveDir, MFileName)
+        if os.path.isfile(oldMFilename) and not os.path.isfile(MFilename):
+            print 'Converting %s . . .' % oldMFilename
+            saveMatrix(loadMatrix(oldMFilename)[order], MFilename)
+        if idsFileName == productIdsFileName:
+            upgradeNeighbors(saveDir, order)
+        # saved last, as it marks the conversion done
+        saveIds(ids[order], idsFilename)
+
+def upgradeNeighbors(saveDir, order):
+    """Renumbers a neighbor index built before products were reordered by
+       order.
+    """
+    neighborsFilename = os.path.join(saveDir, neighborsFileName)
+    neighborSimsFilename = os.path.join(saveDir, neighborSimsFileName)
+    if not os.path.isfile(neighborsFilename):
+        return
+    print 'Converting %s . . .' % neighborsFilename
+    rank = np.argsort(order).astype(np.int32)
+    np.save(neighborsFilename, rank[np.load(neighborsFilename)[order]])
+    np.save(neighborSimsFilename, np.load(neighborSimsFilename)[order])
+
+class FactorModel(object):
+    """Read-only view of a model saved by this script. Ids are looked up by
+       binary search, and the id arrays, Q and P are memory-mapped, so only
+       the rows that are looked up are read.
+    """
+    def __init__(self, saveDir):
+        upgradeModel(saveDir)
+        self.productIds = loadIds(os.path.join(saveDir, productIdsFileName))
+        self.userIds = loadIds(os.path.join(saveDir, userIdsFileName))
+        self.Q = loadMatrix(os.path.join(saveDir, QFileName), mmap=True)
+        self.P = loadMatrix(os.path.join(saveDir, PFileName), mmap=True)
+
+    def getProductIndices(self, productIds):
+        return lookupIds(self.productIds, productIds)
+
+    def getUserIndices(self, userIds):
+        return lookupIds(self.userIds, userIds)
+
+    def getProductFactors(self, productIds):
+        """Returns (factors, known): the rows of Q of productIds (zeros for
+           unknown ids) and a mask of the known ids.
+        """
+        idx = self.getProductIndices(productIds)
+        return getRows(self.Q, idx), idx >= 0
+
+    def getUserFactors(self, userIds):
+        """Returns (factors, known): the rows of P of userIds (zeros for
+           unknown ids) and a mask of the known ids.
+        """
+        idx = self.getUserIndices(userIds)
+        return getRows(self.P, idx), idx >= 0
+
+def sharedMatrix(M):
+    """Returns a copy of M in shared memory, to be updated by workers."""
+    buf = mp.RawArray('d', M.size)
+    S = np.frombuffer(buf, dtype=np.float64).reshape(M.shape)
+    S[:] = M
+    return S
+
+def loadRatings(db_conn, productIds, userIds):
+    """Returns (items, users, ratings) arrays of all Reviews."""
+    db_curs = db_conn.cursor()
+    db_curs.execute(selectReviewsStmt)
+    itemChunks = []
+    userChunks = []
+    ratingChunks = []
     cnt = 0
-    totalError = 0
-    totalSquareError = 0
     while True:
-        row = db_curs.fetchone()
-        if not row: break
-        try:
-            # get indices and rating
-            i = productIdDict[row[0]]
-            u = userIdDict[row[1]]
-            r_ui = row[2]
-        except:
-            print >> sys.stderr,\
-                'Exception for ProductId: %s, UserId: %s' % (row[0], row[1])
-            raise
-        try:
-            # compute error
-            e_ui = r_ui - np.dot(Q[i,:], P[u,:])
-            totalError += e_ui
-            totalSquareError += e_ui**2
-            # update column vectors
-            Q[i,:] =\
-                Q[i,:] + learningRate*(e_ui*P[u,:] - regularization*Q[i,:])
-            P[u,:] =\
-                P[u,:] + learningRate*(e_ui*Q[i,:] - regularization*P[u,:])
-        except:
-            print >> sys.stderr,\
-                'Exception for i = %d, u = %d' % (i, u)
-            raise
-        cnt += 1
-        if cnt % displayInterval == 0:
-            print 'Processed %d ratings' % cnt
-    return Q, P, cnt, totalError, totalSquareError
-
-def doSGD(db_conn, Q, P, productIdDict, userIdDict, shuffle=False):
+        rows = db_curs.fetchmany(fetchSize)
+        if not rows:
+            break
+        for chunks, ids, col in ((itemChunks, productIds, 0),
+                                 (userChunks, userIds, 1)):
+            idx = lookupIds(ids, [row[col] for row in rows])
+            unknown = np.flatnonzero(idx < 0)
+            if len(unknown):
+                print >> sys.stderr, 'Unknown Id: %s' % rows[unknown[0]][col]
+                raise KeyError(rows[unknown[0]][col])
+            chunks.append(idx.astype(np.int32))
+        ratingChunks.append(np.array([row[2] for row in rows],
+                                     dtype=np.float32))
+        cnt += len(rows)
+        print 'Loaded %d ratings' % cnt
+    if not cnt:
+        return (np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32),
+                np.zeros(0, dtype=np.float32))
+    return (np.concatenate(itemChunks), np.concatenate(userChunks),
+            np.concatenate(ratingChunks))
+
+def splitRatings(numRatings, holdout, rs):
+    """Returns (train, test) index arrays of a random split of the ratings."""
+    perm = rs.permutation(numRatings)
+    numTest = int(round(holdout*numRatings))
+    return perm[numTest:], perm[:numTest]
+
+def getErrors(idx):
+    """Returns the errors of the ratings with indices idx."""
+    errors = np.empty(len(idx))
+    for begin in range(0, len(idx), predictChunkSize):
+        chunk = idx[begin:begin+predictChunkSize]
+        errors[begin:begin+predictChunkSize] = ratings[chunk] -\
+            np.einsum('ij,ij->i', Q[items[chunk]], P[users[chunk]])
+    return errors
+
+def getRMSE(idx):
+    if not len(idx):
+        return float('nan')
+    errors = getErrors(idx)
+    return math.sqrt(np.dot(errors, errors)/len(errors))
+
+def addRows(M, idx, deltas):
+    """Adds each row of deltas to row idx[k] of M, summing repeated rows."""
+    rows, inv = np.unique(idx, return_inverse=True)
+    S = sp.csr_matrix((np.ones(len(idx)), (inv, np.arange(len(idx)))),
+                      shape=(len(rows), len(idx)))
+    M[rows] += S.dot(deltas)
+
+def SGD_batch(batch, learningRate, regularization):
+    """Updates Q and P with one minibatch and returns its errors."""
+    i = items[batch]
+    u = users[batch]
+    Qi = Q[i]
+    Pu = P[u]
+    e_ui = ratings[batch] - np.einsum('ij,ij->i', Qi, Pu)
+    addRows(Q, i, learningRate*(e_ui[:,np.newaxis]*Pu - regularization*Qi))
+    addRows(P, u, learningRate*(e_ui[:,np.newaxis]*Qi - regularization*Pu))
+    return e_ui
+
+def SGD_shard(task):
+    """Runs one epoch of SGD over a shard of the training ratings and returns
+       (cnt, totalError, totalSquareError).
+    """
+    iteration, shardIdx, batchSize = task
+    shard = trainShards[shardIdx]
+    # Unnecessary to randomize on first iteration.
+    if shuffle and iteration > 0:
+        rs = np.random.RandomState([seed, iteration, shardIdx])
+        shard = shard[rs.permutation(len(shard))]
+    totalError = 0.0
+    totalSquareError = 0.0
+    for begin in range(0, len(shard), batchSize):
+        e_ui = SGD_batch(shard[begin:begin+batchSize], learningRate,
+                         regularization)
+        totalError += e_ui.sum()
+        totalSquareError += np.dot(e_ui, e_ui)
+    return len(shard), totalError, totalSquareError
+
+def getALSIndex(train, rowIdx, numRows):
+    """Returns (order, offsets) such that order[offsets[r]:offsets[r+1]] are
+       the training ratings of row r.
+    """
+    order = train[np.argsort(rowIdx[train], kind='mergesort')]
+    offsets = np.searchsorted(rowIdx[order], np.arange(numRows + 1))
+    return order, offsets
+
+def getALSMaxRows(dimension):
+    """Returns the number of rows (or ratings) whose d x d matrices fit in
+       alsBlockBytes.
+    """
+    return max(1, alsBlockBytes/(8*dimension*dimension))
+
+def getALSBlocks(offsets, dimension, numWorkers):
+    """Splits rows into contiguous blocks whose normal equations fit in
+       alsBlockBytes, of about that many ratings, and into at least
+       numWorkers blocks.
+    """
+    numRows = len(offsets) - 1
+    maxRatings = getALSMaxRows(dimension)
+    maxRows = max(1, int(math.ceil(float(numRows)/numWorkers)))
+    maxRows = min(maxRows, getALSMaxRows(dimension))
+    blocks = []
+    begin = 0
+    while begin < numRows:
+        end = np.searchsorted(offsets, offsets[begin] + maxRatings,
+                              side='right') - 1
+        end = min(max(end, begin + 1), begin + maxRows, numRows)
+        blocks.append((begin, end))
+        begin = end
+    return blocks
+
+def ALS_block(task):
+    """Solves the rows begin:end of Q (side 0) or P (side 1) with the other
+       factor fixed. Outer products are summed over chunks of ratings that
+       fit in alsBlockBytes, so rows with many ratings span several chunks.
+    """
+    side, begin, end = task
+    if side == 0:
+        M, F, cols = Q, P, users
+    else:
+        M, F, cols = P, Q, items
+    order, offsets = alsIndex[side]
+    rowOffsets = offsets[begin:end+1]
+    counts = np.diff(rowOffsets)
+    dimension = M.shape[1]
+    maxRatings = getALSMaxRows(dimension)
+    A = np.zeros((end - begin, dimension, dimension))
+    b = np.zeros((end - begin, dimension))
+    for chunkBegin in range(rowOffsets[0], rowOffsets[-1], maxRatings):
+        chunkEnd = min(chunkBegin + maxRatings, rowOffsets[-1])
+        sel = order[chunkBegin:chunkEnd]
+        rows = np.searchsorted(rowOffsets, np.arange(chunkBegin, chunkEnd),
+                               side='right') - 1
+        chunkRows, starts = np.unique(rows, return_index=True)
+        F_sel = F[cols[sel]]
+        A[chunkRows] += np.add.reduceat(
+            F_sel[:,:,np.newaxis]*F_sel[:,np.newaxis,:], starts, axis=0)
+        b[chunkRows] += np.add.reduceat(
+            F_sel*ratings[sel][:,np.newaxis], starts, axis=0)
+    # regularize as SGD does, once per rating
+    A += (regularization*np.maximum(counts, 1))[:,np.newaxis,np.newaxis]*\
+         np.eye(dimension)
+    M[begin:end] = np.linalg.solve(A, b[:,:,np.newaxis])[:,:,0]
+
+def doSGD(pool, train, test, options):
     # Run stochastic gradient descent using Reviews
     print 'Running stochastic gradient descent . . .'
-    selectReviewsStmt =\
-        ('SELECT ProductId, UserId, UnbiasedScore '
-         'FROM Reviews LIMIT 100000')
-    selectReviewsRandomizedStmt =\
-        ('SELECT ProductId, UserId, UnbiasedScore '
-         'FROM (SELECT ProductId, UserId, UnbiasedScore '
-         'FROM Reviews LIMIT 100000) '
-         'ORDER BY random()')
-    db_curs = db_conn.cursor()
-    for iteration in range(iterations):
-        # Unnecessary to randomize on first iteration.
-        if iteration == 0 or not shuffle:
-            print 'Executing Query . . .'
-            db_curs.execute(selectReviewsStmt)
-        else:
-            print 'Executing Randomized Query . . .'
-            db_curs.execute(selectReviewsRandomizedStmt)
+    for iteration in range(options.iterations):
         print 'SGD iteration %d . . .' % (iteration + 1)
-        try:
-            Q, P, cnt, totalError, totalSquareError =\
-                SGD_iter(db_curs, productIdDict, userIdDict,
-                         Q, P, learningRate, regularization, displayInterval)
-        except:
-            errMsg = sys.exc_info()[0]
-            print >> sys.stderr, 'Error during SGD: %s' % errMsg
-            return Q, P
+        tasks = [(iteration, shardIdx, options.batchSize)
+                 for shardIdx in range(len(trainShards))]
+        if pool is not None:
+            results = pool.map(SGD_shard, tasks)
+        else:
+            results = map(SGD_shard, tasks)
+        cnt = sum([result[0] for result in results])
+        totalError = sum([result[1] for result in results])
+        totalSquareError = sum([result[2] for result in results])
         # Print iteration stats
         avgError = totalError/cnt
         stdError = math.sqrt(totalSquareError/(cnt - 1))
         print '<error> = %0.4f +/- %0.4f' % (avgError, stdError)
+        print 'Train RMSE = %0.4f, Test RMSE = %0.4f' %\
+            (getRMSE(train), getRMSE(test))
 
-    return Q, P
+def doALS(pool, train, test, options):
+    # Run alternating least squares using Reviews
+    print 'Running alternating least squares . . .'
+    blocks = [[(side, begin, end) for (begin, end) in
+               getALSBlocks(alsIndex[side][1], Q.shape[1], options.numWorkers)]
+              for side in (0, 1)]
+    for iteration in range(options.iterations):
+        print 'ALS iteration %d . . .' % (iteration + 1)
+        for side in (0, 1):
+            if pool is not None:
+                pool.map(ALS_block, blocks[side])
+            else:
+                map(ALS_block, blocks[side])
+        print 'Train RMSE = %0.4f, Test RMSE = %0.4f' %\
+            (getRMSE(train), getRMSE(test))
 
 def main():
+    global items
+    global users
+    global ratings
+    global Q
+    global P
+    global trainShards
+    global alsIndex
+    global shuffle
+    global seed
+
     # Parse options
     usage = 'Usage: %prog [options]'
     parser = getParser(usage=usage)
     (options, args) = parser.parse_args()
+    if options.method not in ('sgd', 'als'):
+        parser.error('Invalid method: %s' % options.method)
     if options.shuffle:
         shuffle = True
     else:
         shuffle = False
+    if options.seed is None:
+        seed = np.random.randint(2**31)
+    else:
+        seed = options.seed
+    rs = np.random.RandomState(seed)
 
     # Connect to db
     print 'Connecting to %s . . .' % options.db_fname
@@ -163,38 +459,65 @@ def main():
     if not os.path.exists(options.saveDir):
         os.makedirs(options.saveDir)
 
-    # Get productId dict
-    productIdDictFilename = os.path.join(options.saveDir,
-                                         'productIdDict.pickle')
-    productIdDict = getProductIdDict(db_conn, productIdDictFilename)
+    # Convert a model saved by earlier versions
+    upgradeModel(options.saveDir)
 
-    # Get userId dict
-    userIdDictFilename = os.path.join(options.saveDir, 'userIdDict.pickle')
-    userIdDict = getUserIdDict(db_conn, userIdDictFilename)
+    # Get ProductIds
+    productIdsFilename = os.path.join(options.saveDir, productIdsFileName)
+    productIds = getProductIds(db_conn, productIdsFilename)
 
-    QFilename = os.path.join(options.saveDir, 'Q.pickle')
-    PFilename = os.path.join(options.saveDir, 'P.pickle')
+    # Get UserIds
+    userIdsFilename = os.path.join(options.saveDir, userIdsFileName)
+    userIds = getUserIds(db_conn, userIdsFilename)
+
+    # Load ratings
+    print 'Loading ratings . . .'
+    items, users, ratings = loadRatings(db_conn, productIds, userIds)
+    train, test = splitRatings(len(ratings), options.holdout, rs)
+    print '%d training ratings, %d test ratings' % (len(train), len(test))
+    if not len(train):
+        print >> sys.stderr, 'No ratings to train on.'
+        return
+
+    QFilename = os.path.join(options.saveDir, QFileName)
+    PFilename = os.path.join(options.saveDir, PFileName)
     if not os.path.isfile(QFilename) or not os.path.isfile(PFilename):
         # Initialize matrix elements uniformly at random between -0.1 and +0.1.
         print 'Initializing matrices . . .'
-        Q = (np.random.rand(len(productIdDict), innerDimension) - 1)/5
-        P = (np.random.rand(len(userIdDict), innerDimension) - 1)/5
+        Q = sharedMatrix((rs.rand(len(productIds), innerDimension) - 0.5)/5)
+        P = sharedMatrix((rs.rand(len(userIds), innerDimension) - 0.5)/5)
     else:
         print 'Loading Q Matrix from %s . . .' % QFilename
-        Q = loadMatrix(QFilename);
+        Q = sharedMatrix(loadMatrix(QFilename))
         print 'Loading P Matrix from %s . . .' % PFilename
-        P = loadMatrix(PFilename);
+        P = sharedMatrix(loadMatrix(PFilename))
+
+    # Index training ratings
+    if options.method == 'sgd':
+        trainShards = np.array_split(train, options.numWorkers)
+    else:
+        alsIndex = (getALSIndex(train, items, Q.shape[0]),
+                    getALSIndex(train, users, P.shape[0]))
+
+    # Fork workers after loading
+    if options.numWorkers > 1:
+        pool = mp.Pool(options.numWorkers)
+    else:
+        pool = None
     try:
-        # Do SGD
-        Q, P = doSGD(db_conn, Q, P, productIdDict, userIdDict, shuffle=shuffle)
+        if options.method == 'sgd':
+            doSGD(pool, train, test, options)
+        else:
+            doALS(pool, train, test, options)
     finally:
-        if P is not None and Q is not None:
-            # Save Q and P
-            print 'Saving Q Matrix to %s . . .' % QFilename
-            saveMatrix(Q, QFilename)
-            print 'Saving P Matrix to %s . . .' % PFilename
-            saveMatrix(P, PFilename)
-        pass
-    
+        if pool is not None:
+            pool.close()
+            pool.join()
+        # Save Q and P
+        print 'Saving Q Matrix to %s . . .' % QFilename
+        saveMatrix(Q, QFilename)
+        print 'Saving P Matrix to %s . . .' % PFilename
+        saveMatrix(P, PFilename)
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,104 @@
+#!/usr/local/bin/python
+
+"""
+Builds the index of the top K neighbors of each product by cosine similarity
+of the item factor vectors (rows of Q) of a trained matrix factorization, as
+saved by matrixFactorization.py.
+
+Rows of Q are normalized, and the similarities of a block of products to all
+products are computed with one matrix product. The top K of each row are
+selected with argpartition and sorted. The index is saved in the model's
+save directory as two arrays with a row per product (in the order of the
+model's productIds): the indices of the neighbors and their similarities.
+"""
+
+from optparse import OptionParser
+import numpy as np
+import os
+
+import matrixFactorization as mf
+
+def getParser(usage=None):
+    parser = OptionParser(usage=usage)
+    parser.add_option('-s', '--save-dir', dest='saveDir',
+        default='.mf', help='Save directory of the model.', metavar='DIR')
+    parser.add_option('-k', '--numNeighbors', dest='k', type='int',
+        default=100, help='Number of neighbors per product.', metavar='K')
+    parser.add_option('--memory', dest='memory', type='int', default=256,
+        help='Memory budget for one block of similarities, in MB.',
+        metavar='MB')
+    return parser
+
+def normalizeRows(Q):
+    """Returns Q with rows scaled to unit length (zero rows are kept)."""
+    norms = np.sqrt(np.einsum('ij,ij->i', Q, Q))
+    norms[norms == 0] = 1.0
+    return Q/norms[:,np.newaxis]
+
+def topNeighbors(Q, k, memory):
+    """Returns (neighbors, sims) arrays with the indices of the k rows of Q
+       most cosine-similar to each row (excluding itself) and their
+       similarities, in decreasing order of similarity.
+    """
+    numRows = Q.shape[0]
+    k = min(k, numRows - 1)
+    Qn = normalizeRows(Q)
+    blockSize = max(1, memory/(8*numRows))
+    neighbors = np.zeros((numRows, k), dtype=np.int32)
+    sims = np.zeros((numRows, k), dtype=np.float32)
+    if k <= 0:
+        return neighbors, sims
+    for begin in range(0, numRows, blockSize):
+        end = min(begin + blockSize, numRows)
+        S = np.dot(Qn[begin:end], Qn.T)
+        # exclude each product from its own neighbors
+        S[np.arange(end - begin), np.arange(begin, end)] = -np.inf
+        top = np.argpartition(-S, k - 1, axis=1)[:,:k]
+        topSims = S[np.arange(end - begin)[:,np.newaxis], top]
+        order = np.argsort(-topSims, axis=1, kind='mergesort')
+        rows = np.arange(end - begin)[:,np.newaxis]
+        neighbors[begin:end] = top[rows, order]
+        sims[begin:end] = topSims[rows, order]
+        print 'Processed %d products' % end
+    return neighbors, sims
+
+def loadNeighbors(saveDir):
+    """Returns (productIds, neighbors, sims) of the index in saveDir."""
+    mf.upgradeModel(saveDir)
+    productIds = mf.loadIds(os.path.join(saveDir, mf.productIdsFileName))
+    neighbors = np.load(os.path.join(saveDir, mf.neighborsFileName),
+                        mmap_mode='r')
+    sims = np.load(os.path.join(saveDir, mf.neighborSimsFileName),
+                   mmap_mode='r')
+    return productIds, neighbors, sims
+
+def main():
+    # Parse options
+    usage = 'Usage: %prog [options]'
+    parser = getParser(usage=usage)
+    (options, args) = parser.parse_args()
+
+    # Load Q
+    mf.upgradeModel(options.saveDir)
+    QFilename = os.path.join(options.saveDir, mf.QFileName)
+    if not os.path.isfile(QFilename):
+        parser.error('Cannot find: %s' % QFilename)
+    print 'Loading Q Matrix from %s . . .' % QFilename
+    Q = mf.loadMatrix(QFilename)
+
+    # Find neighbors
+    print 'Finding top %d neighbors of %d products . . .' %\
+        (options.k, Q.shape[0])
+    neighbors, sims = topNeighbors(Q, options.k, options.memory*1024*1024)
+
+    # Save index
+    neighborsFilename = os.path.join(options.saveDir, mf.neighborsFileName)
+    print 'Saving neighbors to %s . . .' % neighborsFilename
+    np.save(neighborsFilename, neighbors)
+    neighborSimsFilename = os.path.join(options.saveDir,
+                                        mf.neighborSimsFileName)
+    print 'Saving neighbor similarities to %s . . .' % neighborSimsFilename
+    np.save(neighborSimsFilename, sims)
+
+if __name__ == '__main__':
+    main()
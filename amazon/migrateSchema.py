@@ -0,0 +1,240 @@
+#!/usr/local/bin/python
+
+"""
+Tunes the schema of the database for the access patterns of the scripts:
+adds covering indexes, so that the per-product (and per-user) review fetches
+and the StoreProducts and Similarities probes are answered from an index
+range scan without looking up table rows, optionally rebuilds the keyed
+tables other than Reviews as WITHOUT ROWID tables, sets the page size and
+runs ANALYZE. The query plans and fetch times of the hot queries are
+reported before and after.
+
+Reviews keeps its rowid, which makeSimilarities.py -i uses to find new
+reviews. computeBiases.py recreates UserBiases and ProductBiases, so run
+this again after a full computeBiases.py.
+"""
+
+from optparse import OptionParser
+import sqlite3
+import time
+
+# params
+numSamples = 100
+
+# db params
+dbTimeout = 5
+# covering indexes as (name, table, columns)
+coveringIndexes = [
+    ('Reviews_ProductId_UserId_Cover_Idx', 'Reviews',
+     ['ProductId', 'UserId', 'Time', 'AdjustedScore', 'Score']),
+    ('Reviews_ProductId_Time_Cover_Idx', 'Reviews',
+     ['ProductId', 'Time', 'UserId', 'AdjustedScore']),
+    ('Reviews_UserId_Cover_Idx', 'Reviews',
+     ['UserId', 'ProductId', 'AdjustedScore', 'Score']),
+    ('StoreProducts_ProductId_Cover_Idx', 'StoreProducts',
+     ['ProductId', 'StoreId']),
+    ('Similarities_NumUsers_Cover_Idx', 'Similarities',
+     ['NumUsers', 'ProductId1', 'ProductId2', 'CosineSim']),
+]
+# covering indexes of tables that are not rebuilt WITHOUT ROWID
+biasIndexes = [
+    ('UserBiases_Cover_Idx', 'UserBiases', ['UserId', 'Bias']),
+    ('ProductBiases_Cover_Idx', 'ProductBiases', ['ProductId', 'Bias']),
+]
+withoutRowidTables = ['UserBiases', 'ProductBiases', 'StoreProducts',
+                      'Similarities']
+createIndexStmt = 'CREATE INDEX IF NOT EXISTS %s ON %s(%s)'
+selectTableStmt =\
+    "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :Name"
+selectIndexesStmt =\
+    ("SELECT sql FROM sqlite_master WHERE type = 'index' AND "
+     "tbl_name = :Name AND sql IS NOT NULL")
+renameTableStmt = 'ALTER TABLE %s RENAME TO %s'
+copyTableStmt = 'INSERT INTO %s SELECT * FROM %s'
+dropTableStmt = 'DROP TABLE %s'
+selectSampleProductsStmt =\
+    'SELECT ProductId FROM Products ORDER BY random() LIMIT :Limit'
+selectSampleUsersStmt =\
+    'SELECT UserId FROM Users ORDER BY random() LIMIT :Limit'
+# hot queries as (name, table, statement, sample key)
+hotQueries = [
+    ('reviews by user', 'Reviews',
+     ('SELECT Time, UserId, AdjustedScore '
+      'FROM Reviews '
+      'WHERE ProductId = :ProductId '
+      'ORDER BY UserId'), 'product'),
+    ('reviews by time', 'Reviews',
+     ('SELECT Time, UserId, AdjustedScore '
+      'FROM Reviews '
+      'WHERE ProductId = :ProductId '
+      'ORDER BY Time'), 'product'),
+    ('user scores', 'Reviews',
+     ('SELECT UserId, Score FROM Reviews WHERE ProductId = :ProductId '
+      'ORDER BY UserId'), 'product'),
+    ('unbiased scores', 'UserBiases',
+     ('SELECT R.UserId, R.Score - PB.Bias - UB.Bias '
+      'FROM Reviews AS R, ProductBiases AS PB, UserBiases AS UB '
+      'WHERE R.ProductId = PB.ProductId '
+      'AND R.UserId = UB.UserId '
+      'AND R.ProductId = :ProductId '
+      'ORDER BY R.UserId'), 'product'),
+    ('user products', 'Reviews',
+     'SELECT ProductId FROM Reviews WHERE UserId = :UserId '
+     'ORDER BY ProductId', 'user'),
+    ('product stores', 'StoreProducts',
+     'SELECT StoreId FROM StoreProducts WHERE ProductId = :ProductId',
+     'product'),
+]
+
+def getParser(usage=None):
+    parser = OptionParser(usage=usage)
+    parser.add_option('-d', '--database', dest='db_fname',
+        default='data/amazon.db', help='sqlite3 database file.', metavar='FILE')
+    parser.add_option('--withoutRowid', action='store_true',
+        dest='withoutRowid', default=False,
+        help=('Rebuild %s as WITHOUT ROWID tables.' %
+              ', '.join(withoutRowidTables)))
+    parser.add_option('--pageSize', dest='pageSize', type='int', default=None,
+        help='Database page size in bytes (applied with VACUUM).',
+        metavar='NUM')
+    parser.add_option('--mmapSize', dest='mmapSize', type='int', default=None,
+        help=('Memory map size in bytes for the migration (mmap_size is not '
+              'stored in the database, so it only applies to this '
+              'connection).'), metavar='NUM')
+    parser.add_option('-n', '--numSamples', dest='numSamples', type='int',
+        default=numSamples,
+        help='Number of products and users to time hot queries on.',
+        metavar='NUM')
+    return parser
+
+def getTableSql(db_curs, table):
+    """Returns the CREATE statement of table, or None if it does not exist."""
+    db_curs.execute(selectTableStmt, (table,))
+    row = db_curs.fetchone()
+    if row is None:
+        return None
+    return row[0]
+
+def createIndexes(db_curs, indexes):
+    for name, table, columns in indexes:
+        if getTableSql(db_curs, table) is None:
+            continue
+        print 'Creating %s . . .' % name
+        db_curs.execute(createIndexStmt % (name, table, ', '.join(columns)))
+
+def rebuildWithoutRowid(db_curs, table):
+    """Copies table into a WITHOUT ROWID table with the same definition and
+       indexes.
+    """
+    tableSql = getTableSql(db_curs, table)
+    if tableSql is None:
+        return
+    if 'WITHOUT ROWID' in tableSql.upper():
+        print '%s is already WITHOUT ROWID' % table
+        return
+    if 'PRIMARY KEY' not in tableSql.upper():
+        print '%s has no primary key, skipping' % table
+        return
+    print 'Rebuilding %s WITHOUT ROWID . . .' % table
+    db_curs.execute(selectIndexesStmt, (table,))
+    indexSqls = [row[0] for row in db_curs.fetchall()]
+    oldTable = table + '_old'
+    db_curs.execute('BEGIN')
+    try:
+        db_curs.execute(renameTableStmt % (table, oldTable))
+        db_curs.execute(tableSql + ' WITHOUT ROWID')
+        db_curs.execute(copyTableStmt % (table, oldTable))
+        db_curs.execute(dropTableStmt % oldTable)
+        for indexSql in indexSqls:
+            db_curs.execute(indexSql)
+        db_curs.execute('COMMIT')
+    except:
+        db_curs.execute('ROLLBACK')
+        raise
+
+def getSamples(db_curs, limit):
+    """Returns sample keys of hot queries as a dict of lists."""
+    samples = {}
+    db_curs.execute(selectSampleProductsStmt, (limit,))
+    samples['product'] = [row[0] for row in db_curs.fetchall()]
+    db_curs.execute(selectSampleUsersStmt, (limit,))
+    samples['user'] = [row[0] for row in db_curs.fetchall()]
+    return samples
+
+def profileQueries(db_curs, samples):
+    """Returns {name: (plan, seconds)} of the hot queries whose tables exist,
+       where seconds is the time to fetch all rows for the samples.
+    """
+    profiles = {}
+    for name, table, stmt, key in hotQueries:
+        if getTableSql(db_curs, table) is None:
+            continue
+        db_curs.execute('EXPLAIN QUERY PLAN ' + stmt, (None,))
+        plan = [row[-1] for row in db_curs.fetchall()]
+        startTime = time.time()
+        for value in samples[key]:
+            db_curs.execute(stmt, (value,))
+            db_curs.fetchall()
+        profiles[name] = (plan, time.time() - startTime)
+    return profiles
+
+def printReport(before, after):
+    for name, table, stmt, key in hotQueries:
+        if name not in before or name not in after:
+            continue
+        planBefore, secondsBefore = before[name]
+        planAfter, secondsAfter = after[name]
+        print '%s:' % name
+        print '  before (%0.4fs):' % secondsBefore
+        for line in planBefore:
+            print '    %s' % line
+        print '  after (%0.4fs):' % secondsAfter
+        for line in planAfter:
+            print '    %s' % line
+        if secondsAfter > 0:
+            print '  speedup: %0.1fx' % (secondsBefore/secondsAfter)
+
+def main():
+    # Parse options
+    usage = 'Usage: %prog [options]'
+    parser = getParser(usage=usage)
+    (options, args) = parser.parse_args()
+
+    # connect to db, managing transactions explicitly
+    print 'Connecting to %s. . .' % options.db_fname
+    db_conn = sqlite3.connect(options.db_fname, dbTimeout)
+    db_conn.isolation_level = None
+    db_curs = db_conn.cursor()
+    if options.mmapSize is not None:
+        db_curs.execute('PRAGMA mmap_size = %d' % options.mmapSize)
+    # keep references to renamed tables as they are
+    db_curs.execute('PRAGMA legacy_alter_table = ON')
+
+    # profile hot queries
+    print 'Profiling queries . . .'
+    samples = getSamples(db_curs, options.numSamples)
+    before = profileQueries(db_curs, samples)
+
+    # migrate
+    if options.withoutRowid:
+        for table in withoutRowidTables:
+            rebuildWithoutRowid(db_curs, table)
+    else:
+        createIndexes(db_curs, biasIndexes)
+    createIndexes(db_curs, coveringIndexes)
+    if options.pageSize is not None:
+        db_curs.execute('PRAGMA page_size')
+        if db_curs.fetchone()[0] != options.pageSize:
+            print 'Setting page size to %d . . .' % options.pageSize
+            db_curs.execute('PRAGMA page_size = %d' % options.pageSize)
+            db_curs.execute('VACUUM')
+    print 'Analyzing . . .'
+    db_curs.execute('ANALYZE')
+
+    # profile hot queries again
+    print 'Profiling queries . . .'
+    after = profileQueries(db_curs, samples)
+    printReport(before, after)
+
+if __name__ == '__main__':
+    main()
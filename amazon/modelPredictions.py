@@ -5,31 +5,25 @@ Processes a list of product pairs and for each produces a list of users, their
 implied similarity estimates based on a model, and their error.
 """
 
-import multiprocessing as mp
-import Queue
 from optparse import OptionParser
+import functools
 import sqlite3
 import csv
 import os
 import sys
-import numpy as np
 
 import similarity
 import modelSim
+import reviewStore
+import resultStore
+import ratingPairs
+import executor
 
 # params
 outputTemplateTemplate = '%s_%%s_%%s.csv'
-workerTimeout = 20
-workerQueueSize = 20
-END_OF_QUEUE = -1
 
 # db params
 dbTimeout = 5
-selectReviewsStmt =\
-    ('SELECT Time, UserId, AdjustedScore '
-     'FROM Reviews '
-     'WHERE ProductId = :ProductId '
-     'ORDER BY UserId')
 
 def getParser(usage=None):
     parser = OptionParser(usage=usage)
@@ -39,10 +33,24 @@ def getParser(usage=None):
         default='data/amazon.db', help='sqlite3 database file.', metavar='FILE')
     parser.add_option('-o', '--output-dir', dest='outputDir',
         default='modelPredictions', help='Output directory.', metavar='DIR')
+    parser.add_option('--shards', action='store_true', dest='shards',
+        default=False, help=('Append results to npz shards in the output '
+        'directory instead of writing one CSV file per pair.'))
+    parser.add_option('--reviewStore', dest='storeDir', default=None,
+        help='Review store directory built by reviewStore.py.', metavar='DIR')
+    parser.add_option('--cache', dest='cacheDir', default=None,
+        help='Rating pair cache directory (see ratingPairs.py).',
+        metavar='DIR')
     parser.add_option('-c', '--cosineFunc', dest='cosineFunc',
         default='randSim',
         help=('Similarity function to use as reference: '
              '"randSim" (default) or "prefSim"'), metavar='FUNCNAME')
+    parser.add_option('--errorFileName', dest='errorFileName',
+        default='output/aggregatePredictions_modelSim.csv',
+        help='User prediction errors file for weightedRandSim.',
+        metavar='FILE')
+    parser.add_option('--epsilon', dest='epsilon', type='float', default=0.01,
+        help='Parameter epsilon for weightedRandSim.', metavar='FLOAT')
     parser.add_option('--mu_s', type='float', dest='mu_s', default=None,
         help='Mean of score distribution.', metavar='FLOAT')
     parser.add_option('--sigma_s', type='float', dest='sigma_s', default=None,
@@ -51,10 +59,13 @@ def getParser(usage=None):
         help='Mean of rating distribution.', metavar='FLOAT')
     parser.add_option('--sigma_r', type='float', dest='sigma_r', default=None,
         help='Standard deviation of rating distribution.', metavar='FLOAT')
+    parser.add_option('--maxError', type='float', dest='maxError',
+        default=modelSim.surfaceMaxError,
+        help=('Error bound of the interpolated modelSim surface. 0 solves '
+              'for every rating pair.'), metavar='FLOAT')
     return parser
 
-def getPredictions(reviews1, reviews2, bias1, bias2, mu_s=None, sigma_s=None,
-                   mu_r=None, sigma_r=None):
+def setParams(mu_s=None, sigma_s=None, mu_r=None, sigma_r=None):
     # override params
     if mu_s:
         modelSim.mu_s = mu_s
@@ -64,98 +75,70 @@ def getPredictions(reviews1, reviews2, bias1, bias2, mu_s=None, sigma_s=None,
         modelSim.mu_r = mu_r
     if sigma_r:
         modelSim.sigma_r = sigma_r
-    predictions = []
-    # iterate over common reviewers
-    i = 0
-    j = 0
-    while i < len(reviews1) and j < len(reviews2):
-        userId1 = reviews1[i][1]
-        userId2 = reviews2[j][1]
-        if userId1 < userId2:
-            i += 1
-        elif userId1 > userId2:
-            j += 1
-        else:
-            time1 = reviews1[i][0]
-            time2 = reviews2[j][0]
-            if time1 == time2:
-                i += 1
-                j += 1
-                continue # ignore duplicate reviews
-            rating1 = reviews1[i][2] - bias1
-            rating2 = reviews2[j][2] - bias2
-            simScore = modelSim.modelSim(rating1, rating2)
-            predictions.append((userId1, rating1, rating2, simScore))
-            i += 1
-            j += 1
-    return predictions
-
-def processPair(db_conn, writer, cosineFunc, mu_s, sigma_s, mu_r, sigma_r,
-                productId1, productId2):
-    db_curs = db_conn.cursor()
-    # fetch product reviews
-    db_curs.execute(selectReviewsStmt, (productId1,))
-    reviews1 = [row for row in db_curs.fetchall()]
-    db_curs.execute(selectReviewsStmt, (productId2,))
-    reviews2 = [row for row in db_curs.fetchall()]
+
+def predict(userIds, ratings1, ratings2, mu_s=None, sigma_s=None, mu_r=None,
+            sigma_r=None):
+    setParams(mu_s=mu_s, sigma_s=sigma_s, mu_r=mu_r, sigma_r=sigma_r)
+    # evaluate modelSim for all common reviewers at once
+    simScores = modelSim.modelSims(ratings1, ratings2)
+    return zip(userIds.tolist(), ratings1.tolist(), ratings2.tolist(),
+               simScores.tolist())
+
+def getPredictions(reviews1, reviews2, bias1, bias2, mu_s=None, sigma_s=None,
+                   mu_r=None, sigma_r=None):
+    userIds, ratings1, ratings2 =\
+        ratingPairs.getCommonRatings(reviews1, reviews2, bias1, bias2)
+    return predict(userIds, ratings1, ratings2, mu_s=mu_s, sigma_s=sigma_s,
+                   mu_r=mu_r, sigma_r=sigma_r)
+
+def processPair(writer, cosineFunc, mu_s, sigma_s, mu_r, sigma_r,
+                ratingPair):
     # compute cosine similarity using the provided function.
-    cosineSim, numUserCommon = cosineFunc(reviews1, reviews2)
-    # compute product biases
-    bias1 = np.mean([review[2] for review in reviews1])
-    bias2 = np.mean([review[2] for review in reviews2])
+    cosineSim, numUserCommon = ratingPair.cosineSim(cosineFunc)
     # get predictions
-    predictions = getPredictions(reviews1, reviews2, bias1, bias2,
-                                 mu_s=mu_s, sigma_s=sigma_s,
-                                 mu_r=mu_r, sigma_r=sigma_r)
+    predictions = predict(ratingPair.userIds, ratingPair.ratings1,
+                          ratingPair.ratings2, mu_s=mu_s, sigma_s=sigma_s,
+                          mu_r=mu_r, sigma_r=sigma_r)
     # write output
     for (userId, rating1, rating2, prediction) in predictions:
         error = prediction - cosineSim
         writer.writerow([userId, rating1, rating2, prediction, error])
 
-def worker(workerIdx, q, db_fname, outputDir, outputTemplate, cosineFunc,
-           mu_s, sigma_s, mu_r, sigma_r):
-    num_writes = 0
-    num_skips = 0
+def initWorker(db_fname, outputDir, prefix, shards, workerIdx):
     # connect to db
     db_conn = sqlite3.connect(db_fname, dbTimeout)
-    while True:
-        (productId1, productId2) = q.get()
-        if productId1 == END_OF_QUEUE: break
-        outputFileName = os.path.join(outputDir, outputTemplate %
-                                      (productId1, productId2))
-        if os.path.isfile(outputFileName) and\
-           os.stat(outputFileName).st_size > 0:
-            num_skips += 1
-            print 'Skipping %s . . .' % outputFileName
-        else:
-            print 'Writing %s . . .' % outputFileName
-            with open(outputFileName, 'wb') as csvfile:
-                writer = csv.writer(csvfile)
-                processPair(db_conn, writer, cosineFunc, mu_s, sigma_s,
-                            mu_r, sigma_r, productId1, productId2)
-                num_writes += 1
-
-def master(inputfile, queues, workers):
-    i = 0
-    for line in inputfile:
-        tokens = line.split(',')
-        productId1 = tokens[0].strip()
-        productId2 = tokens[1].strip()
-        workerIdx = i % len(workers)
-
-        while True:
-            try:
-                queues[workerIdx].put((productId1, productId2),
-                                      timeout=workerTimeout)
-                break
-            except Queue.Full:
-                print 'WARNING: Worker Queue Full!'
-        i += 1
-
-    # close queues
-    for q in queues:
-        q.put((END_OF_QUEUE, END_OF_QUEUE))
-        q.close()
+    if shards:
+        resultWriter = resultStore.ResultWriter(outputDir, prefix, workerIdx,
+                                                resultStore.predictionsDtypes)
+    else:
+        resultWriter = None
+    return (db_conn, resultWriter)
+
+def finishWorker(state):
+    db_conn, resultWriter = state
+    db_conn.close()
+    if resultWriter is not None:
+        resultWriter.close()
+
+def writePair(store, cache, outputDir, outputTemplate, cosineFunc, mu_s,
+              sigma_s, mu_r, sigma_r, state, pair):
+    db_conn, resultWriter = state
+    productId1, productId2 = pair
+    ratingPair = ratingPairs.getCachedRatingPair(db_conn.cursor(), store,
+                                                 cache, productId1, productId2)
+    if resultWriter is not None:
+        rows = resultStore.RowBuffer()
+        processPair(rows, cosineFunc, mu_s, sigma_s, mu_r, sigma_r,
+                    ratingPair)
+        resultWriter.writePair(productId1, productId2, rows.rows)
+        return
+    outputFileName = os.path.join(outputDir, outputTemplate %
+                                  (productId1, productId2))
+    print 'Writing %s . . .' % outputFileName
+    with resultStore.openFiles([outputFileName]) as (csvfile,):
+        writer = csv.writer(csvfile)
+        processPair(writer, cosineFunc, mu_s, sigma_s, mu_r, sigma_r,
+                    ratingPair)
 
 def main():
     # Parse options
@@ -175,13 +158,15 @@ def main():
     if not os.path.isdir(outputDir):
        print >> sys.stderr, 'Cannot find output dir: %s' % outputDir
        return
-    try:
-        cosineFunc = getattr(similarity, options.cosineFunc)
-    except KeyError:
+    if options.cosineFunc not in similarity.batchCosineFuncs:
         print >> sys.stderr,\
             'Invalid Similarity function: %s' % options.cosineFunc
         return
 
+    # weighted similarity
+    if options.cosineFunc == 'weightedRandSim':
+        similarity.initWeightedSim(options.errorFileName, options.epsilon)
+
     # modelSim param overrides
     if options.mu_s:
         mu_s = options.mu_s
@@ -200,29 +185,50 @@ def main():
     else:
         sigma_r = modelSim.sigma_r
 
+    # build modelSim surface before forking workers
+    modelSim.surfaceMaxError = options.maxError
+    if modelSim.surfaceMaxError:
+        print 'Building modelSim surface . . .'
+        modelSim.mu_s = mu_s
+        modelSim.sigma_s = sigma_s
+        modelSim.mu_r = mu_r
+        modelSim.sigma_r = sigma_r
+        modelSim.getSurface()
+
     outputTemplate = outputTemplateTemplate % options.cosineFunc
 
-    # create queues
-    queues = []
-    for w in range(options.numWorkers):
-        queues.append(mp.Queue(workerQueueSize))
+    # connect to db
+    print 'Connecting to %s. . .' % options.db_fname
+    db_conn = sqlite3.connect(options.db_fname, dbTimeout)
 
-    # create worker processes
-    workers = []
-    for w in range(options.numWorkers):
-        workers.append(mp.Process(target=worker,
-            args=(w, queues[w], options.db_fname, outputDir, outputTemplate,
-                  cosineFunc, mu_s, sigma_s, mu_r, sigma_r)))
+    # open review store
+    store = reviewStore.openStore(options.storeDir)
 
-    # start worker processes
-    for w in range(options.numWorkers):
-        workers[w].start()
+    # open rating pair cache
+    if options.cacheDir:
+        cache = ratingPairs.openCache(db_conn, inputFileName,
+                                      options.cacheDir, store=store)
+    else:
+        cache = None
 
     # open input file
     print 'Reading from %s. . .' % inputFileName
     with open(inputFileName, 'r') as inputfile:
-        # do master task
-        master(inputfile, queues, workers)
+        pairs = executor.readPairs(inputfile)
+        if options.shards:
+            pairs = resultStore.skipStored(pairs, outputDir,
+                                           options.cosineFunc)
+        else:
+            pairs = resultStore.skipWritten(pairs, outputDir, outputTemplate)
+        # fetch and process rating pairs in worker processes
+        executor.run(pairs,
+            functools.partial(writePair, store, cache, outputDir,
+                              outputTemplate, options.cosineFunc, mu_s,
+                              sigma_s, mu_r, sigma_r),
+            numWorkers=options.numWorkers,
+            initWorker=functools.partial(initWorker, options.db_fname,
+                outputDir, options.cosineFunc, options.shards),
+            finishWorker=finishWorker)
 
 if __name__ == '__main__':
     main()
@@ -5,7 +5,6 @@ import os
 import sys
 import math
 import numpy as np
-from scipy.optimize import brentq
 
 """
 Determine a estimate for item-item similarity given two product ratings by
@@ -39,19 +38,197 @@ def getParser(usage=None):
         help='Standard deviation of rating distribution.', metavar='FLOAT')
     return parser
 
+# solver params
+solverXtol = 0.0001
+solverRtol = 4*np.finfo(float).eps
+solverMaxIter = 100
+
+# surface params
+surfaceMinRating = -8.0
+surfaceMaxRating = 8.0
+surfaceStep = 0.05
+surfaceMaxError = 0.0001
+surfaces = {}
+
 def modelSim(rating1, rating2):
-    p = (rating1 - mu_r)*(rating2 - mu_r)
-    q = (rating1 - mu_r)**2 + (rating2 - mu_r)**2
-    extremum = brentq(lambda s: -p*s**2 + q*s - p +\
-                  (sigma_r/sigma_s)**2*(1 - s**2)**2*(s - mu_s) +\
-                  -sigma_r**2*(1 - s**2)*s,
-                  -100, 100, xtol=0.0001)
-    if extremum > 1:
-        return 1
-    elif extremum < -1:
-        return -1
-    else:
-        return extremum
+    return float(solve(np.array([rating1], dtype=np.float64),
+                       np.array([rating2], dtype=np.float64))[0])
+
+def modelSims(ratings1, ratings2):
+    """Returns modelSim for arrays of rating pairs, interpolated from the
+       cached surface for the current params unless surfaceMaxError is 0.
+    """
+    ratings1 = np.asarray(ratings1, dtype=np.float64)
+    ratings2 = np.asarray(ratings2, dtype=np.float64)
+    if not surfaceMaxError:
+        return solve(ratings1, ratings2)
+    return getSurface().evaluate(ratings1, ratings2)
+
+def objective(s, p, q):
+    return -p*s**2 + q*s - p +\
+           (sigma_r/sigma_s)**2*(1 - s**2)**2*(s - mu_s) +\
+           -sigma_r**2*(1 - s**2)*s
+
+def numRealRoots(ratings1, ratings2):
+    """Returns the number of real roots of the (quintic) objective for arrays
+       of rating pairs, from the eigenvalues of its companion matrices.
+    """
+    p = (ratings1 - mu_r)*(ratings2 - mu_r)
+    q = (ratings1 - mu_r)**2 + (ratings2 - mu_r)**2
+    c = (sigma_r/sigma_s)**2
+    coefs = np.zeros((len(p), 5))
+    coefs[:, 0] = -mu_s
+    coefs[:, 1] = -2 + sigma_r**2/c
+    coefs[:, 2] = 2*mu_s - p/c
+    coefs[:, 3] = 1 - sigma_r**2/c + q/c
+    coefs[:, 4] = -mu_s - p/c
+    companion = np.zeros((len(p), 5, 5))
+    companion[:, 0, :] = -coefs
+    companion[:, np.arange(1, 5), np.arange(4)] = 1
+    roots = np.linalg.eigvals(companion)
+    real = np.abs(roots.imag) < 1e-6*np.maximum(1, np.abs(roots))
+    return real.sum(axis=1)
+
+def solve(ratings1, ratings2, xtol=None):
+    """Finds the extremum for arrays of rating pairs with a vectorized
+       version of the Brent's method used by scipy's brentq, over the same
+       bracket, so that the same root is found where there are several.
+    """
+    if xtol is None:
+        xtol = solverXtol
+    p = (ratings1 - mu_r)*(ratings2 - mu_r)
+    q = (ratings1 - mu_r)**2 + (ratings2 - mu_r)**2
+    n = len(p)
+    xpre = np.repeat(-100.0, n)
+    xcur = np.repeat(100.0, n)
+    xblk = np.zeros(n)
+    fpre = objective(xpre, p, q)
+    fcur = objective(xcur, p, q)
+    fblk = np.zeros(n)
+    spre = np.zeros(n)
+    scur = np.zeros(n)
+    roots = np.where(fpre == 0, xpre, xcur)
+    active = (fpre != 0) & (fcur != 0)
+    for k in range(solverMaxIter):
+        if not active.any():
+            break
+        idx = np.flatnonzero(active)
+        xp, xc, xb = xpre[idx], xcur[idx], xblk[idx]
+        fp, fc, fb = fpre[idx], fcur[idx], fblk[idx]
+        sp, sc = spre[idx], scur[idx]
+        # keep the root bracketed by xcur and xblk
+        flip = (fp != 0) & (fc != 0) & (np.signbit(fp) != np.signbit(fc))
+        xb = np.where(flip, xp, xb)
+        fb = np.where(flip, fp, fb)
+        sp = np.where(flip, xc - xp, sp)
+        sc = np.where(flip, xc - xp, sc)
+        # make xcur the best estimate
+        swap = np.abs(fb) < np.abs(fc)
+        xp = np.where(swap, xc, xp)
+        xc, xb = np.where(swap, xb, xc), np.where(swap, xc, xb)
+        fp = np.where(swap, fc, fp)
+        fc, fb = np.where(swap, fb, fc), np.where(swap, fc, fb)
+        delta = (xtol + solverRtol*np.abs(xc))/2
+        sbis = (xb - xc)/2
+        done = (fc == 0) | (np.abs(sbis) < delta)
+        roots[idx[done]] = xc[done]
+        active[idx[done]] = False
+        # interpolate (secant or inverse quadratic), else bisect
+        with np.errstate(divide='ignore', invalid='ignore'):
+            secant = -fc*(xc - xp)/(fc - fp)
+            dpre = (fp - fc)/(xp - xc)
+            dblk = (fb - fc)/(xb - xc)
+            quadratic = -fc*(fb*dblk - fp*dpre)/(dblk*dpre*(fb - fp))
+        stry = np.where(xp == xb, secant, quadratic)
+        interp = (np.abs(sp) > delta) & (np.abs(fc) < np.abs(fp))
+        accept = interp &\
+            (2*np.abs(stry) < np.minimum(np.abs(sp), 3*np.abs(sbis) - delta))
+        sp = np.where(accept, sc, sbis)
+        sc = np.where(accept, stry, sbis)
+        xp = xc
+        fp = fc
+        xc = np.where(np.abs(sc) > delta, xc + sc,
+                      np.where(sbis > 0, xc + delta, xc - delta))
+        xpre[idx], xcur[idx], xblk[idx] = xp, xc, xb
+        fpre[idx], fblk[idx] = fp, fb
+        spre[idx], scur[idx] = sp, sc
+        fcur[idx] = objective(xc, p[idx], q[idx])
+    roots[active] = xcur[active]
+    return np.clip(roots, -1, 1)
+
+def getSurface():
+    key = (mu_s, sigma_s, mu_r, sigma_r, surfaceMinRating, surfaceMaxRating,
+           surfaceStep, surfaceMaxError)
+    if key not in surfaces:
+        surfaces[key] = ModelSimSurface(surfaceMinRating, surfaceMaxRating,
+                                        surfaceStep, surfaceMaxError)
+    return surfaces[key]
+
+class ModelSimSurface(object):
+    """modelSim tabulated over a square grid of rating pairs for the current
+       params, evaluated by bilinear interpolation. The interpolation error
+       is checked at the center and edge midpoints of every cell. Cells where
+       it exceeds maxError, cells near rating pairs with several candidate
+       extrema (where the root found depends on the solver's path) and
+       ratings outside the grid are solved exactly.
+    """
+    def __init__(self, minRating, maxRating, step, maxError):
+        self.minRating = minRating
+        self.step = step
+        self.numNodes = int(round((maxRating - minRating)/step)) + 1
+        # solve on a grid of half steps, containing nodes and check points
+        fine = minRating + np.arange(2*self.numNodes - 1)*step/2
+        ratings1, ratings2 = np.meshgrid(fine, fine, indexing='ij')
+        exact = solve(ratings1.ravel(), ratings2.ravel()).reshape(
+            ratings1.shape)
+        self.nodes = exact[::2, ::2].copy()
+        # interpolation at check points is the mean of adjacent nodes
+        v00 = self.nodes[:-1, :-1]
+        v01 = self.nodes[:-1, 1:]
+        v10 = self.nodes[1:, :-1]
+        v11 = self.nodes[1:, 1:]
+        error = np.abs(exact[1::2, 1::2] - (v00 + v01 + v10 + v11)/4)
+        for edge, interp in [(exact[1::2, :-1:2], (v00 + v10)/2),
+                             (exact[1::2, 2::2], (v01 + v11)/2),
+                             (exact[:-1:2, 1::2], (v00 + v01)/2),
+                             (exact[2::2, 1::2], (v10 + v11)/2)]:
+            error = np.maximum(error, np.abs(edge - interp))
+        # cells touching rating pairs with several real roots
+        multi = (numRealRoots(ratings1.ravel(), ratings2.ravel()) > 1).reshape(
+            ratings1.shape)
+        numCells = self.numNodes - 1
+        multiCells = np.zeros((numCells + 2, numCells + 2), dtype=bool)
+        for a in range(3):
+            for b in range(3):
+                multiCells[1:-1, 1:-1] |=\
+                    multi[a:a + 2*numCells:2, b:b + 2*numCells:2]
+        dilated = np.zeros((numCells, numCells), dtype=bool)
+        for a in range(3):
+            for b in range(3):
+                dilated |= multiCells[a:a + numCells, b:b + numCells]
+        self.badCells = (error > maxError/2) | dilated
+        self.maxRating = minRating + (self.numNodes - 1)*step
+
+    def evaluate(self, ratings1, ratings2):
+        x = (ratings1 - self.minRating)/self.step
+        y = (ratings2 - self.minRating)/self.step
+        inside = (ratings1 >= self.minRating) &\
+                 (ratings1 <= self.maxRating) &\
+                 (ratings2 >= self.minRating) & (ratings2 <= self.maxRating)
+        i = np.clip(np.floor(np.where(inside, x, 0)), 0,
+                    self.numNodes - 2).astype(np.int64)
+        j = np.clip(np.floor(np.where(inside, y, 0)), 0,
+                    self.numNodes - 2).astype(np.int64)
+        t = np.where(inside, x - i, 0)
+        u = np.where(inside, y - j, 0)
+        sims = (1 - t)*(1 - u)*self.nodes[i, j] +\
+               (1 - t)*u*self.nodes[i, j + 1] +\
+               t*(1 - u)*self.nodes[i + 1, j] +\
+               t*u*self.nodes[i + 1, j + 1]
+        exact = ~inside | self.badCells[i, j]
+        if exact.any():
+            sims[exact] = solve(ratings1[exact], ratings2[exact])
+        return sims
 
 def main():
     # Parse options
@@ -15,15 +15,15 @@ The script edgeIngest.py can then be used to compute similarity
 scores and insert edge relations into the database.
 """
 
-import multiprocessing as mp
-import Queue
 from optparse import OptionParser
+import functools
 import sqlite3
 import os
 
+import executor
+
 # params
-workerTimeout = 30
-workerQueueSize = 100
+chunkSize = 100 # users per task chunk
 
 # db params
 createIndexStmt = 'CREATE INDEX IF NOT EXISTS Reviews_UserId_Idx ON Reviews(UserId)'
@@ -43,41 +43,32 @@ def getParser(usage=None):
         default='data', help='Output directory.', metavar='DIR')
     return parser
 
-def worker(db_fname, outfilename, q):
+def initWorker(db_fname, outfileDir, outfilePrefix, workerIdx):
     # open output file
+    outfilename = os.path.join(outfileDir,
+                               outfilePrefix + str(workerIdx) + '.out')
     outfile = open(outfilename, 'w')
     # connect to db
     db_conn = sqlite3.connect(db_fname)
-    with db_conn:
-        db_curs = db_conn.cursor()
-
-        # TODO: Need a terminal condition here.
-        while True:
-            userId = q.get()
-            db_curs.execute(selectReviewsStmt, (userId,))
-            productIds = [row[0] for row in db_curs.fetchall()]
-            for i in range(len(productIds)-1):
-                for j in range(i+1, len(productIds)):
-                    print >> outfile, '%s, %s' % (productIds[i], productIds[j])
-
-def master(db_conn, queues, workers):
-    db_curs1 = db_conn.cursor()
-    db_curs1.execute(selectUsersStmt)
-    i = 0
-    for row1 in db_curs1.fetchall():
-        userId = row1[0]
-        workerIdx = i % len(workers)
-        while True:
-            try:
-                queues[workerIdx].put(userId, timeout=workerTimeout)
-                break
-            except Queue.Full:
-                print 'WARNING: Worker Queue Full!'
-        i += 1
-
-    # close queues
-    for q in queues:
-        q.close()
+    return (db_conn.cursor(), outfile)
+
+def finishWorker(state):
+    db_curs, outfile = state
+    outfile.close()
+
+def processUser(state, userId):
+    db_curs, outfile = state
+    db_curs.execute(selectReviewsStmt, (userId,))
+    productIds = [row[0] for row in db_curs.fetchall()]
+    for i in range(len(productIds)-1):
+        for j in range(i+1, len(productIds)):
+            print >> outfile, '%s, %s' % (productIds[i], productIds[j])
+
+def getUsers(db_conn):
+    db_curs = db_conn.cursor()
+    db_curs.execute(selectUsersStmt)
+    for row in db_curs.fetchall():
+        yield row[0]
 
 def main():
     # Parse options
@@ -85,23 +76,6 @@ def main():
     parser = getParser(usage=usage)
     (options, args) = parser.parse_args()
 
-    # create queues
-    queues = []
-    for w in range(options.numWorkers):
-        queues.append(mp.Queue(workerQueueSize))
-
-    # create worker processes
-    workers = []
-    for w in range(options.numWorkers):
-        outfilename = os.path.join(options.outfileDir, 
-                                   options.outfilePrefix + str(w) + '.out')
-        workers.append(mp.Process(target=worker,
-            args=(options.db_fname, outfilename, queues[w])))
-
-    # start worker processes
-    for w in range(options.numWorkers):
-        workers[w].start()
-
     # connect to db
     print 'Connecting to %s. . .' % options.db_fname
     db_conn = sqlite3.connect(options.db_fname)
@@ -109,8 +83,12 @@ def main():
         db_curs = db_conn.cursor()
         # create index if not already exists
         db_curs.execute(createIndexStmt)
-        # do master task
-        master(db_conn, queues, workers)
+    # process users in worker processes
+    executor.run(getUsers(db_conn), processUser,
+        numWorkers=options.numWorkers,
+        initWorker=functools.partial(initWorker, options.db_fname,
+                                     options.outfileDir, options.outfilePrefix),
+        finishWorker=finishWorker, chunkSize=chunkSize)
 
 if __name__ == '__main__':
     main()
@@ -10,7 +10,8 @@ import csv
 import os
 import sys
 import math
-from fnmatch import fnmatch
+
+import resultStore
 
 # params
 userIdIdx = 0
@@ -29,28 +30,21 @@ def getParser(usage=None):
         default='prefSim',
         help=('Similarity function to use: "prefSim" (default), "randSim", '
               '"prefSimAlt1", or "randSimAlt1".'), metavar='FUNCNAME')
+    parser.add_option('--shards', dest='shards', default=None,
+        help='Read results from the npz shards with this prefix.',
+        metavar='PREFIX')
     return parser
 
 def incrementBin(bins, cosineSim):
     bins[int(round((1.0 + cosineSim)*(len(bins) - 1)/2.0))] += 1
 
-def makeHistogram(inputDir, pattern, bins):
-    for filename in os.listdir(inputDir):
-        fullpath = os.path.join(inputDir, filename)
-        if not os.path.isfile(fullpath):
-            continue
-        if not fnmatch(filename, pattern):
-            continue
+def makeHistogram(inputDir, pattern, bins, prefix=None):
+    for filename, productId1, productId2, columns in\
+        resultStore.iterResults(inputDir, resultStore.predictionsDtypes,
+                                pattern=pattern, prefix=prefix):
         print >> sys.stderr, 'Processing %s . . .' % filename
-        with open(fullpath, 'rb') as csvfile:
-            reader = csv.reader(csvfile)
-            for row in reader:
-                #userId = row[userIdIdx]
-                #rating1 = float(row[rating1Idx])
-                #rating2 = float(row[rating2Idx])
-                prediction = float(row[predictionIdx])
-                #error = float(row[errorIdx])
-                incrementBin(bins, prediction)
+        for prediction in columns[predictionIdx].tolist():
+            incrementBin(bins, prediction)
     return bins
 
 def printHistogram(writer, bins):
@@ -75,7 +69,7 @@ def main():
 
     # Generate histogram data
     bins = [0]*options.numBins
-    makeHistogram(inputDir, pattern, bins)
+    makeHistogram(inputDir, pattern, bins, prefix=options.shards)
 
     # Print histogram data
     writer = csv.writer(sys.stdout)
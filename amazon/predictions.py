@@ -1,31 +1,24 @@
 #!/usr/local/bin/python
 
-import multiprocessing as mp
-import Queue
 from optparse import OptionParser
+import functools
 import sqlite3
 import csv
 import os
 import sys
-import random
-import numpy as np
 
 import similarity
-from cosineSimSim import cosineSimSim
+import reviewStore
+import resultStore
+import ratingPairs
+import executor
+from cosineSimSim import CosineSimSampler
 
 # params
 outputTemplateTemplate = '%s_%%s_%%s.csv'
-workerTimeout = 20
-workerQueueSize = 100
-END_OF_QUEUE = -1
 
 # db params
 dbTimeout = 5
-selectReviewsStmt =\
-    ('SELECT Time, UserId, AdjustedScore '
-     'FROM Reviews '
-     'WHERE ProductId = :ProductId '
-     'ORDER BY UserId')
 
 def getParser(usage=None):
     parser = OptionParser(usage=usage)
@@ -35,12 +28,27 @@ def getParser(usage=None):
         default='data/amazon.db', help='sqlite3 database file.', metavar='FILE')
     parser.add_option('-o', '--output-dir', dest='outputDir',
         default='predictions', help='Output directory.', metavar='DIR')
+    parser.add_option('--shards', action='store_true', dest='shards',
+        default=False, help=('Append results to npz shards in the output '
+        'directory instead of writing one CSV file per pair.'))
+    parser.add_option('--reviewStore', dest='storeDir', default=None,
+        help='Review store directory built by reviewStore.py.', metavar='DIR')
+    parser.add_option('--cache', dest='cacheDir', default=None,
+        help='Rating pair cache directory (see ratingPairs.py).',
+        metavar='DIR')
     parser.add_option('--randomSeed', type='int', dest='randomSeed',
-        default=0, help='Seed for random module.', metavar='NUM')
+        default=0, help='Seed for random states of simulations.',
+        metavar='NUM')
     parser.add_option('-c', '--cosineFunc', dest='cosineFunc',
         default='prefSim',
         help='Similarity function to use: "prefSim" (default) or "randSim"',
               metavar='FUNCNAME')
+    parser.add_option('--errorFileName', dest='errorFileName',
+        default='output/aggregatePredictions_modelSim.csv',
+        help='User prediction errors file for weightedRandSim.',
+        metavar='FILE')
+    parser.add_option('--epsilon', dest='epsilon', type='float', default=0.01,
+        help='Parameter epsilon for weightedRandSim.', metavar='FLOAT')
     parser.add_option('--dimensions', type='int', dest='dimensions',
         default=100, help='Number of dimensions.', metavar='NUM')
     parser.add_option('--sigmaXX', type='float', dest='sigmaXX', default=1.0,
@@ -50,102 +58,66 @@ def getParser(usage=None):
        help=('Scalar constant for off-diagonal component of covariance matrix '
              'for multivariate Gaussian distribution prior for ratings.'),
              metavar='FLOAT')
+    parser.add_option('--quantum', type='float', dest='quantum', default=0.01,
+        help=('Ratings are quantized to multiples of quantum to cache '
+              'simulations. 0 simulates every rating pair.'),
+        metavar='FLOAT')
     return parser
 
-def getPredictions(dimensions, sigmaXX, rho, reviews1, reviews2):
-    predictions = []
-    # compute product biases
-    bias1 = np.mean([review[2] for review in reviews1])
-    bias2 = np.mean([review[2] for review in reviews2])
-    # update histograms
-    i = 0
-    j = 0
-    while i < len(reviews1) and j < len(reviews2):
-        userId1 = reviews1[i][1]
-        userId2 = reviews2[j][1]
-        if userId1 < userId2:
-            i += 1
-        elif userId1 > userId2:
-            j += 1
-        else:
-            time1 = reviews1[i][0]
-            time2 = reviews2[j][0]
-            if time1 == time2:
-                i += 1
-                j += 1
-                continue # ignore duplicate reviews
-            rating1 = reviews1[i][2] - bias1
-            rating2 = reviews2[j][2] - bias2
-            # make prediction
-            predictions.append((userId1, rating1, rating2,
-                               cosineSimSim(dimensions, sigmaXX, rho,
-                                            rating1, rating2)))
-            i += 1
-            j += 1
-    return predictions
-
-def processPair(db_conn, writer, dimensions, sigmaXX, rho, cosineFunc,
-                productId1, productId2):
-    db_curs = db_conn.cursor()
-    # fetch product reviews
-    db_curs.execute(selectReviewsStmt, (productId1,))
-    reviews1 = [row for row in db_curs.fetchall()]
-    db_curs.execute(selectReviewsStmt, (productId2,))
-    reviews2 = [row for row in db_curs.fetchall()]
+def getPredictions(sampler, ratingPair):
+    # make predictions for all common reviewers at once
+    predictions = sampler.sample(ratingPair.ratings1, ratingPair.ratings2)
+    return zip(ratingPair.userIds.tolist(), ratingPair.ratings1.tolist(),
+               ratingPair.ratings2.tolist(), predictions.tolist())
+
+def processPair(writer, sampler, cosineFunc, ratingPair):
     # compute cosine similarity using the provided function.
-    cosineSim, numUserCommon = cosineFunc(reviews1, reviews2)
+    cosineSim, numUserCommon = ratingPair.cosineSim(cosineFunc)
     # get predictions
-    predictions = getPredictions(dimensions, sigmaXX, rho, reviews1, reviews2)
+    predictions = getPredictions(sampler, ratingPair)
     # write output
     for (userId, rating1, rating2, prediction) in predictions:
         error = prediction - cosineSim
         writer.writerow([userId, rating1, rating2, prediction, error])
 
-def worker(workerIdx, q, db_fname, outputDir, outputTemplate, randomSeed,
-           dimensions, sigmaXX, rho, cosineFunc):
-    num_writes = 0
-    num_skips = 0
-    # Seed random module
-    random.seed(randomSeed)
+def initWorker(db_fname, dimensions, sigmaXX, rho, randomSeed, quantum,
+               outputDir, prefix, shards, workerIdx):
+    # simulations are seeded per rating pair, so that output does not depend
+    # on which worker processes a product pair
+    sampler = CosineSimSampler(dimensions, sigmaXX, rho,
+                               randomSeed=randomSeed, quantum=quantum)
     # connect to db
     db_conn = sqlite3.connect(db_fname, dbTimeout)
-    while True:
-        (productId1, productId2) = q.get()
-        if productId1 == END_OF_QUEUE: break
-        outputFileName = os.path.join(outputDir, outputTemplate %
-                                      (productId1, productId2))
-        if os.path.isfile(outputFileName):
-            num_skips += 1
-            print 'Skipping %s . . .' % outputFileName
-        else:
-            print 'Writing %s . . .' % outputFileName
-            with open(outputFileName, 'wb') as csvfile:
-                writer = csv.writer(csvfile)
-                processPair(db_conn, writer, dimensions, sigmaXX, rho,
-                            cosineFunc, productId1, productId2)
-                num_writes += 1
-
-def master(inputfile, queues, workers):
-    i = 0
-    for line in inputfile:
-        tokens = line.split(',')
-        productId1 = tokens[0].strip()
-        productId2 = tokens[1].strip()
-        workerIdx = i % len(workers)
-
-        while True:
-            try:
-                queues[workerIdx].put((productId1, productId2),
-                                      timeout=workerTimeout)
-                break
-            except Queue.Full:
-                print 'WARNING: Worker Queue Full!'
-        i += 1
-
-    # close queues
-    for q in queues:
-        q.put((END_OF_QUEUE, END_OF_QUEUE))
-        q.close()
+    if shards:
+        resultWriter = resultStore.ResultWriter(outputDir, prefix, workerIdx,
+                                                resultStore.predictionsDtypes)
+    else:
+        resultWriter = None
+    return (db_conn, sampler, resultWriter)
+
+def finishWorker(state):
+    db_conn, sampler, resultWriter = state
+    db_conn.close()
+    if resultWriter is not None:
+        resultWriter.close()
+
+def writePair(store, cache, outputDir, outputTemplate, cosineFunc, state,
+              pair):
+    db_conn, sampler, resultWriter = state
+    productId1, productId2 = pair
+    ratingPair = ratingPairs.getCachedRatingPair(db_conn.cursor(), store,
+                                                 cache, productId1, productId2)
+    if resultWriter is not None:
+        rows = resultStore.RowBuffer()
+        processPair(rows, sampler, cosineFunc, ratingPair)
+        resultWriter.writePair(productId1, productId2, rows.rows)
+        return
+    outputFileName = os.path.join(outputDir, outputTemplate %
+                                  (productId1, productId2))
+    print 'Writing %s . . .' % outputFileName
+    with resultStore.openFiles([outputFileName]) as (csvfile,):
+        writer = csv.writer(csvfile)
+        processPair(writer, sampler, cosineFunc, ratingPair)
 
 def main():
     # Parse options
@@ -165,37 +137,50 @@ def main():
     if not os.path.isdir(outputDir):
        print >> sys.stderr, 'Cannot find output dir: %s' % outputDir
        return
-    try:
-        cosineFunc = getattr(similarity, options.cosineFunc)
-    except KeyError:
+    if options.cosineFunc not in similarity.batchCosineFuncs:
         print >> sys.stderr,\
             'Invalid Similarity function: %s' % options.cosineFunc
         return
 
+    # weighted similarity
+    if options.cosineFunc == 'weightedRandSim':
+        similarity.initWeightedSim(options.errorFileName, options.epsilon)
+
     outputTemplate = outputTemplateTemplate % options.cosineFunc
 
-    # create queues
-    queues = []
-    for w in range(options.numWorkers):
-        queues.append(mp.Queue(workerQueueSize))
+    # connect to db
+    print 'Connecting to %s. . .' % options.db_fname
+    db_conn = sqlite3.connect(options.db_fname, dbTimeout)
 
-    # create worker processes
-    workers = []
-    for w in range(options.numWorkers):
-        workers.append(mp.Process(target=worker,
-            args=(w, queues[w], options.db_fname, outputDir, outputTemplate,
-                  options.randomSeed, options.dimensions, options.sigmaXX,
-                  options.rho, cosineFunc)))
+    # open review store
+    store = reviewStore.openStore(options.storeDir)
 
-    # start worker processes
-    for w in range(options.numWorkers):
-        workers[w].start()
+    # open rating pair cache
+    if options.cacheDir:
+        cache = ratingPairs.openCache(db_conn, inputFileName,
+                                      options.cacheDir, store=store)
+    else:
+        cache = None
 
     # open input file
     print 'Reading from %s. . .' % inputFileName
     with open(inputFileName, 'r') as inputfile:
-        # do master task
-        master(inputfile, queues, workers)
+        pairs = executor.readPairs(inputfile)
+        if options.shards:
+            pairs = resultStore.skipStored(pairs, outputDir,
+                                           options.cosineFunc)
+        else:
+            pairs = resultStore.skipWritten(pairs, outputDir, outputTemplate)
+        # fetch and process rating pairs in worker processes
+        executor.run(pairs,
+            functools.partial(writePair, store, cache, outputDir,
+                              outputTemplate, options.cosineFunc),
+            numWorkers=options.numWorkers,
+            initWorker=functools.partial(initWorker, options.db_fname,
+                options.dimensions, options.sigmaXX, options.rho,
+                options.randomSeed, options.quantum, outputDir,
+                options.cosineFunc, options.shards),
+            finishWorker=finishWorker)
 
 if __name__ == '__main__':
     main()
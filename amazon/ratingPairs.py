@@ -0,0 +1,367 @@
+#!/usr/local/bin/python
+
+"""
+Streams the rating pairs of product pairs: the ratings of each common
+reviewer of the two products, adjusted by the product biases, as used by
+makeSimGrid.py, make3DRatingData.py, aggregateRatings.py,
+modelPredictions.py and predictions.py.
+
+Common reviewers are found as in similarity.cosineSim, with one numpy
+intersection on (user, occurrence) keys per pair, and duplicate reviews (same
+user and time) are ignored unless dedupe is False. Each pair also keeps the
+numbers of reviews of both products and the sums of squared ratings of their
+other reviews, so that the cosineSim family is computed without the reviews.
+
+Rating pairs of a pair file may be cached in an .npz file laid out like a
+result shard: productIds1 and productIds2 index its pairs and
+offsets[k]:offsets[k+1] is the slice of userIds, ratings1 and ratings2
+belonging to pair k. The cache is named after the pair file and a key of the
+sizes and modification times of the pair file and of the database (or review
+store), so changing either builds a new cache.
+
+Running this module builds the cache of a pair file.
+"""
+
+from optparse import OptionParser
+import sqlite3
+import numpy as np
+import hashlib
+import os
+import sys
+
+import similarity
+import reviewStore
+import executor
+
+# params
+cacheTemplate = '%s_%s.npz'
+cacheKeyLength = 16
+
+# db params
+dbTimeout = 5
+selectDatabaseListStmt = 'PRAGMA database_list'
+
+def getParser(usage=None):
+    parser = OptionParser(usage=usage)
+    parser.add_option('-d', '--database', dest='db_fname',
+        default='data/amazon.db', help='sqlite3 database file.', metavar='FILE')
+    parser.add_option('--reviewStore', dest='storeDir', default=None,
+        help='Review store directory built by reviewStore.py.', metavar='DIR')
+    parser.add_option('-o', '--output-dir', dest='cacheDir',
+        default='data/ratingPairs', help='Rating pair cache directory.',
+        metavar='DIR')
+    return parser
+
+class RatingPair(object):
+    """Bias-adjusted ratings of the common reviewers of a product pair, in
+       UserId order, with the numbers of reviews of both products and the sums
+       of squared ratings of the reviews that are not rating pairs (duplicate
+       reviews excluded).
+    """
+    def __init__(self, productId1, productId2, userIds, ratings1, ratings2,
+                 numReviews1, numReviews2, otherSquares1, otherSquares2):
+        self.productId1 = productId1
+        self.productId2 = productId2
+        self.userIds = userIds
+        self.ratings1 = ratings1
+        self.ratings2 = ratings2
+        self.numReviews1 = numReviews1
+        self.numReviews2 = numReviews2
+        self.otherSquares1 = otherSquares1
+        self.otherSquares2 = otherSquares2
+
+    def __len__(self):
+        return len(self.ratings1)
+
+    def cosineSim(self, funcName):
+        """Returns (similarity, numUsersCommon) of the similarity function
+           funcName, one of similarity.batchCosineFuncs, as computed from the
+           reviews.
+        """
+        onlyCommon, fudgeFactor = similarity.batchCosineFuncs[funcName]
+        ratings1 = self.ratings1
+        ratings2 = self.ratings2
+        if funcName == 'weightedRandSim':
+            weights = np.array([similarity.weights.get(userId,
+                                                       similarity.avgWeight)
+                                for userId in self.userIds.tolist()])
+            ratings1 = ratings1*weights
+            ratings2 = ratings2*weights
+        numUsersCommon = len(ratings1)
+        innerProd = np.dot(ratings1, ratings2)
+        varA = np.dot(ratings1, ratings1)
+        varB = np.dot(ratings2, ratings2)
+        if not onlyCommon:
+            varA += self.otherSquares1
+            varB += self.otherSquares2
+        # Magical simp fudge factor
+        if fudgeFactor == 'simpFudge':
+            if self.numReviews1 < similarity.K:
+                varA += (similarity.K - self.numReviews1)*similarity.sigma**2
+            if self.numReviews2 < similarity.K:
+                varB += (similarity.K - self.numReviews2)*similarity.sigma**2
+        # Magical simr fudge factor
+        elif fudgeFactor == 'simrFudge':
+            if numUsersCommon < similarity.K:
+                varA += (similarity.K - numUsersCommon)*similarity.sigma**2
+                varB += (similarity.K - numUsersCommon)*similarity.sigma**2
+        return (similarity.computeScore(innerProd, varA, varB),
+                numUsersCommon)
+
+def getKeys(codes, numCodes):
+    """Returns keys of (code, occurrence of code) for codes sorted by code,
+       so that the k-th reviews of a user by two products get the same key.
+       numCodes bounds the number of occurrences.
+    """
+    idx = np.arange(len(codes))
+    starts = np.ones(len(codes), dtype=bool)
+    starts[1:] = codes[1:] != codes[:-1]
+    ranks = idx - np.maximum.accumulate(np.where(starts, idx, 0))
+    return codes.astype(np.int64)*numCodes + ranks
+
+def getCommonIdx(users1, times1, users2, times2, dedupe=True):
+    """Returns (idx1, idx2, other1, other2) for the reviews of two products
+       sorted by user: the indexes of the rating pairs, paired as by the merge
+       in similarity.cosineSim, and masks of the reviews of each product that
+       are neither rating pairs nor duplicates.
+    """
+    other1 = np.ones(len(users1), dtype=bool)
+    other2 = np.ones(len(users2), dtype=bool)
+    if not len(users1) or not len(users2):
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, other1, other2
+    # users as codes in a common order
+    users, codes = np.unique(np.concatenate((users1, users2)),
+                             return_inverse=True)
+    keys1 = getKeys(codes[:len(users1)], len(codes))
+    keys2 = getKeys(codes[len(users1):], len(codes))
+    keys, idx1, idx2 = np.intersect1d(keys1, keys2, assume_unique=True,
+                                      return_indices=True)
+    other1[idx1] = False
+    other2[idx2] = False
+    if dedupe:
+        # ignore duplicate reviews
+        unique = times1[idx1] != times2[idx2]
+        idx1 = idx1[unique]
+        idx2 = idx2[unique]
+    return idx1, idx2, other1, other2
+
+def getBias(scores):
+    if not len(scores):
+        return 0.0
+    return np.mean(scores)
+
+def makeRatingPair(productId1, productId2, times1, users1, scores1, times2,
+                   users2, scores2, userIds=None, dedupe=True):
+    """Returns the RatingPair of the reviews of two products as arrays sorted
+       by user. If given, userIds maps user codes to UserIds.
+    """
+    scores1 = np.asarray(scores1, dtype=np.float64)
+    scores2 = np.asarray(scores2, dtype=np.float64)
+    idx1, idx2, other1, other2 =\
+        getCommonIdx(users1, times1, users2, times2, dedupe=dedupe)
+    ratings1 = scores1 - getBias(scores1)
+    ratings2 = scores2 - getBias(scores2)
+    users = users1[idx1]
+    if userIds is not None:
+        users = userIds[users]
+    return RatingPair(productId1, productId2, users, ratings1[idx1],
+                      ratings2[idx2], len(scores1), len(scores2),
+                      np.dot(ratings1[other1], ratings1[other1]),
+                      np.dot(ratings2[other2], ratings2[other2]))
+
+def getReviewArrays(reviews):
+    """Returns (times, userIds, scores) arrays of a list of reviews."""
+    if not reviews:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.unicode_),
+                np.zeros(0))
+    times, userIds, scores = zip(*reviews)
+    return np.array(times), np.array(userIds), np.array(scores)
+
+def getCommonRatings(reviews1, reviews2, bias1, bias2, dedupe=True):
+    """Returns (userIds, ratings1, ratings2) arrays of the common reviewers of
+       two lists of reviews sorted by UserId, with ratings adjusted by the
+       given product biases.
+    """
+    times1, users1, scores1 = getReviewArrays(reviews1)
+    times2, users2, scores2 = getReviewArrays(reviews2)
+    idx1, idx2, other1, other2 =\
+        getCommonIdx(users1, times1, users2, times2, dedupe=dedupe)
+    return (users1[idx1], scores1[idx1] - bias1, scores2[idx2] - bias2)
+
+def getRatingPair(db_curs, store, productId1, productId2, dedupe=True):
+    """Returns the RatingPair of a product pair, from the review store if
+       given, else from the db.
+    """
+    if store is not None:
+        times1, codes1, scores1 = store.getArrays(productId1)
+        times2, codes2, scores2 = store.getArrays(productId2)
+        return makeRatingPair(productId1, productId2, times1, codes1, scores1,
+                              times2, codes2, scores2,
+                              userIds=store.userIds, dedupe=dedupe)
+    times1, users1, scores1 = getReviewArrays(
+        reviewStore.fetchReviews(db_curs, productId1))
+    times2, users2, scores2 = getReviewArrays(
+        reviewStore.fetchReviews(db_curs, productId2))
+    return makeRatingPair(productId1, productId2, times1, users1, scores1,
+                          times2, users2, scores2, dedupe=dedupe)
+
+def getCachedRatingPair(db_curs, store, cache, productId1, productId2,
+                        dedupe=True):
+    """Returns the RatingPair of a product pair, from the cache if given and
+       it holds the pair, else as getRatingPair does. Workers call this with
+       their own db cursor, while the store and the cache opened before they
+       were forked are shared.
+    """
+    if cache is not None and (productId1, productId2) in cache:
+        return cache.get(productId1, productId2)
+    return getRatingPair(db_curs, store, productId1, productId2,
+                         dedupe=dedupe)
+
+def iterRatingPairs(db_conn, pairs, store=None, dedupe=True, cache=None):
+    """Yields the RatingPair of each (productId1, productId2) in pairs, from
+       the cache if given and it holds the pair.
+    """
+    db_curs = db_conn.cursor()
+    for productId1, productId2 in pairs:
+        yield getCachedRatingPair(db_curs, store, cache, productId1,
+                                  productId2, dedupe=dedupe)
+
+class RatingPairCache(object):
+    """Read-only view of a rating pair cache file."""
+    def __init__(self, fileName):
+        self.fileName = fileName
+        with np.load(fileName) as cache:
+            self.productIds1 = cache['productIds1']
+            self.productIds2 = cache['productIds2']
+            self.offsets = cache['offsets']
+            self.userIds = cache['userIds']
+            self.ratings1 = cache['ratings1']
+            self.ratings2 = cache['ratings2']
+            self.numReviews1 = cache['numReviews1']
+            self.numReviews2 = cache['numReviews2']
+            self.otherSquares1 = cache['otherSquares1']
+            self.otherSquares2 = cache['otherSquares2']
+        self.index = dict((pair, k) for k, pair in
+            enumerate(zip(self.productIds1.tolist(),
+                          self.productIds2.tolist())))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, pair):
+        return pair in self.index
+
+    def get(self, productId1, productId2):
+        k = self.index[(productId1, productId2)]
+        begin = self.offsets[k]
+        end = self.offsets[k+1]
+        return RatingPair(productId1, productId2, self.userIds[begin:end],
+                          self.ratings1[begin:end], self.ratings2[begin:end],
+                          self.numReviews1[k], self.numReviews2[k],
+                          self.otherSquares1[k], self.otherSquares2[k])
+
+def writeCache(fileName, ratingPairs):
+    ratingPairs = list(ratingPairs)
+    lens = [len(ratingPair) for ratingPair in ratingPairs]
+    arrays = {
+        'productIds1': np.array([r.productId1 for r in ratingPairs],
+                                dtype=np.unicode_),
+        'productIds2': np.array([r.productId2 for r in ratingPairs],
+                                dtype=np.unicode_),
+        'offsets': np.concatenate(([0], np.cumsum(lens))).astype(np.int64),
+        'userIds': np.concatenate([np.zeros(0, dtype=np.unicode_)] +
+            [r.userIds.astype(np.unicode_) for r in ratingPairs]),
+        'ratings1': np.concatenate([np.zeros(0)] +
+                                   [r.ratings1 for r in ratingPairs]),
+        'ratings2': np.concatenate([np.zeros(0)] +
+                                   [r.ratings2 for r in ratingPairs]),
+        'numReviews1': np.array([r.numReviews1 for r in ratingPairs],
+                                dtype=np.int64),
+        'numReviews2': np.array([r.numReviews2 for r in ratingPairs],
+                                dtype=np.int64),
+        'otherSquares1': np.array([r.otherSquares1 for r in ratingPairs],
+                                  dtype=np.float64),
+        'otherSquares2': np.array([r.otherSquares2 for r in ratingPairs],
+                                  dtype=np.float64),
+    }
+    with open(fileName + '.tmp', 'wb') as f:
+        np.savez(f, **arrays)
+    os.rename(fileName + '.tmp', fileName)
+    return len(ratingPairs), sum(lens)
+
+def getFileStamp(fileName):
+    stat = os.stat(fileName)
+    return (os.path.abspath(fileName), stat.st_size, stat.st_mtime)
+
+def getSourceStamps(db_conn, store=None):
+    """Returns (fileName, size, mtime) of the files the reviews come from:
+       the review store files if given, else the db file and its journal.
+    """
+    if store is not None:
+        return [getFileStamp(os.path.join(store.storeDir, fileName))
+                for fileName in sorted(os.listdir(store.storeDir))]
+    db_curs = db_conn.cursor()
+    db_curs.execute(selectDatabaseListStmt)
+    stamps = []
+    for seq, name, fileName in db_curs.fetchall():
+        if name != 'main' or not fileName:
+            continue
+        for suffix in ['', '-wal']:
+            if os.path.isfile(fileName + suffix):
+                stamps.append(getFileStamp(fileName + suffix))
+    return stamps
+
+def getCacheFileName(db_conn, pairFileName, cacheDir, store=None,
+                     dedupe=True):
+    stamps = [getFileStamp(pairFileName)] +\
+             getSourceStamps(db_conn, store=store) + [dedupe]
+    key = hashlib.sha1(repr(stamps)).hexdigest()[:cacheKeyLength]
+    name = os.path.splitext(os.path.basename(pairFileName))[0]
+    return os.path.join(cacheDir, cacheTemplate % (name, key))
+
+def openCache(db_conn, pairFileName, cacheDir, store=None, dedupe=True):
+    """Returns the RatingPairCache of the pairs in pairFileName, building it
+       in cacheDir (created if need be) if the pair file or the reviews
+       changed since.
+    """
+    fileName = getCacheFileName(db_conn, pairFileName, cacheDir, store=store,
+                                dedupe=dedupe)
+    if not os.path.isfile(fileName):
+        # Create cache directory if not exists
+        if not os.path.exists(cacheDir):
+            os.makedirs(cacheDir)
+        print >> sys.stderr, 'Writing %s . . .' % fileName
+        with open(pairFileName, 'r') as inputfile:
+            numPairs, numRatings = writeCache(fileName,
+                iterRatingPairs(db_conn, executor.readPairs(inputfile),
+                                store=store, dedupe=dedupe))
+        print >> sys.stderr, '%d pairs, %d rating pairs written' %\
+            (numPairs, numRatings)
+    print >> sys.stderr, 'Reading %s . . .' % fileName
+    return RatingPairCache(fileName)
+
+def main():
+    # Parse options
+    usage = 'Usage: %prog [options] <csvfile>'
+    parser = getParser(usage=usage)
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error('Wrong number of arguments')
+    inputFileName = args[0]
+    if not os.path.isfile(inputFileName):
+        print >> sys.stderr, 'Cannot find input file: %s' % inputFileName
+        return
+
+    # connect to db
+    print >> sys.stderr, 'Connecting to %s . . .' % options.db_fname
+    db_conn = sqlite3.connect(options.db_fname, dbTimeout)
+
+    # open review store
+    store = reviewStore.openStore(options.storeDir)
+
+    # build cache
+    openCache(db_conn, inputFileName, options.cacheDir, store=store)
+
+if __name__ == '__main__':
+    main()
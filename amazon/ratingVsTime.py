@@ -1,16 +1,32 @@
 #!/usr/local/bin/python
 
-import multiprocessing as mp
-import Queue
+"""
+Writes the duration since each user's first review and the score of every
+review, as raw CSV rows from worker processes.
+
+With --histogram, writes counts of reviews binned by duration and score
+instead. Durations are computed in one streamed pass over the reviews
+ordered by user and time, using numpy group offsets within each fetched
+chunk, or with --sql by SQLite window functions (SQLite 3.25 or later), in
+which case SQLite also bins and counts.
+"""
+
 from optparse import OptionParser
+import functools
 import sqlite3
 import csv
 import os
+import numpy as np
+from collections import Counter
+
+import executor
 
 # params
-workerTimeout = 10
-workerQueueSize = 100
 outputFileTemplate = '%s_%d.csv'
+histogramFileTemplate = '%s_hist.csv'
+fetchSize = 100000
+secondsPerDay = 86400
+windowFunctionsVersion = (3, 25, 0)
 
 # db params
 dbTimeout = 5
@@ -18,6 +34,13 @@ selectReviewsStmt =\
     ('SELECT UserId, Time, Score '
      'FROM Reviews '
      'ORDER BY UserId, Time')
+selectHistogramStmt =\
+    ('SELECT CAST((Time - FirstTime)/:BinSize AS INTEGER) AS Bin, Score, '
+     'count(*) '
+     'FROM (SELECT Time, Score, '
+     'min(Time) OVER (PARTITION BY UserId) AS FirstTime FROM Reviews) '
+     'GROUP BY Bin, Score '
+     'ORDER BY Bin, Score')
 
 def getParser(usage=None):
     parser = OptionParser(usage=usage)
@@ -29,57 +52,101 @@ def getParser(usage=None):
         default=1, help='Number of worker processes.', metavar='NUM')
     parser.add_option('-p', '--prefix', dest='prefix', default=None,
         help='Output file prefix.', metavar='STR')
+    parser.add_option('--histogram', action='store_true', dest='histogram',
+        default=False,
+        help='Write a histogram of reviews by duration and score.')
+    parser.add_option('--binDays', dest='binDays', type='int', default=30,
+        help='Width of histogram duration bins in days.', metavar='NUM')
+    parser.add_option('--sql', action='store_true', dest='sql', default=False,
+        help='Compute the histogram with SQLite window functions.')
     return parser
 
-def worker(workerIdx, q, outputDir, prefix):
-    num_writes = 0
+def initWorker(outputDir, prefix, workerIdx):
     outputFileName = os.path.join(outputDir,
                                   outputFileTemplate % (prefix, workerIdx))
     print 'Witing %s . . .' % outputFileName
-    with open(outputFileName, 'wb') as csvfile:
-        writer = csv.writer(csvfile)
+    csvfile = open(outputFileName, 'wb')
+    return (csvfile, csv.writer(csvfile))
+
+def finishWorker(state):
+    csvfile, writer = state
+    csvfile.close()
 
-        # TODO: Need a terminal condition here.
-        lastUserId = None
-        firstTime = None
-        while True:
-            row = q.get()
-            userId = row[0]
-            time = row[1]
-            score = row[2]
-            if userId != lastUserId:
-                lastUserId = userId
-                firstTime = time
-            duration = time - firstTime
-            writer.writerow([duration, score])
-            num_writes += 1
-
-def master(db_conn, queues, workers):
+def processUser(state, rows):
+    csvfile, writer = state
+    firstTime = rows[0][1]
+    for (userId, time, score) in rows:
+        duration = time - firstTime
+        writer.writerow([duration, score])
+
+def getUserRows(db_conn):
+    """Yields the reviews of each user as a list of rows ordered by time."""
     db_curs = db_conn.cursor()
     db_curs.execute(selectReviewsStmt)
-    userCnt = 0
-    lastUserId = None
+    rows = []
     while True:
         row = db_curs.fetchone()
         if row is None:
             break
         userId = row[0]
-        if userId != lastUserId:
+        if rows and userId != rows[0][0]:
+            yield rows
+            rows = []
+        if not rows:
             print 'Processing userId: %s' % userId
-            lastUserId = userId
-            userCnt += 1
-        workerIdx = userCnt % len(workers)
+        rows.append(row)
+    if rows:
+        yield rows
+
+def getHistogram(db_conn, binSize):
+    """Returns a Counter of (bin, score) over reviews, where bin is the
+       duration since the user's first review divided by binSize.
+    """
+    db_curs = db_conn.cursor()
+    db_curs.execute(selectReviewsStmt)
+    histogram = Counter()
+    lastUserId = None
+    lastFirstTime = None
+    while True:
+        rows = db_curs.fetchmany(fetchSize)
+        if not rows:
+            break
+        userIds = np.array([row[0] for row in rows], dtype=object)
+        times = np.array([row[1] for row in rows], dtype=np.int64)
+        scores = np.array([row[2] for row in rows])
+        # index of the first row of each row's user within the chunk
+        firstRows = np.zeros(len(rows), dtype=np.int64)
+        starts = np.flatnonzero(userIds[1:] != userIds[:-1]) + 1
+        firstRows[starts] = starts
+        firstRows = np.maximum.accumulate(firstRows)
+        firstTimes = times[firstRows]
+        # the first user may continue from the previous chunk
+        if userIds[0] == lastUserId:
+            firstTimes[firstRows == 0] = lastFirstTime
+        lastUserId = userIds[-1]
+        lastFirstTime = firstTimes[-1]
+        bins = (times - firstTimes)//binSize
+        keys, counts = np.unique(np.column_stack((bins, scores)), axis=0,
+                                 return_counts=True)
+        for (b, score), count in zip(keys.tolist(), counts.tolist()):
+            histogram[(int(b), score)] += count
+    return histogram
 
-        while True:
-            try:
-                queues[workerIdx].put(row, timeout=workerTimeout)
-                break
-            except Queue.Full:
-                print 'WARNING: Worker Queue Full!'
+def getHistogramSql(db_conn, binSize):
+    """Returns the same Counter as getHistogram, computed by SQLite."""
+    db_curs = db_conn.cursor()
+    db_curs.execute(selectHistogramStmt, (binSize,))
+    histogram = Counter()
+    for b, score, count in db_curs.fetchall():
+        histogram[(b, score)] += count
+    return histogram
 
-    # close queues
-    for q in queues:
-        q.close()
+def writeHistogram(outputFileName, histogram, binSize):
+    print 'Writing %s . . .' % outputFileName
+    with open(outputFileName, 'wb') as csvfile:
+        writer = csv.writer(csvfile)
+        for b, score in sorted(histogram):
+            writer.writerow([b*binSize, score, histogram[(b, score)]])
 
 def main():
     # Parse options
@@ -91,26 +158,31 @@ def main():
     else:
         prefix = os.path.splitext(os.path.basename(__file__))[0]
 
-    # create queues
-    queues = []
-    for w in range(options.numWorkers):
-        queues.append(mp.Queue(workerQueueSize))
-
-    # create worker processes
-    workers = []
-    for w in range(options.numWorkers):
-        workers.append(mp.Process(target=worker,
-            args=(w, queues[w], options.outputDir, prefix)))
-
-    # start worker processes
-    for w in range(options.numWorkers):
-        workers[w].start()
-
     # connect to db
     db_conn = sqlite3.connect(options.db_fname, dbTimeout)
-    
-    # do master task
-    master(db_conn, queues, workers)
+
+    # write histogram in one pass
+    if options.histogram:
+        binSize = options.binDays*secondsPerDay
+        if options.sql and\
+           sqlite3.sqlite_version_info < windowFunctionsVersion:
+            print 'SQLite %s has no window functions, using numpy.' %\
+                sqlite3.sqlite_version
+            options.sql = False
+        if options.sql:
+            histogram = getHistogramSql(db_conn, binSize)
+        else:
+            histogram = getHistogram(db_conn, binSize)
+        writeHistogram(os.path.join(options.outputDir,
+                                    histogramFileTemplate % prefix),
+                       histogram, binSize)
+        return
+
+    # process users in worker processes
+    executor.run(getUserRows(db_conn), processUser,
+        numWorkers=options.numWorkers,
+        initWorker=functools.partial(initWorker, options.outputDir, prefix),
+        finishWorker=finishWorker)
 
 if __name__ == '__main__':
     main()
@@ -10,6 +10,8 @@ import csv
 import os
 import sys
 
+import resultStore
+
 # params
 numUsersCommonIdx = 0
 scoreIdx = 1
@@ -21,17 +23,11 @@ def getParser(usage=None):
     parser.add_option('-m', '--max-common-reviewers', dest='maxUsersCommon',
         type='int', default=100, help='Maximum number of common reviewers.',
         metavar='NUM')
+    parser.add_option('--shards', dest='shards', default=None,
+        help='Read results from the npz shards with this prefix.',
+        metavar='PREFIX')
     return parser
 
-def getTrueScore(fullpath):
-    """Retrieves last score in file."""
-    trueScore = None
-    with open(fullpath, 'rb') as csvfile:
-        reader = csv.reader(csvfile)
-        for row in reader:
-            trueScore = row[scoreIdx]
-    return trueScore
-
 def main():
     # Parse options
     usage = 'Usage: %prog [options] inputDir'
@@ -53,21 +49,20 @@ def main():
         writers.append(csv.writer(outfile))
 
     print 'Reading files in %s . . .' % inputDir
-    for filename in os.listdir(inputDir):
-        fullpath = os.path.join(inputDir, filename)
-        if not os.path.isfile(fullpath):
-            continue
+    for filename, productId1, productId2, columns in\
+        resultStore.iterResults(inputDir, resultStore.simVsKDtypes,
+                                prefix=options.shards):
         print 'Processing %s . . .' % filename
-        trueScore = getTrueScore(fullpath)
-        with open(fullpath, 'rb') as csvfile:
-            reader = csv.reader(csvfile)
-            for row in reader:
-                numUsersCommon = int(row[numUsersCommonIdx])
-                if numUsersCommon > options.maxUsersCommon:
-                    break
-                score = float(row[scoreIdx])
-                # write output
-                writers[numUsersCommon].writerow([score, trueScore])
+        if not len(columns[scoreIdx]):
+            continue
+        # last score is the best estimate of the true score
+        trueScore = columns[scoreIdx][-1]
+        for numUsersCommon, score in zip(columns[numUsersCommonIdx].tolist(),
+                                         columns[scoreIdx].tolist()):
+            if numUsersCommon > options.maxUsersCommon:
+                break
+            # write output
+            writers[numUsersCommon].writerow([score, trueScore])
 
 if __name__ == '__main__':
     main()
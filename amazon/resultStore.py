@@ -0,0 +1,324 @@
+#!/usr/local/bin/python
+
+"""
+Appends per-product-pair result rows (as written by experiment.py,
+predictions.py, modelPredictions.py and simVsK.py) to sharded, columnar .npz
+files and streams them back, in place of one small CSV file per pair.
+
+Each worker appends to its own shards, named <prefix>_<workerIdx>_<seq>.npz.
+A shard holds the rows of many pairs: productIds1 and productIds2 index its
+pairs, offsets[k]:offsets[k+1] is the slice of each column belonging to pair
+k, and col_0, col_1, ... hold the columns in the order they were written.
+Shards are written to a temporary file and renamed, so a shard is either
+complete or absent.
+
+Running this module converts a directory of per-pair CSV files into shards.
+"""
+
+from optparse import OptionParser
+import contextlib
+import numpy as np
+import csv
+import os
+import re
+import sys
+from fnmatch import fnmatch
+
+# params
+shardRows = 100000
+shardTemplate = '%s_%d_%d.npz'
+shardPattern = r'^%s_(\d+)_(\d+)\.npz$'
+csvPattern = r'^%s_([^_]+)_([^_]+)\.csv$'
+csvTemplate = '%s_%s_%s.csv'
+tmpSuffix = '.tmp'
+
+# column dtypes of each kind of result (None for strings)
+experimentDtypes = [np.int64, np.int64, np.int64, np.int64, np.float64]
+predictionsDtypes = [None, np.float64, np.float64, np.float64, np.float64]
+simVsKDtypes = [np.int64, np.float64]
+resultDtypes = {
+    'experiment': experimentDtypes,
+    'predictions': predictionsDtypes,
+    'simVsK': simVsKDtypes,
+}
+
+def getParser(usage=None):
+    parser = OptionParser(usage=usage)
+    parser.add_option('-o', '--output-dir', dest='outputDir', default=None,
+        help='Output directory (default: input directory).', metavar='DIR')
+    parser.add_option('--prefix', dest='prefix', default=None,
+        help='Prefix of input files and shards.', metavar='STR')
+    parser.add_option('-t', '--type', dest='resultType',
+        default='experiment',
+        help=('Kind of results: "experiment" (default), "predictions" or '
+              '"simVsK".'), metavar='TYPE')
+    return parser
+
+class RowBuffer(object):
+    """Collects rows through the writerow() method of a csv writer."""
+    def __init__(self):
+        self.rows = []
+
+    def writerow(self, row):
+        self.rows.append(row)
+
+class ResultWriter(object):
+    """Appends the rows of product pairs to the shards of one worker. dtypes
+       gives the dtype of each column; a dtype of None is inferred (e.g. for
+       strings).
+    """
+    def __init__(self, storeDir, prefix, workerIdx, dtypes,
+                 shardRows=shardRows):
+        self.storeDir = storeDir
+        self.prefix = prefix
+        self.workerIdx = workerIdx
+        self.dtypes = dtypes
+        self.shardRows = shardRows
+        seqs = [seq for (workerIdx, seq, fileName) in
+                listShards(storeDir, prefix) if workerIdx == self.workerIdx]
+        self.seq = max(seqs) + 1 if seqs else 0
+        self.reset()
+
+    def reset(self):
+        self.productIds1 = []
+        self.productIds2 = []
+        self.offsets = [0]
+        self.rows = []
+
+    def writePair(self, productId1, productId2, rows):
+        self.productIds1.append(productId1)
+        self.productIds2.append(productId2)
+        self.rows += rows
+        self.offsets.append(len(self.rows))
+        if len(self.rows) >= self.shardRows:
+            self.flush()
+
+    def flush(self):
+        if not self.productIds1:
+            return
+        arrays = {'productIds1': np.array(self.productIds1, dtype=np.str_),
+                  'productIds2': np.array(self.productIds2, dtype=np.str_),
+                  'offsets': np.array(self.offsets, dtype=np.int64)}
+        columns = zip(*self.rows) if self.rows else [()]*len(self.dtypes)
+        for c in range(len(self.dtypes)):
+            arrays['col_%d' % c] = np.array(columns[c], dtype=self.dtypes[c])
+        fileName = os.path.join(self.storeDir, shardTemplate %
+                                (self.prefix, self.workerIdx, self.seq))
+        with open(fileName + '.tmp', 'wb') as f:
+            np.savez(f, **arrays)
+        os.rename(fileName + '.tmp', fileName)
+        self.seq += 1
+        self.reset()
+
+    def close(self):
+        self.flush()
+
+class ResultStore(object):
+    """Read-only view of the shards with one prefix in a directory."""
+    def __init__(self, storeDir, prefix):
+        self.storeDir = storeDir
+        self.prefix = prefix
+        self.fileNames = [fileName for (workerIdx, seq, fileName) in
+                          listShards(storeDir, prefix)]
+
+    def readShard(self, fileName):
+        """Returns (productIds1, productIds2, offsets, columns) of a shard."""
+        with np.load(os.path.join(self.storeDir, fileName)) as shard:
+            numColumns = len([key for key in shard.files
+                              if key.startswith('col_')])
+            columns = [shard['col_%d' % c] for c in range(numColumns)]
+            return (shard['productIds1'], shard['productIds2'],
+                    shard['offsets'], columns)
+
+    def iterShards(self):
+        """Yields (productIds1, productIds2, offsets, columns) per shard."""
+        for fileName in self.fileNames:
+            yield self.readShard(fileName)
+
+    def iterPairs(self, fileNames=None):
+        """Yields (productId1, productId2, columns) per product pair of the
+           given shards (default all), where columns is a list of numpy
+           arrays.
+        """
+        if fileNames is None:
+            fileNames = self.fileNames
+        for fileName in fileNames:
+            productIds1, productIds2, offsets, columns =\
+                self.readShard(fileName)
+            for k in range(len(productIds1)):
+                begin = offsets[k]
+                end = offsets[k+1]
+                yield (productIds1[k], productIds2[k],
+                       [column[begin:end] for column in columns])
+
+    def getPairs(self):
+        """Returns the set of product pairs in the store."""
+        pairs = set()
+        for productIds1, productIds2, offsets, columns in self.iterShards():
+            pairs.update(zip(productIds1.tolist(), productIds2.tolist()))
+        return pairs
+
+@contextlib.contextmanager
+def openFiles(fileNames):
+    """Opens temporary files for writing in place of fileNames and yields
+       them. They are renamed to fileNames if the block completes and removed
+       otherwise, so that, like a shard, a per-pair CSV file is either
+       complete or absent.
+    """
+    files = [open(fileName + tmpSuffix, 'wb') for fileName in fileNames]
+    try:
+        yield files
+    except:
+        for f, fileName in zip(files, fileNames):
+            f.close()
+            os.remove(fileName + tmpSuffix)
+        raise
+    for f, fileName in zip(files, fileNames):
+        f.close()
+        os.rename(fileName + tmpSuffix, fileName)
+
+def skipStored(pairs, storeDir, prefix):
+    """Yields the product pairs that are not yet in the store."""
+    storedPairs = ResultStore(storeDir, prefix).getPairs()
+    for pair in pairs:
+        if pair in storedPairs:
+            print 'Skipping %s, %s . . .' % pair
+        else:
+            yield pair
+
+def skipWritten(pairs, outputDir, outputTemplate):
+    """Yields the product pairs whose per-pair CSV file, named by
+       outputTemplate % (productId1, productId2), is not yet written.
+    """
+    for pair in pairs:
+        outputFileName = os.path.join(outputDir, outputTemplate % pair)
+        if os.path.isfile(outputFileName):
+            print 'Skipping %s . . .' % outputFileName
+        else:
+            yield pair
+
+def listShards(storeDir, prefix):
+    """Returns (workerIdx, seq, fileName) of the shards with prefix, sorted."""
+    pattern = re.compile(shardPattern % re.escape(prefix))
+    shards = []
+    for fileName in os.listdir(storeDir):
+        match = pattern.match(fileName)
+        if match:
+            shards.append((int(match.group(1)), int(match.group(2)),
+                           fileName))
+    shards.sort()
+    return shards
+
+def parsePairFileName(fileName):
+    """Returns the product pair of a <prefix>_<productId1>_<productId2>.csv
+       file name, or (None, None) if it does not have that form.
+    """
+    tokens = os.path.splitext(fileName)[0].split('_')
+    if len(tokens) < 3:
+        return (None, None)
+    return (tokens[-2], tokens[-1])
+
+def getConverters(dtypes):
+    converters = []
+    for dtype in dtypes:
+        if dtype is None:
+            converters.append(str)
+        elif np.issubdtype(dtype, np.integer):
+            converters.append(int)
+        else:
+            converters.append(float)
+    return converters
+
+def parseRows(rows, dtypes):
+    converters = getConverters(dtypes)
+    return [[converters[c](row[c]) for c in range(len(converters))]
+            for row in rows]
+
+def parseColumns(rows, dtypes):
+    if not rows:
+        return [np.array([], dtype=dtype) for dtype in dtypes]
+    columns = zip(*parseRows(rows, dtypes))
+    return [np.array(columns[c], dtype=dtypes[c])
+            for c in range(len(dtypes))]
+
+def listSources(inputDir, pattern='*.csv', prefix=None):
+    """Returns the names of the files holding results in inputDir: the shards
+       with prefix if it is given, and otherwise the CSV files matching
+       pattern.
+    """
+    if prefix is not None:
+        return ResultStore(inputDir, prefix).fileNames
+    fileNames = []
+    for fileName in os.listdir(inputDir):
+        if not os.path.isfile(os.path.join(inputDir, fileName)):
+            continue
+        if not fnmatch(fileName, pattern):
+            continue
+        fileNames.append(fileName)
+    return fileNames
+
+def readSource(inputDir, source, dtypes, prefix=None):
+    """Yields (name, productId1, productId2, columns) per product pair of one
+       file returned by listSources, where columns is a list of numpy arrays.
+       CSV columns are parsed as dtypes. For shards, name is the equivalent
+       CSV file name.
+    """
+    if prefix is not None:
+        store = ResultStore(inputDir, prefix)
+        for productId1, productId2, columns in store.iterPairs([source]):
+            name = csvTemplate % (prefix, productId1, productId2)
+            yield (name, productId1, productId2, columns)
+        return
+    with open(os.path.join(inputDir, source), 'rb') as csvfile:
+        rows = [row for row in csv.reader(csvfile)]
+    productId1, productId2 = parsePairFileName(source)
+    yield (source, productId1, productId2, parseColumns(rows, dtypes))
+
+def iterResults(inputDir, dtypes, pattern='*.csv', prefix=None):
+    """Yields (name, productId1, productId2, columns) per product pair of
+       results in inputDir, from the shards with prefix if it is given, and
+       otherwise from the CSV files matching pattern.
+    """
+    for source in listSources(inputDir, pattern=pattern, prefix=prefix):
+        for result in readSource(inputDir, source, dtypes, prefix=prefix):
+            yield result
+
+def main():
+    # Parse options
+    usage = 'Usage: %prog [options] <inputDir>'
+    parser = getParser(usage=usage)
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error('Wrong number of arguments')
+    inputDir = args[0]
+    if not os.path.isdir(inputDir):
+        print >> sys.stderr, 'Cannot find: %s' % inputDir
+        return
+    if not options.prefix:
+        parser.error('--prefix is required')
+    try:
+        dtypes = resultDtypes[options.resultType]
+    except KeyError:
+        print >> sys.stderr, 'Invalid result type: %s' % options.resultType
+        return
+    if options.outputDir:
+        outputDir = options.outputDir
+    else:
+        outputDir = inputDir
+
+    # convert CSV files to shards
+    writer = ResultWriter(outputDir, options.prefix, 0, dtypes)
+    # match the prefix exactly, as listShards does
+    pattern = re.compile(csvPattern % re.escape(options.prefix))
+    for fileName in sorted(os.listdir(inputDir)):
+        match = pattern.match(fileName)
+        if not match:
+            continue
+        print 'Converting %s . . .' % fileName
+        with open(os.path.join(inputDir, fileName), 'rb') as csvfile:
+            rows = parseRows(csv.reader(csvfile), dtypes)
+        writer.writePair(match.group(1), match.group(2), rows)
+    writer.close()
+
+if __name__ == '__main__':
+    main()
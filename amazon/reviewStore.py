@@ -0,0 +1,234 @@
+#!/usr/local/bin/python
+
+"""
+Exports the Reviews table into a columnar, memory-mapped review store and
+provides fast per-product review fetches from it.
+
+The store is a directory of .npy files laid out CSR-style: productIds holds the
+sorted ProductIds and offsets[k]:offsets[k+1] is the slice of the flat
+userCodes, times and scores arrays belonging to productIds[k]. Within a slice,
+reviews are sorted by user. User codes are ranks within the sorted userIds
+array, so comparing codes orders reviews exactly as comparing UserIds does.
+"""
+
+from optparse import OptionParser
+import sqlite3
+import numpy as np
+import os
+import sys
+
+# params
+fetchSize = 100000
+productIdsFileName = 'productIds.npy'
+userIdsFileName = 'userIds.npy'
+offsetsFileName = 'offsets.npy'
+userCodesFileName = 'userCodes.npy'
+timesFileName = 'times.npy'
+scoresFileName = 'scores.npy'
+
+# db params
+dbTimeout = 5
+selectNumReviewsStmt = 'SELECT count(*) FROM Reviews'
+selectUsersStmt = 'SELECT DISTINCT UserId FROM Reviews ORDER BY UserId'
+selectAllReviewsStmt =\
+    ('SELECT ProductId, UserId, Time, AdjustedScore '
+     'FROM Reviews '
+     'ORDER BY ProductId, UserId')
+selectReviewsStmt =\
+    ('SELECT Time, UserId, AdjustedScore '
+     'FROM Reviews '
+     'WHERE ProductId = :ProductId '
+     'ORDER BY UserId')
+
+def getParser(usage=None):
+    parser = OptionParser(usage=usage)
+    parser.add_option('-d', '--database', dest='db_fname',
+        default='data/amazon.db', help='sqlite3 database file.', metavar='FILE')
+    parser.add_option('-o', '--output-dir', dest='storeDir',
+        default='data/reviewStore', help='Review store directory.',
+        metavar='DIR')
+    return parser
+
+class ReviewStore(object):
+    """Read-only view of a review store directory. All arrays are opened with
+       np.memmap, so review slices are zero-copy and pages are shared between
+       processes that open the same store.
+    """
+    def __init__(self, storeDir):
+        self.storeDir = storeDir
+        self.productIds = self._load(productIdsFileName)
+        self.userIds = self._load(userIdsFileName)
+        self.offsets = self._load(offsetsFileName)
+        self.userCodes = self._load(userCodesFileName)
+        self.times = self._load(timesFileName)
+        self.scores = self._load(scoresFileName)
+
+    def _load(self, fileName):
+        return np.load(os.path.join(self.storeDir, fileName), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.productIds)
+
+    def __contains__(self, productId):
+        return self.getProductIdx(productId) is not None
+
+    def getProductIdx(self, productId):
+        idx = np.searchsorted(self.productIds, productId)
+        if idx < len(self.productIds) and self.productIds[idx] == productId:
+            return idx
+        return None
+
+    def getUserCode(self, userId):
+        code = np.searchsorted(self.userIds, userId)
+        if code < len(self.userIds) and self.userIds[code] == userId:
+            return code
+        return None
+
+    def getArrays(self, productId):
+        """Returns (times, userCodes, scores) array slices for a product,
+           sorted by user. Unknown products yield empty slices.
+        """
+        idx = self.getProductIdx(productId)
+        if idx is None:
+            begin = end = 0
+        else:
+            begin = self.offsets[idx]
+            end = self.offsets[idx+1]
+        return (self.times[begin:end], self.userCodes[begin:end],
+                self.scores[begin:end])
+
+    def getSegments(self, productIds):
+        """Returns (begins, ends) offset arrays for a list of ProductIds.
+           Unknown products get empty segments.
+        """
+        productIds = np.array(productIds, dtype=np.unicode_)
+        if not len(self.productIds) or not len(productIds):
+            empty = np.zeros(len(productIds), dtype=np.int64)
+            return empty, empty
+        idx = np.searchsorted(self.productIds, productIds)
+        idx = np.minimum(idx, len(self.productIds) - 1)
+        found = self.productIds[idx] == productIds
+        begins = np.where(found, self.offsets[idx], 0)
+        ends = np.where(found, self.offsets[idx+1], 0)
+        return begins, ends
+
+    def getBatchArrays(self, productIds):
+        """Gathers the reviews of a list of products into flat arrays.
+           Returns (lens, seg, times, userCodes, scores), where seg[k] is the
+           position in productIds of the product that review k belongs to.
+        """
+        begins, ends = self.getSegments(productIds)
+        lens = ends - begins
+        seg = np.repeat(np.arange(len(lens)), lens)
+        starts = np.cumsum(lens) - lens
+        pos = np.arange(lens.sum()) + np.repeat(begins - starts, lens)
+        return (lens, seg, self.times[pos], self.userCodes[pos],
+                self.scores[pos])
+
+    def getReviews(self, productId, decode=True):
+        """Returns a list of (Time, UserId, AdjustedScore) tuples ordered by
+           UserId, i.e. the rows of selectReviewsStmt. With decode=False user
+           codes are returned in place of UserIds, which is faster and orders
+           identically.
+        """
+        times, userCodes, scores = self.getArrays(productId)
+        if decode:
+            users = self.userIds[userCodes].tolist()
+        else:
+            users = userCodes.tolist()
+        return zip(times.tolist(), users, scores.tolist())
+
+    def getPair(self, productId1, productId2, decode=True):
+        return (self.getReviews(productId1, decode=decode),
+                self.getReviews(productId2, decode=decode))
+
+def fetchReviews(db_curs, productId, store=None):
+    """Returns the reviews of a product as (Time, UserId, AdjustedScore) tuples
+       ordered by UserId, from the review store if given, else from the db.
+    """
+    if store is not None:
+        return store.getReviews(productId)
+    db_curs.execute(selectReviewsStmt, (productId,))
+    return [(row[0], row[1], row[2]) for row in db_curs.fetchall()]
+
+def openStore(storeDir):
+    if not storeDir:
+        return None
+    if not os.path.isdir(storeDir):
+        print >> sys.stderr, 'Cannot find review store: %s' % storeDir
+        sys.exit(-1)
+    return ReviewStore(storeDir)
+
+def buildStore(db_conn, storeDir):
+    db_curs = db_conn.cursor()
+    # assign user codes in UserId order
+    print 'Reading UserIds . . .'
+    db_curs.execute(selectUsersStmt)
+    userIds = [row[0] for row in db_curs.fetchall()]
+    np.save(os.path.join(storeDir, userIdsFileName),
+            np.array(userIds, dtype=np.unicode_))
+    userCodeDict = dict((userId, code) for code, userId in enumerate(userIds))
+    # allocate review columns
+    db_curs.execute(selectNumReviewsStmt)
+    numReviews = db_curs.fetchone()[0]
+    print 'Exporting %d reviews . . .' % numReviews
+    userCodes = np.lib.format.open_memmap(
+        os.path.join(storeDir, userCodesFileName), mode='w+', dtype=np.int32,
+        shape=(numReviews,))
+    times = np.lib.format.open_memmap(
+        os.path.join(storeDir, timesFileName), mode='w+', dtype=np.int64,
+        shape=(numReviews,))
+    scores = np.lib.format.open_memmap(
+        os.path.join(storeDir, scoresFileName), mode='w+', dtype=np.float32,
+        shape=(numReviews,))
+    # stream reviews in (ProductId, UserId) order
+    productIds = []
+    offsets = []
+    cnt = 0
+    db_curs.execute(selectAllReviewsStmt)
+    while True:
+        rows = db_curs.fetchmany(fetchSize)
+        if not rows:
+            break
+        for k in range(len(rows)):
+            productId = rows[k][0]
+            if not productIds or productIds[-1] != productId:
+                productIds.append(productId)
+                offsets.append(cnt + k)
+        userCodes[cnt:cnt+len(rows)] = [userCodeDict[row[1]] for row in rows]
+        times[cnt:cnt+len(rows)] = [row[2] for row in rows]
+        scores[cnt:cnt+len(rows)] = [row[3] for row in rows]
+        cnt += len(rows)
+        print 'Exported %d reviews' % cnt
+    assert(cnt == numReviews)
+    offsets.append(cnt)
+    userCodes.flush()
+    times.flush()
+    scores.flush()
+    np.save(os.path.join(storeDir, productIdsFileName),
+            np.array(productIds, dtype=np.unicode_))
+    np.save(os.path.join(storeDir, offsetsFileName),
+            np.array(offsets, dtype=np.int64))
+    print '%d products, %d users, %d reviews written' %\
+        (len(productIds), len(userIds), cnt)
+
+def main():
+    # Parse options
+    usage = 'Usage: %prog [options]'
+    parser = getParser(usage=usage)
+    (options, args) = parser.parse_args()
+
+    # Create store directory if not exists
+    if not os.path.exists(options.storeDir):
+        os.makedirs(options.storeDir)
+
+    # connect to db
+    print 'Connecting to %s. . .' % options.db_fname
+    db_conn = sqlite3.connect(options.db_fname, dbTimeout)
+
+    # build review store
+    print 'Writing review store to %s . . .' % options.storeDir
+    buildStore(db_conn, options.storeDir)
+
+if __name__ == '__main__':
+    main()
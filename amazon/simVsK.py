@@ -3,38 +3,55 @@
 """
 Computes the similarity between products as a function of the number of common
 reviewers, K.
+
+Several similarity functions, each with its own parameters, may be given as a
+comma separated list (see similarity.parseSpecs). They are computed in one
+merge of each pair's reviews, and each is written to its own output with the
+function and its parameters as prefix.
 """
 
 from optparse import OptionParser
 import sqlite3
 import math
 import os
+import sys
 import csv
 
 import similarity
+import reviewStore
+import resultStore
+import executor
 
 # params
 outputFileTemplate = '%s_%s_%s.csv'
 
-# db params
-selectReviewsStmt =\
-    ('SELECT Time, UserId, AdjustedScore '
-     'FROM Reviews '
-     'WHERE ProductId = :ProductId '
-     'ORDER BY UserId') 
 
 def getParser(usage=None):
     parser = OptionParser(usage=usage)
     parser.add_option('-d', '--database', dest='db_fname',
         default='data/amazon.db', help='sqlite3 database file.', metavar='FILE')
+    parser.add_option('--reviewStore', dest='storeDir', default=None,
+        help='Review store directory built by reviewStore.py.', metavar='DIR')
     parser.add_option('-o', '--output-dir', dest='outputDir', default='simVsK',
         help='Output directory.', metavar='DIR')
+    parser.add_option('--shards', action='store_true', dest='shards',
+        default=False, help=('Append results to npz shards in the output '
+        'directory instead of writing one CSV file per pair.'))
     parser.add_option('-c', '--cosineFunc', dest='cosineFunc',
         default='prefSim',
         help=('Similarity function to use: "prefSim" (default), "randSim", '
-              '"prefSimAlt1", or "randSimAlt1"'), metavar='FUNCNAME')
+              '"prefSimAlt1", "randSimAlt1" or "weightedRandSim", or a comma '
+              'separated list of them, each optionally followed by :K=, '
+              ':sigma= or :epsilon= settings'),
+        metavar='FUNCNAMES')
     parser.add_option('-s', '--step', dest='step', type='int', default=1,
         help='Step size for K.', metavar='NUM')
+    parser.add_option('--errorFileName', dest='errorFileName',
+        default='output/aggregatePredictions_modelSim.csv',
+        help='User prediction errors file for weightedRandSim.',
+        metavar='FILE')
+    parser.add_option('--epsilon', dest='epsilon', type='float', default=0.01,
+        help='Parameter epsilon for weightedRandSim.', metavar='FLOAT')
     return parser
 
 def main():
@@ -49,37 +66,77 @@ def main():
         print >> sys.stderr, 'Cannot find: %s' % inputfilename
         return
     try:
-        cosineFunc = getattr(similarity, options.cosineFunc)
-    except KeyError:
-        print >> sys.stderr,\
-            'Invalid Similarity function: %s' % options.cosineFunc
+        specs = similarity.parseSpecs(options.cosineFunc)
+    except ValueError as e:
+        print >> sys.stderr, e
         return
+    for spec in specs:
+        if spec.funcName not in similarity.batchCosineFuncs:
+            print >> sys.stderr,\
+                'Invalid Similarity function: %s' % spec.funcName
+            return
+    prefixes = [spec.getLabel() for spec in specs]
     # Set the similarity step value
     similarity.step = options.step
 
+    # weighted similarity
+    if any(spec.funcName == 'weightedRandSim' for spec in specs):
+        similarity.initWeightedSim(options.errorFileName, options.epsilon)
+        for spec in specs:
+            spec.initWeights(options.errorFileName)
+
+    # open review store
+    store = reviewStore.openStore(options.storeDir)
+
     # connect to db
     print 'Connecting to %s. . .' % options.db_fname
     db_conn = sqlite3.connect(options.db_fname)
     with db_conn:
         db_curs = db_conn.cursor()
         with open(inputfilename, 'r') as inputfile:
-            for line in inputfile:
-                tokens = line.split(',')
-                productId1 = tokens[0].strip()
-                productId2 = tokens[1].strip()
-                outputFileName =\
-                    os.path.join(options.outputDir, outputFileTemplate %\
-                    (options.cosineFunc, productId1, productId2))
-                print 'Writing %s . . .' % outputFileName
-                with open(outputFileName, 'wb') as csvfile:
-                    similarity.writer = csv.writer(csvfile)
-                    db_curs.execute(selectReviewsStmt, (productId1,))
-                    reviews1 = [(row[0], row[1], row[2])\
-                                for row in db_curs.fetchall()]
-                    db_curs.execute(selectReviewsStmt, (productId2,))
-                    reviews2 = [(row[0], row[1], row[2])\
-                                for row in db_curs.fetchall()]
-                    cosineFunc(reviews1, reviews2)
+            if options.shards:
+                resultWriters = [resultStore.ResultWriter(options.outputDir,
+                                     prefix, 0, resultStore.simVsKDtypes)
+                                 for prefix in prefixes]
+                storedPairs = [resultStore.ResultStore(options.outputDir,
+                                   prefix).getPairs() for prefix in prefixes]
+            else:
+                resultWriters = None
+            for productId1, productId2 in executor.readPairs(inputfile):
+                pair = (productId1, productId2)
+                if resultWriters is not None:
+                    todo = [k for k in range(len(specs))
+                            if pair not in storedPairs[k]]
+                    if not todo:
+                        print 'Skipping %s, %s . . .' % pair
+                        continue
+                else:
+                    todo = range(len(specs))
+                reviews1 = reviewStore.fetchReviews(db_curs, productId1,
+                                                    store)
+                reviews2 = reviewStore.fetchReviews(db_curs, productId2,
+                                                    store)
+                if resultWriters is not None:
+                    rows = [resultStore.RowBuffer() for k in todo]
+                    similarity.cosineSims(reviews1, reviews2,
+                                          [specs[k] for k in todo], rows)
+                    for k, buf in zip(todo, rows):
+                        resultWriters[k].writePair(productId1, productId2,
+                                                   buf.rows)
+                    continue
+                outputFileNames = []
+                for k in todo:
+                    outputFileName =\
+                        os.path.join(options.outputDir, outputFileTemplate %\
+                        (prefixes[k], productId1, productId2))
+                    print 'Writing %s . . .' % outputFileName
+                    outputFileNames.append(outputFileName)
+                with resultStore.openFiles(outputFileNames) as csvfiles:
+                    similarity.cosineSims(reviews1, reviews2, specs,
+                        [csv.writer(csvfile) for csvfile in csvfiles])
+            if resultWriters is not None:
+                for resultWriter in resultWriters:
+                    resultWriter.close()
 
 if __name__ == '__main__':
     main()
@@ -13,6 +13,7 @@ from collections import defaultdict
 import sympy 
 
 from SimilarityGrid import SimilarityGrid
+import matrixFactorization
 
 # params
 #constSimScore = 0.16   # topEdges_40_randSim
@@ -34,6 +35,9 @@ def regSim(reviewsA, reviewsB):
        raw similarity to an improved esimate.
     """
     rawSim, numUsersCommon = regSim_rawFunc(reviewsA, reviewsB)
+    return adjustRegSim(rawSim, numUsersCommon)
+
+def adjustRegSim(rawSim, numUsersCommon):
     if numUsersCommon <= regSim_maxCommonUsers:
         intercept, slope = regSimParams[numUsersCommon]
         return (intercept + slope*rawSim, numUsersCommon)
@@ -45,6 +49,9 @@ def momSim(reviewsA, reviewsB):
        raw similarity to an improved esimate.
     """
     rawSim, numUsersCommon = momSim_rawFunc(reviewsA, reviewsB)
+    return adjustMomSim(rawSim, numUsersCommon)
+
+def adjustMomSim(rawSim, numUsersCommon):
     if numUsersCommon <= momSim_maxCommonUsers:
         mu = momSimParams['mu']
         sigma1 = momSimParams['sigma1']
@@ -59,7 +66,10 @@ def alphaSim(reviewsA, reviewsB):
        raw similarity to an improved esimate.
     """
     rawSim, numUsersCommon = alphaSim_rawFunc(reviewsA, reviewsB)
-    if numUsersCommon <= alphaSim_maxCommonUsers:
+    return adjustAlphaSim(rawSim, numUsersCommon)
+
+def adjustAlphaSim(rawSim, numUsersCommon):
+    if 0 < numUsersCommon <= alphaSim_maxCommonUsers:
         mu = float(alphaSimParams['mu'])
         sigma1 = float(alphaSimParams['sigma1'])
         alpha = float(alphaSimParams['alpha'])
@@ -135,9 +145,8 @@ def predSim(reviewsA, reviewsB):
         biasB = np.mean([review[2] for review in reviewsB])
     else:
         biasB = 0.0
-    totalScore = 0
-    totalCount = 0
-    numUsersCommon = 0
+    scoresA = []
+    scoresB = []
     i = 0
     j = 0
     while i < len(reviewsA) and j < len(reviewsB):
@@ -154,20 +163,39 @@ def predSim(reviewsA, reviewsB):
                 i += 1
                 j += 1
                 continue # ignore duplicate reviews
-            numUsersCommon += 1
-            scoreA = reviewsA[i][2] - biasA
-            scoreB = reviewsB[j][2] - biasB
-            entry = simGrid[(scoreA, scoreB)]
-            if entry:
-                totalScore += entry[0]
-                totalCount += entry[1]
+            scoresA.append(reviewsA[i][2] - biasA)
+            scoresB.append(reviewsB[j][2] - biasB)
             i += 1
             j += 1
+    numUsersCommon = len(scoresA)
+    # look up all rating pairs at once
+    scoreTotals, counts = simGrid.lookup(scoresA, scoresB)
+    totalCount = counts.sum()
     if totalCount > 0:
-        return (totalScore/totalCount, numUsersCommon)
+        return (scoreTotals.sum()/totalCount, numUsersCommon)
     else:
         return (constSimScore, numUsersCommon)
 
+def mfSim(reviewsA, reviewsB):
+    """Compute the cosine similarity of the item factor vectors of A and B in
+       a trained matrix factorization. The factor vectors are fit to the
+       given reviews with the user factors fixed (as in a step of
+       alternating least squares), so they reflect only these reviews.
+    """
+    # ignore duplicate reviews
+    timesA = dict((review[1], review[0]) for review in reviewsA)
+    duplicates = set([review[1] for review in reviewsB
+                      if timesA.get(review[1]) == review[0]])
+    if duplicates:
+        reviewsA = [review for review in reviewsA
+                    if review[1] not in duplicates]
+        reviewsB = [review for review in reviewsB
+                    if review[1] not in duplicates]
+    qA = foldInItem(reviewsA)
+    qB = foldInItem(reviewsB)
+    return (computeScore(np.dot(qA, qB), np.dot(qA, qA), np.dot(qB, qB)),
+            countUsersCommon(reviewsA, reviewsB))
+
 def modelSim(reviewsA, reviewsB):
     """this is just a place holder."""
     raise NotImplemented
@@ -300,9 +328,8 @@ def computePredictivity(absAverage, variance, epsilon):
     adjustedError = absAverage 
     return math.exp(-adjustedError/epsilon)
 
-def initWeightedSim(errorFileName, epsilon):
-    global weights
-    global avgWeight
+def loadWeights(errorFileName, epsilon):
+    """Returns (weights, avgWeight) of the users in errorFileName."""
     w = {}
     totalW = 0
     with open(errorFileName, 'rb') as csvfile:
@@ -315,8 +342,12 @@ def initWeightedSim(errorFileName, epsilon):
             totalW += w[userId]
     # create entry for unknown users
     averageW = totalW/len(w)
-    avgWeight = averageW
-    weights = defaultdict(lambda x: averageW, w)
+    return (defaultdict(lambda x: averageW, w), averageW)
+
+def initWeightedSim(errorFileName, epsilon):
+    global weights
+    global avgWeight
+    weights, avgWeight = loadWeights(errorFileName, epsilon)
 
 #########################
 #
@@ -394,7 +425,7 @@ muIdx = 0
 sigma1Idx = 1
 alphaIdx = 2
 
-def initMomSim(paramFileName, cosineFunc, maxCommonUsers):
+def initAlphaSim(paramFileName, cosineFunc, maxCommonUsers):
     global alphaSimParams
     global alphaSim_rawFunc
     global alphaSim_maxCommonUsers
@@ -422,6 +453,598 @@ def initPredSim(minRating, maxRating, stepRating, simGridFileName):
     simGridFile = open(simGridFileName, 'rb')
     simGrid.readFromFile(simGridFile)
 
+#########################
+#
+#  Matrix factorization
+#
+##############################
+
+mfModel = None
+
+def initMFSim(saveDir):
+    global mfModel
+    mfModel = matrixFactorization.FactorModel(saveDir)
+
+def foldInItem(reviews):
+    """Returns the regularized least squares item factor vector for reviews,
+       ignoring users unknown to the model.
+    """
+    dimension = mfModel.P.shape[1]
+    F, known = mfModel.getUserFactors([review[1] for review in reviews])
+    F = F[known]
+    if not len(F):
+        return np.zeros(dimension)
+    scores = np.array([review[2] for review in reviews])[known]
+    A = np.dot(F.T, F) +\
+        matrixFactorization.regularization*len(F)*np.eye(dimension)
+    return np.linalg.solve(A, np.dot(F.T, scores))
+
+#########################
+#
+#  Batch similarity
+#
+##############################
+
+batchSize = 10000
+batchCosineFuncs = {
+    'prefSim': (False, None),
+    'prefSimAlt1': (False, 'simpFudge'),
+    'randSim': (True, None),
+    'randSimAlt1': (True, 'simrFudge'),
+    'weightedRandSim': (True, None),
+}
+batchWeights = {}
+
+def getBatchWeights(store):
+    """Returns the predictivity weights indexed by the store's user codes."""
+    if store.storeDir not in batchWeights:
+        batchWeights[store.storeDir] =\
+            np.array([weights.get(userId, avgWeight)
+                      for userId in store.userIds.tolist()])
+    return batchWeights[store.storeDir]
+
+def computeBatch(funcName, pairs, store):
+    """Computes similarity function funcName for a list of (productId1,
+       productId2) pairs using the reviews in a ReviewStore. Returns arrays of
+       similarities and numbers of common users that match calling the
+       function on each pair in turn.
+    """
+    sims = np.zeros(len(pairs))
+    numUsersCommon = np.zeros(len(pairs), dtype=np.int64)
+    for begin in range(0, len(pairs), batchSize):
+        end = begin + batchSize
+        sims[begin:end], numUsersCommon[begin:end] =\
+            batchFunc(funcName, pairs[begin:end], store)
+    return sims, numUsersCommon
+
+def batchFunc(funcName, pairs, store):
+    if funcName == 'constSim':
+        rawSims, numUsersCommon = batchCosineSim(pairs, store, True)
+        return np.repeat(constSimScore, len(pairs)), numUsersCommon
+    if funcName == 'regSim':
+        rawSims, numUsersCommon =\
+            batchFunc(regSim_rawFunc.__name__, pairs, store)
+        intercepts = np.zeros(regSim_maxCommonUsers + 1)
+        slopes = np.ones(regSim_maxCommonUsers + 1)
+        for n, (intercept, slope) in regSimParams.items():
+            if n <= regSim_maxCommonUsers:
+                intercepts[n] = intercept
+                slopes[n] = slope
+        return (adjustBatch(rawSims, numUsersCommon, regSim_maxCommonUsers,
+                            lambda raw, n: intercepts[n] + slopes[n]*raw),
+                numUsersCommon)
+    if funcName == 'momSim':
+        rawSims, numUsersCommon =\
+            batchFunc(momSim_rawFunc.__name__, pairs, store)
+        mu = momSimParams['mu']
+        sigma1 = momSimParams['sigma1']
+        sigma2_n = np.zeros(momSim_maxCommonUsers + 1)
+        for n, value in momSimParams['sigma2_n'].items():
+            if n <= momSim_maxCommonUsers:
+                sigma2_n[n] = value
+        return (adjustBatch(rawSims, numUsersCommon, momSim_maxCommonUsers,
+                    lambda raw, n:
+                        (sigma1 / (sigma1 + sigma2_n[n])) * (raw - mu) + mu),
+                numUsersCommon)
+    if funcName == 'alphaSim':
+        rawSims, numUsersCommon =\
+            batchFunc(alphaSim_rawFunc.__name__, pairs, store)
+        mu = float(alphaSimParams['mu'])
+        sigma1 = float(alphaSimParams['sigma1'])
+        alpha = float(alphaSimParams['alpha'])
+        return (adjustBatch(rawSims, numUsersCommon, alphaSim_maxCommonUsers,
+                    lambda raw, n: (sigma1 / (sigma1 + alpha/np.sqrt(n))) *
+                                   (raw - mu) + mu),
+                numUsersCommon)
+    try:
+        onlyCommon, fudgeFactor = batchCosineFuncs[funcName]
+    except KeyError:
+        raise ValueError('No batch version of similarity function: %s' %
+                         funcName)
+    if funcName == 'weightedRandSim':
+        userWeights = getBatchWeights(store)
+    else:
+        userWeights = None
+    return batchCosineSim(pairs, store, onlyCommon, fudgeFactor=fudgeFactor,
+                          userWeights=userWeights)
+
+def adjustBatch(rawSims, numUsersCommon, maxCommonUsers, adjust):
+    """Applies adjust(rawSim, n) where 0 < n <= maxCommonUsers."""
+    sims = rawSims.copy()
+    idx = (numUsersCommon > 0) & (numUsersCommon <= maxCommonUsers)
+    sims[idx] = adjust(rawSims[idx], numUsersCommon[idx])
+    return sims
+
+def batchCosineSim(pairs, store, onlyCommon, fudgeFactor=None,
+                   userWeights=None):
+    """Vectorized cosineSim over a batch of pairs. The reviews of all pairs
+       are concatenated and common reviewers are found with a single
+       intersection on (pair, user code) keys.
+    """
+    numPairs = len(pairs)
+    lensA, segA, timesA, codesA, scoresA =\
+        store.getBatchArrays([pair[0] for pair in pairs])
+    lensB, segB, timesB, codesB, scoresB =\
+        store.getBatchArrays([pair[1] for pair in pairs])
+    # center scores on product biases
+    scoresA = centerBatch(lensA, segA, scoresA)
+    scoresB = centerBatch(lensB, segB, scoresB)
+    # find common reviewers, ignoring duplicate reviews
+    numUsers = len(store.userIds)
+    keysA = segA*numUsers + codesA
+    keysB = segB*numUsers + codesB
+    keys, idxA, idxB = np.intersect1d(keysA, keysB, assume_unique=True,
+                                      return_indices=True)
+    duplicate = timesA[idxA] == timesB[idxB]
+    duplicateA = idxA[duplicate]
+    duplicateB = idxB[duplicate]
+    idxA = idxA[~duplicate]
+    idxB = idxB[~duplicate]
+    pairIdx = segA[idxA]
+    commonA = scoresA[idxA]
+    commonB = scoresB[idxB]
+    if userWeights is not None:
+        commonA = commonA*userWeights[codesA[idxA]]
+        commonB = commonB*userWeights[codesB[idxB]]
+    numUsersCommon = np.bincount(pairIdx, minlength=numPairs)
+    innerProd = np.bincount(pairIdx, commonA*commonB, minlength=numPairs)
+    if onlyCommon:
+        varA = np.bincount(pairIdx, commonA**2, minlength=numPairs)
+        varB = np.bincount(pairIdx, commonB**2, minlength=numPairs)
+    else:
+        keepA = np.ones(len(scoresA), dtype=bool)
+        keepA[duplicateA] = False
+        keepB = np.ones(len(scoresB), dtype=bool)
+        keepB[duplicateB] = False
+        varA = np.bincount(segA[keepA], scoresA[keepA]**2, minlength=numPairs)
+        varB = np.bincount(segB[keepB], scoresB[keepB]**2, minlength=numPairs)
+    # Magical simp fudge factor
+    if fudgeFactor == 'simpFudge':
+        varA += np.where(lensA < K, (K - lensA)*sigma**2, 0)
+        varB += np.where(lensB < K, (K - lensB)*sigma**2, 0)
+    # Magical simr fudge factor
+    elif fudgeFactor == 'simrFudge':
+        fudge = np.where(numUsersCommon < K, (K - numUsersCommon)*sigma**2, 0)
+        varA += fudge
+        varB += fudge
+    return computeBatchScores(innerProd, varA, varB), numUsersCommon
+
+def centerBatch(lens, seg, scores):
+    scores = scores.astype(np.float64)
+    biases = np.bincount(seg, scores, minlength=len(lens)) / np.maximum(lens, 1)
+    return scores - biases[seg]
+
+def computeBatchScores(innerProd, varA, varB):
+    scores = np.zeros(len(innerProd))
+    idx = innerProd != 0
+    scores[idx] = innerProd[idx]/(np.sqrt(varA[idx])*np.sqrt(varB[idx]))
+    return scores
+
+#########################
+#
+#  Incremental similarity
+#
+##############################
+
+class SimilarityAccumulator(object):
+    """Running version of cosineSim for reviews that arrive over time.
+       Sums of scores, squares and products are kept relative to the first
+       score seen for each product, so the inner product and variances about
+       the current product biases are recovered in O(1) whenever the biases
+       change. Weights apply to common reviewers, as in weightedRandSim.
+       Further estimators added with addEstimator share the sums (common sums
+       are kept once per distinct weights), so several similarity functions
+       are computed from one pass over the reviews.
+    """
+    def __init__(self, onlyCommon=False, fudgeFactor=None, weights=None,
+                 adjust=None, K=None, sigma=None, avgWeight=None):
+        self.estimators = []
+        self.weightings = []
+        self.reviews = [{}, {}]
+        self.shifts = [None, None]
+        self.counts = [0, 0]
+        self.sums = [0.0, 0.0]
+        # count, sum and sum of squares of non-duplicate reviews
+        self.prefSums = [[0, 0.0, 0.0], [0, 0.0, 0.0]]
+        # per weighting, weighted sums of 1, xA, xB, xA**2, xB**2 and xA*xB
+        # over common users
+        self.commonSums = []
+        self.numUsersCommon = 0
+        self.addEstimator(onlyCommon=onlyCommon, fudgeFactor=fudgeFactor,
+                          weights=weights, adjust=adjust, K=K, sigma=sigma,
+                          avgWeight=avgWeight)
+
+    def addEstimator(self, onlyCommon=False, fudgeFactor=None, weights=None,
+                     adjust=None, K=None, sigma=None, avgWeight=None):
+        """Adds an estimator, before any reviews are added. K, sigma and
+           avgWeight default to the module's values.
+        """
+        if not weights:
+            weights = None
+            avgWeight = None
+        for w, (accWeights, accAvgWeight) in enumerate(self.weightings):
+            if accWeights is weights and accAvgWeight == avgWeight:
+                break
+        else:
+            w = len(self.weightings)
+            self.weightings.append((weights, avgWeight))
+            self.commonSums.append([0.0]*6)
+        self.estimators.append((onlyCommon, fudgeFactor, w, adjust, K, sigma))
+
+    def addReviews(self, reviewsA, reviewsB):
+        for review in reviewsA:
+            self.addReview(0, review)
+        for review in reviewsB:
+            self.addReview(1, review)
+
+    def addReview(self, side, review):
+        time = review[0]
+        userId = review[1]
+        if self.shifts[side] is None:
+            self.shifts[side] = review[2]
+        x = review[2] - self.shifts[side]
+        self.counts[side] += 1
+        self.sums[side] += x
+        self.reviews[side][userId] = (time, x)
+        match = self.reviews[1 - side].get(userId)
+        if match is None:
+            self.addPref(side, x, 1)
+        elif match[0] == time:
+            # ignore duplicate reviews
+            self.addPref(1 - side, match[1], -1)
+        else:
+            self.addPref(side, x, 1)
+            if side == 0:
+                self.addCommon(userId, x, match[1])
+            else:
+                self.addCommon(userId, match[1], x)
+
+    def addPref(self, side, x, sign):
+        sums = self.prefSums[side]
+        sums[0] += sign
+        sums[1] += sign*x
+        sums[2] += sign*x*x
+
+    def addCommon(self, userId, xA, xB):
+        for (accWeights, accAvgWeight), sums in zip(self.weightings,
+                                                    self.commonSums):
+            if accWeights is not None:
+                if accAvgWeight is None:
+                    accAvgWeight = avgWeight
+                w = accWeights.get(userId, accAvgWeight)**2
+            else:
+                w = 1.0
+            sums[0] += w
+            sums[1] += w*xA
+            sums[2] += w*xB
+            sums[3] += w*xA*xA
+            sums[4] += w*xB*xB
+            sums[5] += w*xA*xB
+        self.numUsersCommon += 1
+
+    def getSimilarity(self):
+        """Returns (similarity, numUsersCommon) for the reviews added so far."""
+        return self.getEstimate(self.estimators[0])
+
+    def getSimilarities(self):
+        """Returns (similarity, numUsersCommon) of each estimator."""
+        return [self.getEstimate(estimator) for estimator in self.estimators]
+
+    def getEstimate(self, estimator):
+        onlyCommon, fudgeFactor, w, adjust, estK, estSigma = estimator
+        if estK is None:
+            estK = K
+        if estSigma is None:
+            estSigma = sigma
+        biasA = self.sums[0]/self.counts[0] if self.counts[0] else 0.0
+        biasB = self.sums[1]/self.counts[1] if self.counts[1] else 0.0
+        n, sumA, sumB, sumAA, sumBB, sumAB = self.commonSums[w]
+        innerProd = sumAB - biasB*sumA - biasA*sumB + biasA*biasB*n
+        if onlyCommon:
+            varA = sumAA - 2*biasA*sumA + biasA**2*n
+            varB = sumBB - 2*biasB*sumB + biasB**2*n
+        else:
+            n, sumA, sumAA = self.prefSums[0]
+            varA = sumAA - 2*biasA*sumA + biasA**2*n
+            n, sumB, sumBB = self.prefSums[1]
+            varB = sumBB - 2*biasB*sumB + biasB**2*n
+        varA = max(varA, 0.0)
+        varB = max(varB, 0.0)
+        numUsersCommon = self.numUsersCommon
+        # Magical simp fudge factor
+        if fudgeFactor == 'simpFudge':
+            if self.counts[0] < estK:
+                varA += (estK - self.counts[0])*estSigma**2
+            if self.counts[1] < estK:
+                varB += (estK - self.counts[1])*estSigma**2
+        # Magical simr fudge factor
+        elif fudgeFactor == 'simrFudge':
+            if numUsersCommon < estK:
+                varA += (estK - numUsersCommon)*estSigma**2
+                varB += (estK - numUsersCommon)*estSigma**2
+        if varA <= 0 or varB <= 0:
+            rawSim = 0
+        else:
+            rawSim = computeScore(innerProd, varA, varB)
+        if adjust:
+            return adjust(rawSim, numUsersCommon)
+        return (rawSim, numUsersCommon)
+
+def adjustConstSim(rawSim, numUsersCommon):
+    return (constSimScore, numUsersCommon)
+
+def getAccumulator(cosineFunc):
+    """Returns a new SimilarityAccumulator computing cosineFunc, or None if
+       cosineFunc has no incremental version.
+    """
+    return getSpecsAccumulator([SimilaritySpec(cosineFunc.__name__)])
+
+def getSpecsAccumulator(specs):
+    """Returns a new SimilarityAccumulator with an estimator per
+       SimilaritySpec, or None if any of them has no incremental version.
+    """
+    estimators = [spec.getEstimator() for spec in specs]
+    if None in estimators:
+        return None
+    accumulator = SimilarityAccumulator(**estimators[0])
+    for estimator in estimators[1:]:
+        accumulator.addEstimator(**estimator)
+    return accumulator
+
+#########################
+#
+#  Fused similarity
+#
+##############################
+
+# parameters of a SimilaritySpec and their types
+specParams = {
+    'K': int,
+    'sigma': float,
+    'epsilon': float,
+    'constSimScore': float,
+}
+
+class SimilaritySpec(object):
+    """A similarity function with its own values of the parameters K,
+       sigma, epsilon and constSimScore, so that several settings can be
+       computed in one pass. Parameters that are None take the module's
+       values.
+    """
+    def __init__(self, funcName, K=None, sigma=None, epsilon=None,
+                 constSimScore=None):
+        try:
+            self.func = globals()[funcName]
+        except KeyError:
+            raise ValueError('Invalid Similarity function: %s' % funcName)
+        self.funcName = funcName
+        self.K = K
+        self.sigma = sigma
+        self.epsilon = epsilon
+        self.constSimScore = constSimScore
+        self.weights = None
+        self.avgWeight = None
+
+    def getLabel(self):
+        """Returns the function name followed by the parameters set."""
+        label = self.funcName
+        for name in sorted(specParams):
+            value = getattr(self, name)
+            if value is not None:
+                label += '_%s%s' % (name, value)
+        return label
+
+    def initWeights(self, errorFileName):
+        """Loads the user weights for epsilon, if it is set."""
+        if self.epsilon is not None:
+            self.weights, self.avgWeight =\
+                loadWeights(errorFileName, self.epsilon)
+
+    def getWeights(self):
+        if self.weights is not None:
+            return self.weights, self.avgWeight
+        return weights, avgWeight
+
+    def adjustConstSim(self, rawSim, numUsersCommon):
+        if self.constSimScore is None:
+            return adjustConstSim(rawSim, numUsersCommon)
+        return (self.constSimScore, numUsersCommon)
+
+    def getEstimator(self):
+        """Returns the SimilarityAccumulator.addEstimator arguments of this
+           function, or None if it has no incremental version.
+        """
+        cosineFunc = self.func
+        adjust = None
+        if cosineFunc == regSim:
+            cosineFunc, adjust = regSim_rawFunc, adjustRegSim
+        elif cosineFunc == momSim:
+            cosineFunc, adjust = momSim_rawFunc, adjustMomSim
+        elif cosineFunc == alphaSim:
+            cosineFunc, adjust = alphaSim_rawFunc, adjustAlphaSim
+        elif cosineFunc == constSim:
+            cosineFunc, adjust = randSim, self.adjustConstSim
+        try:
+            onlyCommon, fudgeFactor = batchCosineFuncs[cosineFunc.__name__]
+        except KeyError:
+            return None
+        if cosineFunc == weightedRandSim:
+            accWeights, accAvgWeight = self.getWeights()
+        else:
+            accWeights, accAvgWeight = None, None
+        return dict(onlyCommon=onlyCommon, fudgeFactor=fudgeFactor,
+                    weights=accWeights, adjust=adjust, K=self.K,
+                    sigma=self.sigma, avgWeight=accAvgWeight)
+
+    def __call__(self, reviewsA, reviewsB):
+        """Calls the function with the module's parameters set to these."""
+        global K, sigma, constSimScore, weights, avgWeight
+        saved = (K, sigma, constSimScore, weights, avgWeight)
+        if self.K is not None:
+            K = self.K
+        if self.sigma is not None:
+            sigma = self.sigma
+        if self.constSimScore is not None:
+            constSimScore = self.constSimScore
+        weights, avgWeight = self.getWeights()
+        try:
+            return self.func(reviewsA, reviewsB)
+        finally:
+            K, sigma, constSimScore, weights, avgWeight = saved
+
+def parseSpecs(specsString):
+    """Returns the SimilaritySpecs of a comma separated list of functions,
+       each optionally followed by :param=value settings, e.g.
+       "prefSim,randSimAlt1:K=10:sigma=0.5".
+    """
+    specs = []
+    for specString in specsString.split(','):
+        tokens = specString.strip().split(':')
+        params = {}
+        for token in tokens[1:]:
+            name, sep, value = token.partition('=')
+            if name not in specParams or not sep:
+                raise ValueError('Invalid parameter: %s' % token)
+            params[name] = specParams[name](value)
+        specs.append(SimilaritySpec(tokens[0], **params))
+    return specs
+
+def cosineSims(reviewsA, reviewsB, specs, writers=None):
+    """Computes the cosineSim based functions (those in batchCosineFuncs) of
+       specs in one merge of the reviews. Returns a list of (similarity,
+       numUsersCommon) per spec, and writes the rows of each step to the
+       spec's writer (if writers is given), as cosineSim does.
+    """
+    # compute product biases:
+    if reviewsA:
+        biasA = np.mean([review[2] for review in reviewsA])
+    else:
+        biasA = 0.0
+    if reviewsB:
+        biasB = np.mean([review[2] for review in reviewsB])
+    else:
+        biasB = 0.0
+    # sums of the estimators with weights among the distinct weights
+    weightings = []
+    estimators = []
+    for spec in specs:
+        try:
+            onlyCommon, fudgeFactor = batchCosineFuncs[spec.funcName]
+        except KeyError:
+            raise ValueError('Not a cosineSim function: %s' % spec.funcName)
+        if spec.func == weightedRandSim:
+            specWeights = spec.getWeights()[0]
+        else:
+            specWeights = None
+        for w in range(len(weightings)):
+            if weightings[w] is specWeights:
+                break
+        else:
+            w = len(weightings)
+            weightings.append(specWeights)
+        estimators.append((onlyCommon, fudgeFactor, w))
+    numUsersCommon = 0
+    # per weighting, inner product and variances over common users
+    innerProds = [0]*len(weightings)
+    commonVarsA = [0]*len(weightings)
+    commonVarsB = [0]*len(weightings)
+    # unweighted variances over all (non-duplicate) reviews
+    varA = 0
+    varB = 0
+    i = 0
+    j = 0
+    while i < len(reviewsA) and j < len(reviewsB):
+        userIdA = reviewsA[i][1]
+        userIdB = reviewsB[j][1]
+        if userIdA < userIdB:
+            varA += (reviewsA[i][2] - biasA)**2
+            i += 1
+        elif userIdA > userIdB:
+            varB += (reviewsB[j][2] - biasB)**2
+            j += 1
+        else:
+            timeA = reviewsA[i][0]
+            timeB = reviewsB[j][0]
+            if timeA == timeB:
+                i += 1
+                j += 1
+                continue # ignore duplicate reviews
+            numUsersCommon += 1
+            scoreA = reviewsA[i][2] - biasA
+            scoreB = reviewsB[j][2] - biasB
+            varA += scoreA**2
+            varB += scoreB**2
+            for w in range(len(weightings)):
+                wScoreA = scoreA
+                wScoreB = scoreB
+                if weightings[w]:
+                    wScoreA *= weightings[w][userIdA]
+                    wScoreB *= weightings[w][userIdB]
+                innerProds[w] += wScoreA*wScoreB
+                commonVarsA[w] += wScoreA**2
+                commonVarsB[w] += wScoreB**2
+            i += 1
+            j += 1
+            if numUsersCommon % step == 0 and writers is not None:
+                for (onlyCommon, fudgeFactor, w), specWriter in\
+                        zip(estimators, writers):
+                    if onlyCommon:
+                        score = computeScore(innerProds[w], commonVarsA[w],
+                                             commonVarsB[w])
+                    else:
+                        score = computeScore(innerProds[w], varA, varB)
+                    specWriter.writerow([numUsersCommon, score])
+    while i < len(reviewsA):
+        varA += (reviewsA[i][2] - biasA)**2
+        i += 1
+    while j < len(reviewsB):
+        varB += (reviewsB[j][2] - biasB)**2
+        j += 1
+    results = []
+    for spec, (onlyCommon, fudgeFactor, w) in zip(specs, estimators):
+        specK = K if spec.K is None else spec.K
+        specSigma = sigma if spec.sigma is None else spec.sigma
+        if onlyCommon:
+            specVarA = commonVarsA[w]
+            specVarB = commonVarsB[w]
+        else:
+            specVarA = varA
+            specVarB = varB
+        # Magical simp fudge factor
+        if fudgeFactor == 'simpFudge':
+            if len(reviewsA) < specK:
+                specVarA += (specK - len(reviewsA))*specSigma**2
+            if len(reviewsB) < specK:
+                specVarB += (specK - len(reviewsB))*specSigma**2
+        # Magical simr fudge factor
+        elif fudgeFactor == 'simrFudge':
+            if numUsersCommon < specK:
+                specVarA += (specK - numUsersCommon)*specSigma**2
+                specVarB += (specK - numUsersCommon)*specSigma**2
+        results.append((computeScore(innerProds[w], specVarA, specVarB),
+                        numUsersCommon))
+    return results
+
 ############
 #
 #  Stand-alone similarity
@@ -431,18 +1054,17 @@ def initPredSim(minRating, maxRating, stepRating, simGridFileName):
 from optparse import OptionParser
 import sqlite3
 
+import reviewStore
+
 # db params
 dbTimeout = 5
-selectReviewsStmt =\
-    ('SELECT Time, UserId, AdjustedScore '
-     'FROM Reviews '
-     'WHERE ProductId = :ProductId '
-     'ORDER BY UserId')
 
 def getParser(usage=None):
     parser = OptionParser(usage=usage)
     parser.add_option('-d', '--database', dest='db_fname',
         default='data/amazon.db', help='sqlite3 database file.', metavar='FILE')
+    parser.add_option('--reviewStore', dest='storeDir', default=None,
+        help='Review store directory built by reviewStore.py.', metavar='DIR')
     parser.add_option('-c', '--cosineFunc', dest='cosineFunc',
         default='prefSim',
         help=('Similarity function to use: "prefSim" (default), "randSim", '
@@ -489,6 +1111,9 @@ def getParser(usage=None):
         help='User prediction errors file for weightedModelSim.', metavar='FILE')
     parser.add_option('--epsilon', dest='epsilon', type='float', default=0.01,
         help='Decay constant epsilon for weightedPredSim.', metavar='FLOAT')
+    parser.add_option('--mfDir', dest='mfDir', default='.mf',
+        help='Save directory of matrixFactorization.py for mfSim.',
+        metavar='DIR')
     return parser
 
 def main():
@@ -544,7 +1169,7 @@ def main():
 
     if options.cosineFunc == 'alphaSim':
         # retrieve alpha params
-        initMomSim(options.alphaSimParamsFile, alphaSimRawFunc,
+        initAlphaSim(options.alphaSimParamsFile, alphaSimRawFunc,
                    options.maxUsersCommon)
 
     if options.cosineFunc == 'modelSim':
@@ -561,15 +1186,20 @@ def main():
         # initialize weights
         initWeightedSim(options.errorFileName, options.epsilon)
 
+    if options.cosineFunc == 'mfSim':
+        # load matrix factorization
+        initMFSim(options.mfDir)
+
     # connect to db
     db_conn = sqlite3.connect(options.db_fname, dbTimeout)
     db_curs = db_conn.cursor()
 
+    # open review store
+    store = reviewStore.openStore(options.storeDir)
+
     # fetch product reviews
-    db_curs.execute(selectReviewsStmt, (productId1,))
-    reviews1 = [row for row in db_curs.fetchall()]
-    db_curs.execute(selectReviewsStmt, (productId2,))
-    reviews2 = [row for row in db_curs.fetchall()]
+    reviews1 = reviewStore.fetchReviews(db_curs, productId1, store)
+    reviews2 = reviewStore.fetchReviews(db_curs, productId2, store)
 
     # compute cosine similarity using the provided function.
     cosineSim, numUserCommon = cosineFunc(reviews1, reviews2)
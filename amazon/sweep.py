@@ -0,0 +1,426 @@
+#!/usr/local/bin/python
+
+"""
+Sweeps similarity functions over a grid of parameter settings (K, sigma,
+epsilon, constSimScore and modelSim's mu_s, sigma_s, mu_r and sigma_r) with
+experiment 2 (see experiment.expt2) on a list of product pairs, and writes the
+statistics of the errors reported by aggregateExpt2.py for every setting and
+step to a single table.
+
+The reviews of the pairs are loaded once before worker processes are forked,
+and each worker processes whole pairs: everything that does not depend on the
+swept parameters (the steps, the estimate of truth and the bias-adjusted
+ratings of common reviewers) is computed once per pair, the incremental
+similarity functions of all settings share one SimilarityAccumulator, and
+modelSim is evaluated for all common reviewers of a pair at once.
+"""
+
+from optparse import OptionParser
+import functools
+import itertools
+import sqlite3
+import numpy as np
+import csv
+import os
+import sys
+
+import similarity
+import modelSim
+import ratingPairs
+import experiment
+import reviewStore
+import executor
+import aggregateExpt1 as aggexpt1
+
+# params
+outputFileTemplate = '%s_%s_%s.csv'
+defaultEpsilon = 0.01
+modelFuncNames = ['modelSim', 'weightedModelSim']
+modelParams = ['mu_s', 'sigma_s', 'mu_r', 'sigma_r']
+# swept parameters of each function
+funcParams = {
+    'prefSimAlt1': ['K', 'sigma'],
+    'randSimAlt1': ['K', 'sigma'],
+    'weightedRandSim': ['epsilon'],
+    'constSim': ['constSimScore'],
+    'modelSim': modelParams,
+    'weightedModelSim': modelParams + ['epsilon'],
+}
+sweepParams = ['K', 'sigma', 'epsilon', 'constSimScore'] + modelParams
+header = ['function'] + sweepParams +\
+         ['step', 'avgVariance', 'varVariance', 'avgError', 'varError',
+          'avgNumUsers', 'varNumUsers', 'avgLess', 'varLess', 'maxVariance',
+          'maxFilename']
+
+# reviews of the products in the pairs, loaded before forking workers
+productReviews = {}
+# modelSim params of settings that do not set them
+modelDefaults = dict((name, getattr(modelSim, name)) for name in modelParams)
+
+# db params
+dbTimeout = 5
+
+def getParser(usage=None):
+    parser = OptionParser(usage=usage)
+    parser.add_option('-w', '--numWorkers', dest='numWorkers', type='int',
+        default=1, help='Number of worker processes.', metavar='NUM')
+    parser.add_option('-d', '--database', dest='db_fname',
+        default='data/amazon.db', help='sqlite3 database file.', metavar='FILE')
+    parser.add_option('--reviewStore', dest='storeDir', default=None,
+        help='Review store directory built by reviewStore.py.', metavar='DIR')
+    parser.add_option('-o', '--outputFile', dest='outputFileName',
+        default='output/sweep.csv', help='Output file.', metavar='FILE')
+    parser.add_option('-c', '--cosineFuncs', dest='cosineFuncs',
+        default='prefSimAlt1,randSimAlt1',
+        help=('Comma separated list of similarity functions to sweep: '
+              '"prefSimAlt1,randSimAlt1" (default), or any of "prefSim", '
+              '"randSim", "prefSimAlt1", "randSimAlt1", "weightedRandSim", '
+              '"constSim", "regSim", "momSim", "alphaSim", "modelSim" and '
+              '"weightedModelSim"'), metavar='FUNCNAMES')
+    parser.add_option('-t', '--truthFunc', dest='truthFunc',
+        default='randSim',
+        help=('Similarity function to use for estimate of truth: '
+             '"prefSim" or "randSim" (default)'), metavar='FUNCNAME')
+    parser.add_option('-K', dest='K', default=None,
+        help='Values of K for prefSimAlt1 or randSimAlt1.', metavar='LIST')
+    parser.add_option('--sigma', dest='sigma', default=None,
+        help='Values of sigma for prefSimAlt1 or randSimAlt1.',
+        metavar='LIST')
+    parser.add_option('--epsilon', dest='epsilon', default=None,
+        help='Values of epsilon for weightedRandSim or weightedModelSim.',
+        metavar='LIST')
+    parser.add_option('--constSimScore', dest='constSimScore', default=None,
+        help='Values of constSimScore for constSim.', metavar='LIST')
+    parser.add_option('--mu_s', dest='mu_s', default=None,
+        help='Values of the mean of the score distribution for modelSim.',
+        metavar='LIST')
+    parser.add_option('--sigma_s', dest='sigma_s', default=None,
+        help=('Values of the standard deviation of the score distribution '
+              'for modelSim.'), metavar='LIST')
+    parser.add_option('--mu_r', dest='mu_r', default=None,
+        help='Values of the mean of the rating distribution for modelSim.',
+        metavar='LIST')
+    parser.add_option('--sigma_r', dest='sigma_r', default=None,
+        help=('Values of the standard deviation of the rating distribution '
+              'for modelSim.'), metavar='LIST')
+    parser.add_option('--maxError', type='float', dest='maxError',
+        default=modelSim.surfaceMaxError,
+        help=('Error bound of the interpolated modelSim surface. 0 solves '
+              'for every rating pair.'), metavar='FLOAT')
+    parser.add_option('--errorFileName', dest='errorFileName',
+        default='output/aggregatePredictions_modelSim.csv',
+        help='User prediction errors file for weighted functions.',
+        metavar='FILE')
+    parser.add_option('--regSimRawFunc', dest='regSimRawFunc',
+        default='randSim',
+        help=('Similarity function to used for raw similarity by regSim: '
+              '"prefSim", or "randSim" (default)'), metavar='FUNCNAME')
+    parser.add_option('--momSimRawFunc', dest='momSimRawFunc',
+        default='randSim',
+        help=('Similarity function to used for raw similarity by momSim: '
+              '"prefSim", or "randSim" (default)'), metavar='FUNCNAME')
+    parser.add_option('--alphaSimRawFunc', dest='alphaSimRawFunc',
+        default='randSim',
+        help=('Similarity function to used for raw similarity by alphaSim: '
+              '"prefSim", or "randSim" (default)'), metavar='FUNCNAME')
+    parser.add_option('--regSimParamsFile', dest='regSimParamsFile',
+        default='output/regSim_params.csv', help='Parameter file for regSim.',
+        metavar='FILE')
+    parser.add_option('--momSimParamsFile', dest='momSimParamsFile',
+        default='output/momSim_params.csv', help='Parameter file for momSim.',
+        metavar='FILE')
+    parser.add_option('--alphaSimParamsFile', dest='alphaSimParamsFile',
+        default='output/alphaSim_params.csv',
+        help='Parameter file for alphaSim.', metavar='FILE')
+    parser.add_option('--max-common-reviewers', dest='maxUsersCommon',
+        type='int', default=100,
+        help=('Maximum number of common reviewers for regSim, momSim, or '
+              'alphaSim.'), metavar='NUM')
+    return parser
+
+class Setting(object):
+    """A similarity function with values of the swept parameters. params
+       maps parameter names to values, None for the module's value.
+    """
+    def __init__(self, funcName, params):
+        self.funcName = funcName
+        self.params = params
+        self.spec = similarity.SimilaritySpec(funcName,
+            **dict((name, params[name]) for name in params
+                   if name not in modelParams))
+        self.isModel = funcName in modelFuncNames
+
+    def getLabel(self):
+        label = self.funcName
+        for name in sweepParams:
+            if self.params.get(name) is not None:
+                label += '_%s%s' % (name, self.params[name])
+        return label
+
+    def getValues(self):
+        """Returns the values of the swept parameters, with the module's
+           values for those not set ('' for parameters of other functions).
+        """
+        values = []
+        for name in sweepParams:
+            if name not in self.params:
+                values.append('')
+            elif self.params[name] is not None:
+                values.append(self.params[name])
+            elif name in modelParams:
+                values.append(modelDefaults[name])
+            elif name == 'epsilon':
+                values.append(defaultEpsilon)
+            else:
+                values.append(getattr(similarity, name))
+        return values
+
+    def setModelParams(self):
+        for name in modelParams:
+            value = self.params.get(name)
+            if value is None:
+                value = modelDefaults[name]
+            setattr(modelSim, name, value)
+
+def parseValues(valuesString, valueType):
+    """Returns the values of a comma separated list, or [None] if empty."""
+    if valuesString is None:
+        return [None]
+    return [valueType(value) for value in valuesString.split(',')]
+
+def getSettings(funcNames, grid):
+    """Returns the Settings of each function for every combination of the
+       values in grid of its swept parameters.
+    """
+    settings = []
+    for funcName in funcNames:
+        names = funcParams.get(funcName, [])
+        for values in itertools.product(*[grid[name] for name in names]):
+            settings.append(Setting(funcName, dict(zip(names, values))))
+    return settings
+
+class PairData(object):
+    """The intermediates of experiment 2 for a pair that do not depend on the
+       swept parameters: the review counts at each step, the estimate of
+       truth and the bias-adjusted ratings of the common reviewers in the
+       order modelSim predictions are made.
+    """
+    def __init__(self, reviews1, reviews2, truthFunc):
+        self.truth, numUserCommon = truthFunc(reviews1, reviews2)
+        bias1 = np.mean([review[2] for review in reviews1])
+        bias2 = np.mean([review[2] for review in reviews2])
+        # review pair times, ordered by time
+        reviewPairTimes = experiment.getReviewPairTimes(reviews1, reviews2)
+        reviewPairTimes.sort()
+        self.reviews1 = sorted(reviews1, key=lambda x: x[0])
+        self.reviews2 = sorted(reviews2, key=lambda x: x[0])
+        times1 = np.array([review[0] for review in self.reviews1])
+        times2 = np.array([review[0] for review in self.reviews2])
+        self.i = np.searchsorted(times1, reviewPairTimes, side='right')
+        self.j = np.searchsorted(times2, reviewPairTimes, side='right')
+        # common reviewers ordered by pair time, then by userId
+        times1 = dict((review[1], review[0]) for review in reviews1)
+        times2 = dict((review[1], review[0]) for review in reviews2)
+        userIds, ratings1, ratings2 =\
+            ratingPairs.getCommonRatings(reviews1, reviews2, bias1, bias2)
+        predictions = zip(userIds.tolist(), ratings1.tolist(),
+                          ratings2.tolist())
+        predictions.sort(key=lambda p: (max(times1[p[0]], times2[p[0]]),
+                                        p[0]))
+        self.userIds = [p[0] for p in predictions]
+        self.ratings1 = np.array([p[1] for p in predictions])
+        self.ratings2 = np.array([p[2] for p in predictions])
+        # number of predictions made by each step
+        pairTimes = np.array([max(times1[p[0]], times2[p[0]])
+                              for p in predictions])
+        self.numPredictions = np.searchsorted(pairTimes, reviewPairTimes,
+                                              side='right')
+
+    def getAccumulatorSims(self, accumulator):
+        """Returns the similarities of each step (rows) of the accumulator's
+           estimators (columns).
+        """
+        sims = np.zeros((len(self.i), len(accumulator.estimators)))
+        stepBegin_i = 0
+        stepBegin_j = 0
+        for step in range(len(self.i)):
+            accumulator.addReviews(self.reviews1[stepBegin_i:self.i[step]],
+                                   self.reviews2[stepBegin_j:self.j[step]])
+            stepBegin_i = self.i[step]
+            stepBegin_j = self.j[step]
+            sims[step] = [sim for (sim, numUserCommon) in
+                          accumulator.getSimilarities()]
+        return sims
+
+    def getModelSims(self, setting):
+        """Returns the similarities of each step of a modelSim setting."""
+        setting.setModelParams()
+        scores = modelSim.modelSims(self.ratings1, self.ratings2)
+        if setting.funcName == 'weightedModelSim':
+            specWeights, specAvgWeight = setting.spec.getWeights()
+            weights = np.array([specWeights.get(userId, specAvgWeight)
+                                for userId in self.userIds])
+        else:
+            weights = np.ones(len(scores))
+        totalScores = np.cumsum(scores*weights)
+        totalWeights = np.cumsum(weights)
+        return totalScores[self.numPredictions - 1]/\
+               totalWeights[self.numPredictions - 1]
+
+def initWorker(settings, workerIdx):
+    return [aggexpt1.ExptAccumulator() for setting in settings]
+
+def finishWorker(accumulators):
+    return accumulators
+
+def processPair(settings, truthFunc, accumulators, task):
+    pairIdx, (productId1, productId2) = task
+    print >> sys.stderr, 'Processing %s, %s . . .' % (productId1, productId2)
+    pair = PairData(productReviews[productId1], productReviews[productId2],
+                    truthFunc)
+    if not len(pair.i):
+        return
+    sims = np.zeros((len(pair.i), len(settings)))
+    incremental = [k for k in range(len(settings))
+                   if not settings[k].isModel]
+    if incremental:
+        accumulator = similarity.getSpecsAccumulator(
+            [settings[k].spec for k in incremental])
+        sims[:, incremental] = pair.getAccumulatorSims(accumulator)
+    for k in range(len(settings)):
+        if settings[k].isModel:
+            sims[:, k] = pair.getModelSims(settings[k])
+    users = pair.i + pair.j
+    less = np.minimum(pair.i, pair.j)
+    for k in range(len(settings)):
+        errors = sims[:, k] - pair.truth
+        filename = outputFileTemplate %\
+            (settings[k].getLabel(), productId1, productId2)
+        accumulators[k].add(aggexpt1.getOrder(0, pairIdx), filename, None,
+                            errors**2, errors, users, less)
+
+def loadReviews(db_fname, store, pairs):
+    """Loads the reviews of the products in pairs into productReviews."""
+    db_conn = sqlite3.connect(db_fname, dbTimeout)
+    db_curs = db_conn.cursor()
+    for pair in pairs:
+        for productId in pair:
+            if productId not in productReviews:
+                productReviews[productId] =\
+                    reviewStore.fetchReviews(db_curs, productId, store)
+
+def main():
+    # Parse options
+    usage = 'Usage: %prog [options] <csvfile>'
+    parser = getParser(usage=usage)
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error('Wrong number of arguments')
+    inputFileName = args[0]
+    if not os.path.isfile(inputFileName):
+        print >> sys.stderr, 'Cannot find input file: %s' % inputFileName
+        return
+    funcNames = [funcName.strip()
+                 for funcName in options.cosineFuncs.split(',')]
+    try:
+        truthFunc = getattr(similarity, options.truthFunc)
+        regSimRawFunc = getattr(similarity, options.regSimRawFunc)
+        momSimRawFunc = getattr(similarity, options.momSimRawFunc)
+        alphaSimRawFunc = getattr(similarity, options.alphaSimRawFunc)
+    except AttributeError as e:
+        print >> sys.stderr, 'Invalid Similarity function: %s' % e
+        return
+    grid = {}
+    for name in sweepParams:
+        valueType = int if name == 'K' else float
+        grid[name] = parseValues(getattr(options, name), valueType)
+    try:
+        settings = getSettings(funcNames, grid)
+    except ValueError as e:
+        print >> sys.stderr, e
+        return
+
+    # load parameter files
+    if 'regSim' in funcNames:
+        similarity.initRegSim(options.regSimParamsFile, regSimRawFunc,
+                              options.maxUsersCommon)
+    if 'momSim' in funcNames:
+        similarity.initMomSim(options.momSimParamsFile, momSimRawFunc,
+                              options.maxUsersCommon)
+    if 'alphaSim' in funcNames:
+        similarity.initAlphaSim(options.alphaSimParamsFile, alphaSimRawFunc,
+                                options.maxUsersCommon)
+    for setting in settings:
+        if not setting.isModel and setting.spec.getEstimator() is None:
+            print >> sys.stderr,\
+                'Cannot sweep similarity function: %s' % setting.funcName
+            return
+
+    # load user weights once per epsilon
+    if 'weightedRandSim' in funcNames or 'weightedModelSim' in funcNames:
+        print 'Loading weights from %s . . .' % options.errorFileName
+        weights = {}
+        for epsilon in grid['epsilon']:
+            if epsilon is not None:
+                weights[epsilon] =\
+                    similarity.loadWeights(options.errorFileName, epsilon)
+            else:
+                similarity.initWeightedSim(options.errorFileName,
+                                           defaultEpsilon)
+        for setting in settings:
+            epsilon = setting.params.get('epsilon')
+            if epsilon is not None:
+                setting.spec.weights, setting.spec.avgWeight =\
+                    weights[epsilon]
+
+    # build modelSim surfaces before forking workers
+    modelSim.surfaceMaxError = options.maxError
+    for setting in settings:
+        if setting.isModel and modelSim.surfaceMaxError:
+            print 'Building modelSim surface for %s . . .' %\
+                setting.getLabel()
+            setting.setModelParams()
+            modelSim.getSurface()
+
+    # load pairs and reviews before forking workers
+    print 'Reading from %s. . .' % inputFileName
+    with open(inputFileName, 'r') as inputfile:
+        pairs = list(executor.readPairs(inputfile))
+    store = reviewStore.openStore(options.storeDir)
+    print 'Loading reviews . . .'
+    loadReviews(options.db_fname, store, pairs)
+
+    # evaluate settings in worker processes
+    print 'Sweeping %d settings over %d pairs . . .' %\
+        (len(settings), len(pairs))
+    stats = executor.run(enumerate(pairs),
+        functools.partial(processPair, settings, truthFunc),
+        numWorkers=options.numWorkers,
+        initWorker=functools.partial(initWorker, settings),
+        finishWorker=finishWorker)
+    accumulators = [aggexpt1.ExptAccumulator() for setting in settings]
+    for s in stats:
+        for accumulator, other in zip(accumulators, s['result']):
+            accumulator.merge(other)
+
+    # write results
+    print 'Writing to %s . . .' % options.outputFileName
+    with open(options.outputFileName, 'wb') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(header)
+        for setting, accumulator in zip(settings, accumulators):
+            (avgVariance, varVariance, avgError, varError,
+             avgNumUsers, varNumUsers, avgLess, varLess,
+             maxVariance, maxFilenames) = accumulator.getStats()
+            values = [setting.funcName] + setting.getValues()
+            for i in range(len(avgVariance)):
+                writer.writerow(values +
+                                [i+1,
+                                 avgVariance[i], varVariance[i],
+                                 avgError[i], varError[i],
+                                 avgNumUsers[i], varNumUsers[i],
+                                 avgLess[i], varLess[i],
+                                 maxVariance[i], maxFilenames[i]])
+
+if __name__ == '__main__':
+    main()
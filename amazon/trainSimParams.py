@@ -0,0 +1,182 @@
+#!/usr/local/bin/python
+
+"""
+Learns the parameter files of regSim, momSim and alphaSim from the output of
+simVsK.py in one pass, in place of regressionTrainData.py followed by
+regressionTrain.py, momentsTrain.py and alphaParams.py.
+
+For each number of common reviewers n, the count and the sums of x, y, x*x,
+x*y and y*y are accumulated over the pairs, where x is the similarity after n
+common reviewers and y the pair's last (best) similarity. The linear
+regressions of y on x, the variances of x (sigma2_n), the mean and variance
+of y for n = 1 (mu and sigma1) and the fit of sigma2_n to alpha / sqrt(n) are
+computed from the sums in closed form. As in the separate scripts, n stops at
+the first number of common reviewers without data.
+"""
+
+from optparse import OptionParser
+import numpy as np
+import csv
+import os
+import sys
+
+import resultStore
+
+# params
+numUsersCommonIdx = 0
+scoreIdx = 1
+regSimParamsFileName = 'regSim_params.csv'
+momSimParamsFileName = 'momSim_params.csv'
+alphaSimParamsFileName = 'alphaSim_params.csv'
+
+def getParser(usage=None):
+    parser = OptionParser(usage=usage)
+    parser.add_option('-o', '--output-dir', dest='outputDir',
+        default='output', help='Output directory.', metavar='DIR')
+    parser.add_option('-m', '--max-common-reviewers', dest='maxUsersCommon',
+        type='int', default=100, help='Maximum number of common reviewers.',
+        metavar='NUM')
+    parser.add_option('-p', '--pattern', dest='pattern', default='*.csv',
+        help='Input file pattern.', metavar='PATTERN')
+    parser.add_option('--shards', dest='shards', default=None,
+        help='Read results from the npz shards with this prefix.',
+        metavar='PREFIX')
+    return parser
+
+class SimSums(object):
+    """Sums of (x, y) = (similarity, last similarity) by number of common
+       reviewers, indexed from 0.
+    """
+    def __init__(self, maxUsersCommon):
+        self.counts = np.zeros(maxUsersCommon + 1, dtype=np.int64)
+        self.x = np.zeros(maxUsersCommon + 1)
+        self.y = np.zeros(maxUsersCommon + 1)
+        self.xx = np.zeros(maxUsersCommon + 1)
+        self.xy = np.zeros(maxUsersCommon + 1)
+        self.yy = np.zeros(maxUsersCommon + 1)
+
+    def add(self, numUsersCommon, scores):
+        if not len(scores):
+            return
+        # last score is the best estimate of the true score
+        trueScore = scores[-1]
+        idx = numUsersCommon < len(self.counts)
+        n = numUsersCommon[idx]
+        x = scores[idx]
+        length = len(self.counts)
+        self.counts += np.bincount(n, minlength=length)
+        self.x += np.bincount(n, weights=x, minlength=length)
+        self.y += np.bincount(n, minlength=length)*trueScore
+        self.xx += np.bincount(n, weights=x*x, minlength=length)
+        self.xy += np.bincount(n, weights=x, minlength=length)*trueScore
+        self.yy += np.bincount(n, minlength=length)*trueScore**2
+
+    def getLength(self):
+        """Returns the number of n from 1 on with data."""
+        empty = np.flatnonzero(self.counts[1:] == 0)
+        if len(empty):
+            return empty[0]
+        return len(self.counts) - 1
+
+def linearRegression(sums, length):
+    """Returns (intercepts, slopes, sqrErrors) of the least squares fits of
+       y = intercept + slope*x for n = 1..length. Where all x are equal, the
+       fit is the least squares solution of minimum norm.
+    """
+    s = slice(1, length + 1)
+    n = sums.counts[s].astype(np.float64)
+    sx = sums.x[s]
+    sy = sums.y[s]
+    sxx = sums.xx[s]
+    sxy = sums.xy[s]
+    syy = sums.yy[s]
+    varX = n*sxx - sx*sx
+    covXY = n*sxy - sx*sy
+    degenerate = varX <= 1e-12*np.maximum(n*sxx, 1e-300)
+    slopes = np.where(degenerate, 0.0, covXY/np.where(degenerate, 1.0, varX))
+    intercepts = (sy - slopes*sx)/n
+    # minimum norm solution when x is constant
+    x0 = sx/n
+    y0 = sy/n
+    slopes = np.where(degenerate, x0*y0/(1 + x0*x0), slopes)
+    intercepts = np.where(degenerate, y0/(1 + x0*x0), intercepts)
+    sqrErrors = syy - 2*slopes*sxy - 2*intercepts*sy + slopes**2*sxx +\
+                2*slopes*intercepts*sx + n*intercepts**2
+    return intercepts, slopes, np.maximum(sqrErrors, 0.0)
+
+def getMoments(sums, length):
+    """Returns (mu, sigma1, sigma2_n) for n = 1..length."""
+    s = slice(1, length + 1)
+    n = sums.counts[s].astype(np.float64)
+    mu = sums.y[1]/n[0]
+    sigma1 = sums.yy[1]/n[0] - mu*mu
+    means = sums.x[s]/n
+    sigma2_n = sums.xx[s]/n - means*means
+    return mu, sigma1, sigma2_n
+
+def learnAlpha(sigma2_n):
+    """Returns alpha of the fit of sigma2_n to alpha / sqrt(n)."""
+    n = np.arange(1, len(sigma2_n) + 1)
+    return (sigma2_n/np.sqrt(n)).sum()/(1.0/n).sum()
+
+def main():
+    # Parse options
+    usage = 'Usage: %prog [options] inputDir'
+    parser = getParser(usage=usage)
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error('Wrong number of arguments')
+    inputDir = args[0]
+    if not os.path.isdir(inputDir):
+        print >> sys.stderr, 'Cannot find: %s' % inputDir
+        return
+    if not os.path.isdir(options.outputDir):
+        print >> sys.stderr, 'Cannot find output dir: %s' % options.outputDir
+        return
+
+    # accumulate sums
+    print 'Reading files in %s . . .' % inputDir
+    sums = SimSums(options.maxUsersCommon)
+    for filename, productId1, productId2, columns in\
+        resultStore.iterResults(inputDir, resultStore.simVsKDtypes,
+                                pattern=options.pattern,
+                                prefix=options.shards):
+        sums.add(columns[numUsersCommonIdx], columns[scoreIdx])
+    length = sums.getLength()
+    if length == 0:
+        print >> sys.stderr, 'ERROR: No data for 1 common reviewer'
+        return
+    if length < options.maxUsersCommon:
+        print >> sys.stderr,\
+            'ERROR: No data for %d common reviewers' % (length + 1)
+
+    # linear regressions
+    intercepts, slopes, sqrErrors = linearRegression(sums, length)
+    outputFileName = os.path.join(options.outputDir, regSimParamsFileName)
+    print 'Writing %s . . .' % outputFileName
+    with open(outputFileName, 'wb') as csvfile:
+        writer = csv.writer(csvfile)
+        for k in range(length):
+            writer.writerow([k + 1, intercepts[k], slopes[k],
+                             sums.counts[k + 1], sqrErrors[k]])
+
+    # method of moments
+    mu, sigma1, sigma2_n = getMoments(sums, length)
+    outputFileName = os.path.join(options.outputDir, momSimParamsFileName)
+    print 'Writing %s . . .' % outputFileName
+    with open(outputFileName, 'wb') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['mu', mu])
+        writer.writerow(['sigma1', sigma1])
+        for k in range(length):
+            writer.writerow([k + 1, sigma2_n[k]])
+
+    # alpha fit
+    outputFileName = os.path.join(options.outputDir, alphaSimParamsFileName)
+    print 'Writing %s . . .' % outputFileName
+    with open(outputFileName, 'wb') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow([mu, sigma1, learnAlpha(sigma2_n)])
+
+if __name__ == '__main__':
+    main()